@@ -174,7 +174,7 @@ class AdminAPITester:
             
             if response.status_code == 200:
                 data = response.json()
-                required_fields = ["leads", "total", "page", "limit", "pages"]
+                required_fields = ["leads", "total", "total_exact", "limit", "next_cursor"]
                 if all(field in data for field in required_fields) and isinstance(data["leads"], list):
                     # Store first lead ID for later tests
                     if data["leads"]:
@@ -319,7 +319,7 @@ class AdminAPITester:
             
             if response.status_code == 200:
                 data = response.json()
-                required_fields = ["orders", "total", "page", "limit"]
+                required_fields = ["orders", "total", "total_exact", "limit", "next_cursor"]
                 if all(field in data for field in required_fields) and isinstance(data["orders"], list):
                     self.log_result("Admin Orders", True, response)
                     return True
@@ -1,7 +1,5 @@
 import os
 import uuid
-import csv
-import io
 import hashlib
 import logging
 import httpx
@@ -9,10 +7,11 @@ from datetime import datetime, timezone, timedelta
 from typing import Optional, List, Dict
 from dotenv import load_dotenv
 load_dotenv("/app/backend/.env")
-from fastapi import APIRouter, HTTPException, Depends, Header, Query
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, HTTPException, Depends, Header, Query, Request, Response
 from pydantic import BaseModel
 from motor.motor_asyncio import AsyncIOMotorClient
+from settings_cache import cached, bump_settings_version
+from query_fanout import server_timing
 import jwt
 from passlib.hash import bcrypt
 
@@ -185,49 +184,64 @@ def build_prev_period(start, end):
 
 @router.get("/analytics/executive")
 async def analytics_executive(
+    response: Optional[Response] = Depends(server_timing),
     admin=Depends(require_admin),
     days: int = Query(30),
     date_from: Optional[str] = None,
     date_to: Optional[str] = None,
 ):
+    from event_rollups import rollup_counts, avg_step_time_ms
+    from timing_sketches import percentiles
+    from query_fanout import fan_out
     start, end = build_date_filter(days, date_from, date_to)
     prev_start, prev_end = build_prev_period(start, end)
-    ts_filter = {"server_timestamp": {"$gte": start, "$lte": end}}
-    prev_ts_filter = {"server_timestamp": {"$gte": prev_start, "$lte": prev_end}}
     lead_filter = {"created_at": {"$gte": start, "$lte": end}}
     prev_lead_filter = {"created_at": {"$gte": prev_start, "$lte": prev_end}}
 
-    # Current period
-    sessions = await db.events.count_documents({**ts_filter, "event_name": "tlj_session_start"})
-    wizard_starts = await db.events.count_documents({**ts_filter, "event_name": "tlj_wizard_start"})
-    submits = await db.events.count_documents({**ts_filter, "event_name": "tlj_lead_created"})
-    total_leads = await db.leads.count_documents(lead_filter)
-    abandons = await db.events.count_documents({**ts_filter, "event_name": "tlj_step_abandon"})
-
-    # Previous period
-    prev_sessions = await db.events.count_documents({**prev_ts_filter, "event_name": "tlj_session_start"})
-    prev_wizard_starts = await db.events.count_documents({**prev_ts_filter, "event_name": "tlj_wizard_start"})
-    prev_submits = await db.events.count_documents({**prev_ts_filter, "event_name": "tlj_lead_created"})
-    prev_total_leads = await db.leads.count_documents(prev_lead_filter)
+    # Event counts from rollups (current + previous period); every lead
+    # number from one $facet over both periods.
+    counted = {"event_name": {"$in": ["tlj_session_start", "tlj_wizard_start", "tlj_lead_created", "tlj_step_abandon", "tlj_step_complete"]}}
+    leads_facet = [
+        {"$match": {"created_at": {"$gte": prev_start, "$lte": end}}},
+        {"$facet": {
+            "total": [{"$match": lead_filter}, {"$count": "n"}],
+            "prev_total": [{"$match": prev_lead_filter}, {"$count": "n"}],
+            "quality": [{"$match": lead_filter}, {"$group": {"_id": "$intent_bucket", "count": {"$sum": 1}}}],
+            "status": [{"$match": lead_filter}, {"$group": {"_id": "$status", "count": {"$sum": 1}}}],
+        }},
+    ]
+    r = await fan_out({
+        "events": rollup_counts(start, end, ["event_name"], counted),
+        "prev_events": rollup_counts(prev_start, prev_end, ["event_name"], counted),
+        "leads": db.leads.aggregate(leads_facet).to_list(1),
+        "step_times": percentiles("step_time", start, end),
+    }, response)
+    cur = {row["event_name"]: row for row in r["events"]}
+    prev = {row["event_name"]: row for row in r["prev_events"]}
+    leads = r["leads"][0] if r["leads"] else {}
+
+    sessions = cur.get("tlj_session_start", {}).get("count", 0)
+    wizard_starts = cur.get("tlj_wizard_start", {}).get("count", 0)
+    submits = cur.get("tlj_lead_created", {}).get("count", 0)
+    abandons = cur.get("tlj_step_abandon", {}).get("count", 0)
+    total_leads = leads["total"][0]["n"] if leads.get("total") else 0
+
+    prev_sessions = prev.get("tlj_session_start", {}).get("count", 0)
+    prev_wizard_starts = prev.get("tlj_wizard_start", {}).get("count", 0)
+    prev_submits = prev.get("tlj_lead_created", {}).get("count", 0)
+    prev_total_leads = leads["prev_total"][0]["n"] if leads.get("prev_total") else 0
 
     # Completion rate
     completion_rate = round((submits / wizard_starts * 100), 1) if wizard_starts > 0 else 0
     prev_completion_rate = round((prev_submits / prev_wizard_starts * 100), 1) if prev_wizard_starts > 0 else 0
 
     # Avg step time
-    step_time_pipeline = [{"$match": {**ts_filter, "event_name": "tlj_step_complete", "step_time_ms": {"$exists": True, "$gt": 0}}}, {"$group": {"_id": None, "avg_ms": {"$avg": "$step_time_ms"}, "median_ms": {"$avg": "$step_time_ms"}}}]
-    step_time_result = await db.events.aggregate(step_time_pipeline).to_list(1)
-    avg_step_time_sec = round(step_time_result[0]["avg_ms"] / 1000, 1) if step_time_result and step_time_result[0].get("avg_ms") else 0
+    avg_step_time_sec = round(avg_step_time_ms(cur.get("tlj_step_complete", {})) / 1000, 1)
+    step_pct = r["step_times"].get("_all", {})
 
-    # Lead quality breakdown
-    quality_pipeline = [{"$match": lead_filter}, {"$group": {"_id": "$intent_bucket", "count": {"$sum": 1}}}]
-    quality_result = await db.leads.aggregate(quality_pipeline).to_list(10)
-    quality_breakdown = {q["_id"] or "unscored": q["count"] for q in quality_result}
-
-    # Status breakdown
-    status_pipeline = [{"$match": lead_filter}, {"$group": {"_id": "$status", "count": {"$sum": 1}}}]
-    status_result = await db.leads.aggregate(status_pipeline).to_list(20)
-    status_breakdown = {s["_id"] or "new": s["count"] for s in status_result}
+    # Lead quality + status breakdown
+    quality_breakdown = {q["_id"] or "unscored": q["count"] for q in leads.get("quality", [])}
+    status_breakdown = {s["_id"] or "new": s["count"] for s in leads.get("status", [])}
 
     def delta(current, previous):
         if previous == 0:
@@ -243,6 +257,8 @@ async def analytics_executive(
             "total_leads": {"value": total_leads, "prev": prev_total_leads, "delta": delta(total_leads, prev_total_leads)},
             "completion_rate": {"value": completion_rate, "prev": prev_completion_rate, "delta": round(completion_rate - prev_completion_rate, 1)},
             "avg_step_time_sec": {"value": avg_step_time_sec},
+            "median_step_time_sec": {"value": round(step_pct.get("p50", 0) / 1000, 1)},
+            "p90_step_time_sec": {"value": round(step_pct.get("p90", 0) / 1000, 1)},
             "abandons": {"value": abandons},
         },
         "quality_breakdown": quality_breakdown,
@@ -270,57 +286,48 @@ async def analytics_overview(admin=Depends(require_admin)):
 
 @router.get("/analytics/funnel")
 async def analytics_funnel(
+    response: Optional[Response] = Depends(server_timing),
     admin=Depends(require_admin),
     days: int = Query(30),
     date_from: Optional[str] = None,
     date_to: Optional[str] = None,
+    exact: bool = Query(False),
 ):
+    from event_rollups import rollup_counts, distinct_counts, avg_step_time_ms
+    from query_fanout import fan_out
     start, end = build_date_filter(days, date_from, date_to)
-    ts_filter = {"server_timestamp": {"$gte": start, "$lte": end}}
 
     # Top-level funnel
     funnel_events = ["tlj_landing_view", "tlj_session_start", "tlj_wizard_start", "tlj_step_view", "tlj_step_complete", "tlj_value_reveal_view", "tlj_contact_submit_attempt", "tlj_lead_created"]
-    pipeline = [{"$match": {**ts_filter, "event_name": {"$in": funnel_events}}}, {"$group": {"_id": "$event_name", "count": {"$sum": 1}, "unique_sessions": {"$addToSet": "$session_id"}}}]
-    result = await db.events.aggregate(pipeline).to_list(20)
-    funnel = {}
-    for r in result:
-        funnel[r["_id"]] = {"count": r["count"], "unique_sessions": len(r["unique_sessions"])}
+    step_events = ["tlj_step_view", "tlj_step_complete", "tlj_step_abandon"]
 
-    # Step-level breakdown with timing
-    step_view_pipeline = [
-        {"$match": {**ts_filter, "event_name": "tlj_step_view"}},
-        {"$group": {"_id": "$wizard_step", "views": {"$sum": 1}, "unique_sessions": {"$addToSet": "$session_id"}}}
-    ]
-    step_views = await db.events.aggregate(step_view_pipeline).to_list(30)
-
-    step_complete_pipeline = [
-        {"$match": {**ts_filter, "event_name": "tlj_step_complete"}},
-        {"$group": {"_id": "$wizard_step", "completes": {"$sum": 1}, "avg_time_ms": {"$avg": "$step_time_ms"}, "unique_sessions": {"$addToSet": "$session_id"}}}
-    ]
-    step_completes = await db.events.aggregate(step_complete_pipeline).to_list(30)
-
-    step_abandon_pipeline = [
-        {"$match": {**ts_filter, "event_name": "tlj_step_abandon"}},
-        {"$group": {"_id": "$wizard_step", "abandons": {"$sum": 1}}}
-    ]
-    step_abandons = await db.events.aggregate(step_abandon_pipeline).to_list(30)
+    r = await fan_out({
+        "funnel": distinct_counts(start, end, ["event_name"], {"event_name": {"$in": funnel_events}}, exact=exact),
+        "steps": distinct_counts(start, end, ["event_name", "wizard_step"], {"event_name": {"$in": step_events}}, exact=exact),
+        "step_times": rollup_counts(start, end, ["wizard_step"], {"event_name": "tlj_step_complete"}),
+    }, response)
+    funnel = {}
+    for f in r["funnel"]:
+        funnel[f["event_name"]] = {"count": f["count"], "unique_sessions": f["sessions"]}
+    step_rows = {(row["event_name"], row["wizard_step"]): row for row in r["steps"]}
 
     # Merge step data
     steps = {}
-    for sv in step_views:
-        sid = sv["_id"] or "unknown"
-        steps[sid] = {"views": sv["views"], "unique_views": len(sv["unique_sessions"]), "completes": 0, "abandons": 0, "avg_time_sec": 0}
-    for sc in step_completes:
-        sid = sc["_id"] or "unknown"
-        if sid not in steps:
-            steps[sid] = {"views": 0, "unique_views": 0, "completes": 0, "abandons": 0, "avg_time_sec": 0}
-        steps[sid]["completes"] = sc["completes"]
-        steps[sid]["avg_time_sec"] = round(sc["avg_time_ms"] / 1000, 1) if sc.get("avg_time_ms") else 0
-        steps[sid]["unique_completes"] = len(sc["unique_sessions"])
-    for sa in step_abandons:
-        sid = sa["_id"] or "unknown"
+    for (event, step), row in sorted(step_rows.items(), key=lambda kv: step_events.index(kv[0][0])):
+        sid = step or "unknown"
+        if event == "tlj_step_view":
+            steps[sid] = {"views": row["count"], "unique_views": row["sessions"], "completes": 0, "abandons": 0, "avg_time_sec": 0}
+        elif event == "tlj_step_complete":
+            if sid not in steps:
+                steps[sid] = {"views": 0, "unique_views": 0, "completes": 0, "abandons": 0, "avg_time_sec": 0}
+            steps[sid]["completes"] = row["count"]
+            steps[sid]["unique_completes"] = row["sessions"]
+        elif sid in steps:
+            steps[sid]["abandons"] = row["count"]
+    for st in r["step_times"]:
+        sid = st["wizard_step"] or "unknown"
         if sid in steps:
-            steps[sid]["abandons"] = sa["abandons"]
+            steps[sid]["avg_time_sec"] = round(avg_step_time_ms(st) / 1000, 1)
 
     # Calculate drop rates
     for sid, data in steps.items():
@@ -331,121 +338,120 @@ async def analytics_funnel(
 
     return {"funnel": funnel, "steps": steps}
 
+@router.get("/analytics/funnel/sequence")
+async def analytics_funnel_sequence(
+    admin=Depends(require_admin),
+    days: int = Query(30),
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    steps: Optional[str] = None,
+):
+    """Strict per-session funnel: ordered conversion, time between steps and drop-off paths."""
+    from funnel_engine import evaluate, parse_definition
+    definition = parse_definition(steps)
+    start, end = build_date_filter(days, date_from, date_to)
+    return await evaluate(start, end, definition)
+
 @router.get("/analytics/trends")
 async def analytics_trends(
+    response: Optional[Response] = Depends(server_timing),
     admin=Depends(require_admin),
     days: int = Query(30),
     date_from: Optional[str] = None,
     date_to: Optional[str] = None,
 ):
+    from event_rollups import rollup_counts
+    from query_fanout import fan_out
     start, end = build_date_filter(days, date_from, date_to)
-    ts_filter = {"server_timestamp": {"$gte": start, "$lte": end}}
+
+    trend_events = {"event_name": {"$in": ["tlj_session_start", "tlj_wizard_start", "tlj_lead_created"]}}
+    metric_key = {"tlj_session_start": "sessions", "tlj_wizard_start": "wizard_starts", "tlj_lead_created": "leads"}
+    q = await fan_out({
+        "daily": rollup_counts(start, end, ["date", "event_name"], trend_events),
+        "hourly": rollup_counts(start, end, ["hour", "event_name"], trend_events),
+    }, response)
 
     # Daily trends
-    daily_pipeline = [
-        {"$match": {**ts_filter, "event_name": {"$in": ["tlj_session_start", "tlj_wizard_start", "tlj_lead_created"]}}},
-        {"$group": {
-            "_id": {"date": {"$dateToString": {"format": "%Y-%m-%d", "date": "$server_timestamp"}}, "event": "$event_name"},
-            "count": {"$sum": 1}
-        }},
-        {"$sort": {"_id.date": 1}}
-    ]
-    daily_result = await db.events.aggregate(daily_pipeline).to_list(500)
     daily = {}
-    for r in daily_result:
-        d = r["_id"]["date"]
+    for r in q["daily"]:
+        d = r["date"]
         if d not in daily:
             daily[d] = {"date": d, "sessions": 0, "wizard_starts": 0, "leads": 0}
-        if r["_id"]["event"] == "tlj_session_start":
-            daily[d]["sessions"] = r["count"]
-        elif r["_id"]["event"] == "tlj_wizard_start":
-            daily[d]["wizard_starts"] = r["count"]
-        elif r["_id"]["event"] == "tlj_lead_created":
-            daily[d]["leads"] = r["count"]
-
-    # Hourly heatmap
-    hourly_pipeline = [
-        {"$match": {**ts_filter, "event_name": {"$in": ["tlj_session_start", "tlj_wizard_start", "tlj_lead_created"]}}},
-        {"$group": {
-            "_id": {"hour": {"$hour": "$server_timestamp"}, "dow": {"$dayOfWeek": "$server_timestamp"}, "event": "$event_name"},
-            "count": {"$sum": 1}
-        }}
-    ]
-    hourly_result = await db.events.aggregate(hourly_pipeline).to_list(500)
+        daily[d][metric_key[r["event_name"]]] = r["count"]
+
+    # Hourly heatmap (dow: 1 = Sunday, as Mongo's $dayOfWeek)
     hourly = {}
-    for r in hourly_result:
-        key = f"{r['_id']['dow']}_{r['_id']['hour']}"
+    for r in q["hourly"]:
+        hour_start = datetime.strptime(r["hour"], "%Y-%m-%dT%H")
+        dow, hour = hour_start.isoweekday() % 7 + 1, hour_start.hour
+        key = f"{dow}_{hour}"
         if key not in hourly:
-            hourly[key] = {"dow": r["_id"]["dow"], "hour": r["_id"]["hour"], "sessions": 0, "wizard_starts": 0, "leads": 0}
-        if r["_id"]["event"] == "tlj_session_start":
-            hourly[key]["sessions"] = r["count"]
-        elif r["_id"]["event"] == "tlj_wizard_start":
-            hourly[key]["wizard_starts"] = r["count"]
-        elif r["_id"]["event"] == "tlj_lead_created":
-            hourly[key]["leads"] = r["count"]
+            hourly[key] = {"dow": dow, "hour": hour, "sessions": 0, "wizard_starts": 0, "leads": 0}
+        hourly[key][metric_key[r["event_name"]]] += r["count"]
 
     return {"daily": sorted(daily.values(), key=lambda x: x["date"]), "hourly": list(hourly.values())}
 
 @router.get("/analytics/friction")
 async def analytics_friction(
+    response: Optional[Response] = Depends(server_timing),
     admin=Depends(require_admin),
     days: int = Query(30),
     date_from: Optional[str] = None,
     date_to: Optional[str] = None,
 ):
+    from event_rollups import rollup_counts, avg_step_time_ms
+    from timing_sketches import percentiles
+    from query_fanout import fan_out
     start, end = build_date_filter(days, date_from, date_to)
-    ts_filter = {"server_timestamp": {"$gte": start, "$lte": end}}
+    q = await fan_out({
+        "step_percentiles": percentiles("step_time", start, end),
+        "abandons": rollup_counts(start, end, ["wizard_step"], {"event_name": "tlj_step_abandon"}),
+        "field_errors": rollup_counts(start, end, ["field_name", "error_code"], {"event_name": "tlj_field_error"}),
+        "step_times": rollup_counts(start, end, ["wizard_step"], {"event_name": "tlj_step_complete"}),
+        "back": rollup_counts(start, end, ["from_step"], {"event_name": "tlj_step_back"}),
+    }, response)
 
     # Step-level friction: abandons by step
-    abandon_pipeline = [
-        {"$match": {**ts_filter, "event_name": "tlj_step_abandon"}},
-        {"$group": {"_id": "$wizard_step", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-        {"$limit": 15}
-    ]
-    abandon_result = await db.events.aggregate(abandon_pipeline).to_list(15)
+    abandon_result = sorted(q["abandons"], key=lambda r: -r["count"])[:15]
 
     # Field errors
-    field_error_pipeline = [
-        {"$match": {**ts_filter, "event_name": "tlj_field_error"}},
-        {"$group": {"_id": {"field": "$field_name", "error": "$error_code"}, "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-        {"$limit": 20}
-    ]
-    field_error_result = await db.events.aggregate(field_error_pipeline).to_list(20)
+    field_error_result = sorted(q["field_errors"], key=lambda r: -r["count"])[:20]
 
-    # Slowest steps (avg time)
-    slow_step_pipeline = [
-        {"$match": {**ts_filter, "event_name": "tlj_step_complete", "step_time_ms": {"$exists": True, "$gt": 0}}},
-        {"$group": {"_id": "$wizard_step", "avg_time_ms": {"$avg": "$step_time_ms"}, "max_time_ms": {"$max": "$step_time_ms"}, "count": {"$sum": 1}}},
-        {"$sort": {"avg_time_ms": -1}},
-        {"$limit": 15}
-    ]
-    slow_step_result = await db.events.aggregate(slow_step_pipeline).to_list(15)
+    # Slowest steps by median time (a few tabs left open for hours skew the mean)
+    pct = q["step_percentiles"]
+
+    def step_pct(row):
+        return pct.get(str(row["wizard_step"]) if row["wizard_step"] is not None else "unknown", {})
+
+    slow_step_result = sorted((r for r in q["step_times"] if r["st_n"]), key=lambda r: (-step_pct(r).get("p50", 0), -avg_step_time_ms(r)))[:15]
 
     # Back-button frequency by step
-    back_pipeline = [
-        {"$match": {**ts_filter, "event_name": "tlj_step_back"}},
-        {"$group": {"_id": "$event_data.from_step_id", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-        {"$limit": 10}
-    ]
-    back_result = await db.events.aggregate(back_pipeline).to_list(10)
+    back_result = sorted(q["back"], key=lambda r: -r["count"])[:10]
 
     return {
-        "abandon_by_step": [{"step": a["_id"] or "unknown", "count": a["count"]} for a in abandon_result],
-        "field_errors": [{"field": f["_id"]["field"] or "unknown", "error": f["_id"]["error"] or "unknown", "count": f["count"]} for f in field_error_result],
-        "slowest_steps": [{"step": s["_id"] or "unknown", "avg_time_sec": round(s["avg_time_ms"] / 1000, 1), "max_time_sec": round(s["max_time_ms"] / 1000, 1), "count": s["count"]} for s in slow_step_result],
-        "back_navigation": [{"from_step": b["_id"] or "unknown", "count": b["count"]} for b in back_result],
+        "abandon_by_step": [{"step": a["wizard_step"] or "unknown", "count": a["count"]} for a in abandon_result],
+        "field_errors": [{"field": f["field_name"] or "unknown", "error": f["error_code"] or "unknown", "count": f["count"]} for f in field_error_result],
+        "slowest_steps": [{
+            "step": s["wizard_step"] or "unknown",
+            "avg_time_sec": round(avg_step_time_ms(s) / 1000, 1),
+            "p50_time_sec": round(step_pct(s).get("p50", 0) / 1000, 1),
+            "p90_time_sec": round(step_pct(s).get("p90", 0) / 1000, 1),
+            "p99_time_sec": round(step_pct(s).get("p99", 0) / 1000, 1),
+            "max_time_sec": round(s["st_max"] / 1000, 1),
+            "count": s["st_n"],
+        } for s in slow_step_result],
+        "back_navigation": [{"from_step": b["from_step"] or "unknown", "count": b["count"]} for b in back_result],
     }
 
 @router.get("/analytics/quality")
 async def analytics_quality(
+    response: Optional[Response] = Depends(server_timing),
     admin=Depends(require_admin),
     days: int = Query(30),
     date_from: Optional[str] = None,
     date_to: Optional[str] = None,
 ):
+    from query_fanout import fan_out
     start, end = build_date_filter(days, date_from, date_to)
     lead_filter = {"created_at": {"$gte": start, "$lte": end}}
 
@@ -454,11 +460,13 @@ async def analytics_quality(
         {"$match": {**lead_filter, "lead_score": {"$exists": True}}},
         {"$bucket": {"groupBy": "$lead_score", "boundaries": [0, 20, 40, 60, 80, 101], "default": "other", "output": {"count": {"$sum": 1}}}}
     ]
-    try:
-        score_result = await db.leads.aggregate(score_pipeline).to_list(10)
-        score_dist = [{"range": f"{r['_id']}-{r['_id']+19}" if isinstance(r['_id'], int) else str(r['_id']), "count": r["count"]} for r in score_result]
-    except Exception:
-        score_dist = []
+
+    async def score_distribution():
+        try:
+            score_result = await db.leads.aggregate(score_pipeline).to_list(10)
+            return [{"range": f"{r['_id']}-{r['_id']+19}" if isinstance(r['_id'], int) else str(r['_id']), "count": r["count"]} for r in score_result]
+        except Exception:
+            return []
 
     # Intent bucket breakdown
     intent_pipeline = [
@@ -466,7 +474,6 @@ async def analytics_quality(
         {"$group": {"_id": "$intent_bucket", "count": {"$sum": 1}, "avg_score": {"$avg": {"$ifNull": ["$lead_score", 0]}}}},
         {"$sort": {"count": -1}}
     ]
-    intent_result = await db.leads.aggregate(intent_pipeline).to_list(10)
 
     # Quality by source
     quality_by_source_pipeline = [
@@ -475,7 +482,6 @@ async def analytics_quality(
         {"$sort": {"count": -1}},
         {"$limit": 15}
     ]
-    quality_source_result = await db.leads.aggregate(quality_by_source_pipeline).to_list(15)
 
     # Quality flags frequency
     flags_pipeline = [
@@ -484,7 +490,14 @@ async def analytics_quality(
         {"$group": {"_id": "$quality_flags", "count": {"$sum": 1}}},
         {"$sort": {"count": -1}}
     ]
-    flags_result = await db.leads.aggregate(flags_pipeline).to_list(20)
+
+    q = await fan_out({
+        "score_distribution": score_distribution(),
+        "intent": db.leads.aggregate(intent_pipeline).to_list(10),
+        "by_source": db.leads.aggregate(quality_by_source_pipeline).to_list(15),
+        "flags": db.leads.aggregate(flags_pipeline).to_list(20),
+    }, response)
+    score_dist, intent_result, quality_source_result, flags_result = q["score_distribution"], q["intent"], q["by_source"], q["flags"]
 
     return {
         "score_distribution": score_dist,
@@ -495,40 +508,16 @@ async def analytics_quality(
 
 @router.get("/analytics/geo")
 async def analytics_geo(
+    response: Optional[Response] = Depends(server_timing),
     admin=Depends(require_admin),
     days: int = Query(30),
     date_from: Optional[str] = None,
     date_to: Optional[str] = None,
+    exact: bool = Query(False),
 ):
+    from event_rollups import rollup_counts, distinct_counts
+    from query_fanout import fan_out
     start, end = build_date_filter(days, date_from, date_to)
-    ts_filter = {"server_timestamp": {"$gte": start, "$lte": end}}
-
-    # Geo from events (enriched)
-    country_pipeline = [
-        {"$match": {**ts_filter, "geo.country": {"$exists": True, "$ne": "Unknown"}}},
-        {"$group": {"_id": "$geo.country", "events": {"$sum": 1}, "sessions": {"$addToSet": "$session_id"}}},
-        {"$sort": {"events": -1}},
-        {"$limit": 20}
-    ]
-    country_result = await db.events.aggregate(country_pipeline).to_list(20)
-
-    # City breakdown
-    city_pipeline = [
-        {"$match": {**ts_filter, "geo.city": {"$exists": True, "$ne": ""}}},
-        {"$group": {"_id": {"city": "$geo.city", "region": "$geo.region", "country": "$geo.country"}, "events": {"$sum": 1}, "sessions": {"$addToSet": "$session_id"}}},
-        {"$sort": {"events": -1}},
-        {"$limit": 20}
-    ]
-    city_result = await db.events.aggregate(city_pipeline).to_list(20)
-
-    # Timezone breakdown
-    tz_pipeline = [
-        {"$match": {**ts_filter, "geo.timezone": {"$exists": True, "$ne": ""}}},
-        {"$group": {"_id": "$geo.timezone", "events": {"$sum": 1}}},
-        {"$sort": {"events": -1}},
-        {"$limit": 15}
-    ]
-    tz_result = await db.events.aggregate(tz_pipeline).to_list(15)
 
     # Geo from leads (attribution IP-based)
     lead_geo_pipeline = [
@@ -537,22 +526,37 @@ async def analytics_geo(
         {"$sort": {"leads": -1}},
         {"$limit": 15}
     ]
-    lead_geo_result = await db.leads.aggregate(lead_geo_pipeline).to_list(15)
+
+    q = await fan_out({
+        "countries": distinct_counts(start, end, ["country"], {"country": {"$nin": [None, "Unknown"]}}, exact=exact),
+        "cities": distinct_counts(start, end, ["city", "region", "country"], {"city": {"$nin": [None, ""]}}, exact=exact),
+        "timezones": rollup_counts(start, end, ["timezone"], {"timezone": {"$nin": [None, ""]}}),
+        "lead_geo": db.leads.aggregate(lead_geo_pipeline).to_list(15),
+    }, response)
+    lead_geo_result = q["lead_geo"]
+    country_result = sorted(q["countries"], key=lambda r: -r["count"])[:20]
+    city_result = sorted(q["cities"], key=lambda r: -r["count"])[:20]
+
+    # Timezone breakdown
+    tz_result = sorted(q["timezones"], key=lambda r: -r["count"])[:15]
 
     return {
-        "countries": [{"country": c["_id"], "events": c["events"], "sessions": len(c["sessions"])} for c in country_result],
-        "cities": [{"city": c["_id"]["city"], "region": c["_id"]["region"], "country": c["_id"]["country"], "events": c["events"], "sessions": len(c["sessions"])} for c in city_result],
-        "timezones": [{"timezone": t["_id"], "events": t["events"]} for t in tz_result],
+        "countries": [{"country": c["country"], "events": c["count"], "sessions": c["sessions"]} for c in country_result],
+        "cities": [{"city": c["city"], "region": c["region"], "country": c["country"], "events": c["count"], "sessions": c["sessions"]} for c in city_result],
+        "timezones": [{"timezone": t["timezone"], "events": t["count"]} for t in tz_result],
         "lead_geo": [{"country": lg["_id"], "leads": lg["leads"]} for lg in lead_geo_result],
     }
 
 @router.get("/analytics/sources")
 async def analytics_sources(
+    response: Optional[Response] = Depends(server_timing),
     admin=Depends(require_admin),
     days: int = Query(30),
     date_from: Optional[str] = None,
     date_to: Optional[str] = None,
 ):
+    from event_rollups import rollup_counts
+    from query_fanout import fan_out
     start, end = build_date_filter(days, date_from, date_to)
     lead_filter = {"created_at": {"$gte": start, "$lte": end}}
 
@@ -568,7 +572,6 @@ async def analytics_sources(
         {"$sort": {"count": -1}},
         {"$limit": 20}
     ]
-    source_result = await db.leads.aggregate(source_pipeline).to_list(20)
 
     # Campaign breakdown
     campaign_pipeline = [
@@ -581,131 +584,100 @@ async def analytics_sources(
         {"$sort": {"count": -1}},
         {"$limit": 15}
     ]
-    campaign_result = await db.leads.aggregate(campaign_pipeline).to_list(15)
 
-    # Referrer breakdown from events
-    ts_filter = {"server_timestamp": {"$gte": start, "$lte": end}}
-    referrer_pipeline = [
-        {"$match": {**ts_filter, "attribution.referrer_url": {"$exists": True, "$ne": ""}}},
-        {"$group": {"_id": "$attribution.referrer_url", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-        {"$limit": 10}
-    ]
-    referrer_result = await db.events.aggregate(referrer_pipeline).to_list(10)
+    q = await fan_out({
+        "sources": db.leads.aggregate(source_pipeline).to_list(20),
+        "campaigns": db.leads.aggregate(campaign_pipeline).to_list(15),
+        "referrers": rollup_counts(start, end, ["referrer"], {"referrer": {"$nin": [None, ""]}}),
+        "landing_pages": rollup_counts(start, end, ["landing"], {"event_name": "tlj_session_start", "landing": {"$nin": [None, ""]}}),
+    }, response)
+    source_result, campaign_result = q["sources"], q["campaigns"]
 
-    # Landing page breakdown from events
-    landing_pipeline = [
-        {"$match": {**ts_filter, "event_name": "tlj_session_start", "attribution.landing_url": {"$exists": True, "$ne": ""}}},
-        {"$group": {"_id": "$attribution.landing_url", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-        {"$limit": 10}
-    ]
-    landing_result = await db.events.aggregate(landing_pipeline).to_list(10)
+    # Referrer / landing page breakdown from events
+    referrer_result = sorted(q["referrers"], key=lambda r: -r["count"])[:10]
+    landing_result = sorted(q["landing_pages"], key=lambda r: -r["count"])[:10]
 
     return {
         "sources": [{"source": s["_id"]["source"], "medium": s["_id"]["medium"], "count": s["count"], "avg_score": round(s["avg_score"], 1), "high_intent": s["high_intent"]} for s in source_result],
         "campaigns": [{"campaign": c["_id"], "count": c["count"], "avg_score": round(c["avg_score"], 1)} for c in campaign_result],
-        "referrers": [{"url": r["_id"], "count": r["count"]} for r in referrer_result],
-        "landing_pages": [{"url": lp["_id"], "count": lp["count"]} for lp in landing_result],
+        "referrers": [{"url": r["referrer"], "count": r["count"]} for r in referrer_result],
+        "landing_pages": [{"url": lp["landing"], "count": lp["count"]} for lp in landing_result],
     }
 
 @router.get("/analytics/devices")
 async def analytics_devices(
+    response: Optional[Response] = Depends(server_timing),
     admin=Depends(require_admin),
     days: int = Query(30),
     date_from: Optional[str] = None,
     date_to: Optional[str] = None,
+    exact: bool = Query(False),
 ):
+    from event_rollups import rollup_counts, distinct_counts
+    from query_fanout import fan_out
     start, end = build_date_filter(days, date_from, date_to)
-    ts_filter = {"server_timestamp": {"$gte": start, "$lte": end}}
 
-    # Device type from enriched events
-    device_pipeline = [
-        {"$match": {**ts_filter, "ua_parsed.device": {"$exists": True}}},
-        {"$group": {"_id": "$ua_parsed.device", "events": {"$sum": 1}, "sessions": {"$addToSet": "$session_id"}}},
-        {"$sort": {"events": -1}}
-    ]
-    device_result = await db.events.aggregate(device_pipeline).to_list(10)
-
-    # Browser breakdown
-    browser_pipeline = [
-        {"$match": {**ts_filter, "ua_parsed.browser": {"$exists": True}}},
-        {"$group": {"_id": "$ua_parsed.browser", "events": {"$sum": 1}, "sessions": {"$addToSet": "$session_id"}}},
-        {"$sort": {"events": -1}},
-        {"$limit": 10}
-    ]
-    browser_result = await db.events.aggregate(browser_pipeline).to_list(10)
-
-    # OS breakdown
-    os_pipeline = [
-        {"$match": {**ts_filter, "ua_parsed.os": {"$exists": True}}},
-        {"$group": {"_id": "$ua_parsed.os", "events": {"$sum": 1}, "sessions": {"$addToSet": "$session_id"}}},
-        {"$sort": {"events": -1}},
-        {"$limit": 10}
-    ]
-    os_result = await db.events.aggregate(os_pipeline).to_list(10)
+    q = await fan_out({
+        "devices": distinct_counts(start, end, ["device"], {"device": {"$ne": None}}, exact=exact),
+        "browsers": distinct_counts(start, end, ["browser"], {"browser": {"$ne": None}}, exact=exact),
+        "os": distinct_counts(start, end, ["os"], {"os": {"$ne": None}}, exact=exact),
+        "viewports": rollup_counts(start, end, ["viewport"], {"viewport": {"$nin": [None, ""]}}),
+    }, response)
+    device_result = sorted(q["devices"], key=lambda r: -r["count"])[:10]
+    browser_result = sorted(q["browsers"], key=lambda r: -r["count"])[:10]
+    os_result = sorted(q["os"], key=lambda r: -r["count"])[:10]
 
     # Viewport breakdown
-    viewport_pipeline = [
-        {"$match": {**ts_filter, "viewport": {"$exists": True, "$ne": ""}}},
-        {"$group": {"_id": "$viewport", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-        {"$limit": 10}
-    ]
-    viewport_result = await db.events.aggregate(viewport_pipeline).to_list(10)
+    viewport_result = sorted(q["viewports"], key=lambda r: -r["count"])[:10]
 
     return {
-        "devices": [{"device": d["_id"] or "unknown", "events": d["events"], "sessions": len(d["sessions"])} for d in device_result],
-        "browsers": [{"browser": b["_id"] or "unknown", "events": b["events"], "sessions": len(b["sessions"])} for b in browser_result],
-        "os": [{"os": o["_id"] or "unknown", "events": o["events"], "sessions": len(o["sessions"])} for o in os_result],
-        "viewports": [{"viewport": v["_id"], "count": v["count"]} for v in viewport_result],
+        "devices": [{"device": d["device"] or "unknown", "events": d["count"], "sessions": d["sessions"]} for d in device_result],
+        "browsers": [{"browser": b["browser"] or "unknown", "events": b["count"], "sessions": b["sessions"]} for b in browser_result],
+        "os": [{"os": o["os"] or "unknown", "events": o["count"], "sessions": o["sessions"]} for o in os_result],
+        "viewports": [{"viewport": v["viewport"], "count": v["count"]} for v in viewport_result],
     }
 
 @router.get("/analytics/visitors")
 async def analytics_visitors(
+    response: Optional[Response] = Depends(server_timing),
     admin=Depends(require_admin),
     days: int = Query(30),
     date_from: Optional[str] = None,
     date_to: Optional[str] = None,
+    exact: bool = Query(False),
 ):
+    from event_rollups import distinct_counts
+    from query_fanout import fan_out
     start, end = build_date_filter(days, date_from, date_to)
     ts_filter = {"server_timestamp": {"$gte": start, "$lte": end}}
 
-    # New vs returning from events
-    visitor_pipeline = [
-        {"$match": {**ts_filter, "visitor_type": {"$exists": True, "$ne": "unknown"}}},
-        {"$group": {"_id": "$visitor_type", "count": {"$sum": 1}, "sessions": {"$addToSet": "$session_id"}}},
-    ]
-    visitor_result = await db.events.aggregate(visitor_pipeline).to_list(10)
-    visitor_types = {v["_id"]: {"events": v["count"], "sessions": len(v["sessions"])} for v in visitor_result}
-
-    # Unique visitors over time
-    unique_pipeline = [
-        {"$match": {**ts_filter, "event_name": "tlj_session_start"}},
-        {"$group": {
-            "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$server_timestamp"}},
-            "unique_visitors": {"$addToSet": "$anonymous_id"},
-            "total_sessions": {"$sum": 1}
-        }},
-        {"$sort": {"_id": 1}}
-    ]
-    unique_result = await db.events.aggregate(unique_pipeline).to_list(100)
-
     # Session depth (events per session)
     depth_pipeline = [
         {"$match": ts_filter},
         {"$group": {"_id": "$session_id", "event_count": {"$sum": 1}}},
         {"$bucket": {"groupBy": "$event_count", "boundaries": [1, 3, 6, 10, 20, 100], "default": "100+", "output": {"count": {"$sum": 1}}}}
     ]
-    try:
-        depth_result = await db.events.aggregate(depth_pipeline).to_list(10)
-        session_depth = [{"range": f"{d['_id']}-{d['_id']+2}" if isinstance(d['_id'], int) else str(d['_id']), "count": d["count"]} for d in depth_result]
-    except Exception:
-        session_depth = []
+
+    async def session_depth_buckets():
+        try:
+            depth_result = await db.events.aggregate(depth_pipeline).to_list(10)
+            return [{"range": f"{d['_id']}-{d['_id']+2}" if isinstance(d['_id'], int) else str(d['_id']), "count": d["count"]} for d in depth_result]
+        except Exception:
+            return []
+
+    q = await fan_out({
+        # New vs returning, and unique visitors per day (HLL sketches)
+        "visitor_types": distinct_counts(start, end, ["visitor_type"], {"visitor_type": {"$nin": [None, "unknown"]}}, exact=exact),
+        "daily_visitors": distinct_counts(start, end, ["event_name", "date"], {"event_name": "tlj_session_start"}, exact=exact),
+        "session_depth": session_depth_buckets(),
+    }, response)
+    visitor_types = {v["visitor_type"]: {"events": v["count"], "sessions": v["sessions"]} for v in q["visitor_types"]}
+    unique_result = sorted(q["daily_visitors"], key=lambda u: u["date"])[:100]
+    session_depth = q["session_depth"]
 
     return {
         "visitor_types": visitor_types,
-        "daily_visitors": [{"date": u["_id"], "unique": len(u["unique_visitors"]), "sessions": u["total_sessions"]} for u in unique_result],
+        "daily_visitors": [{"date": u["date"], "unique": u["visitors"], "sessions": u["count"]} for u in unique_result],
         "session_depth": session_depth,
     }
 
@@ -720,29 +692,20 @@ async def analytics_events_health(admin=Depends(require_admin)):
         "tlj_field_focus", "tlj_field_error",
         "tlj_file_upload_start", "tlj_file_upload_success", "tlj_file_upload_fail",
     ]
+    from event_stats import event_health
     now = datetime.now(timezone.utc)
     stale_threshold = now - timedelta(hours=24)
-    last_7d = now - timedelta(days=7)
+    stats = await event_health(critical_events)
 
     results = []
     for name in critical_events:
-        last = await db.events.find_one({"event_name": name}, sort=[("server_timestamp", -1)])
-        total = await db.events.count_documents({"event_name": name})
-        last_7d_count = await db.events.count_documents({"event_name": name, "server_timestamp": {"$gte": last_7d}})
-        
-        last_seen = None
-        is_stale = True
-        if last and "server_timestamp" in last:
-            ts = last["server_timestamp"]
-            if isinstance(ts, datetime):
-                # Ensure timezone-aware comparison
-                if ts.tzinfo is None:
-                    ts = ts.replace(tzinfo=timezone.utc)
-                last_seen = ts.isoformat()
-                is_stale = ts < stale_threshold
-            else:
-                last_seen = str(ts)
-        
+        stat = stats.get(name, {})
+        total = stat.get("total", 0)
+        last_7d_count = stat.get("last_7d", 0)
+        ts = stat.get("last_seen")
+        last_seen = ts.isoformat() if ts else None
+        is_stale = ts < stale_threshold if ts else True
+
         results.append({
             "event": name,
             "total_count": total,
@@ -754,6 +717,14 @@ async def analytics_events_health(admin=Depends(require_admin)):
 
     return {"events": results, "checked_at": now.isoformat()}
 
+@router.get("/storage/metrics")
+async def storage_metrics_endpoint(admin=Depends(require_admin)):
+    """Object-storage backend, pool size, per-operation latency, media cache and in-process caches."""
+    from storage import storage_metrics
+    from media_cache import cache_stats
+    from ttl_cache import all_cache_stats
+    return {**storage_metrics(), "media_cache": cache_stats(), "caches": all_cache_stats()}
+
 @router.get("/analytics/lead-ops")
 async def analytics_lead_ops(admin=Depends(require_admin)):
     """Lead operations: aging, uncontacted, priority queue."""
@@ -814,63 +785,60 @@ async def analytics_lead_ops(admin=Depends(require_admin)):
 
 @router.get("/analytics/smart-insights")
 async def analytics_smart_insights(
+    response: Optional[Response] = Depends(server_timing),
     admin=Depends(require_admin),
     days: int = Query(30),
 ):
     """Rules-based smart insights for founders."""
-    start = datetime.now(timezone.utc) - timedelta(days=days)
-    ts_filter = {"server_timestamp": {"$gte": start}}
+    from event_rollups import rollup_counts, avg_step_time_ms
+    from query_fanout import fan_out
+    now = datetime.now(timezone.utc)
+    start = now - timedelta(days=days)
     lead_filter = {"created_at": {"$gte": start}}
     insights = []
 
-    # 1. Top drop-off step
-    drop_pipeline = [
-        {"$match": {**ts_filter, "event_name": "tlj_step_abandon"}},
-        {"$group": {"_id": "$wizard_step", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
+    best_source_pipeline = [
+        {"$match": {**lead_filter, "lead_score": {"$exists": True}}},
+        {"$group": {"_id": {"$ifNull": ["$attribution.utm_source", "direct"]}, "avg_score": {"$avg": "$lead_score"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gte": 2}}},
+        {"$sort": {"avg_score": -1}},
         {"$limit": 1}
     ]
-    drop_result = await db.events.aggregate(drop_pipeline).to_list(1)
+    q = await fan_out({
+        "steps": rollup_counts(start, now, ["wizard_step", "event_name"], {"event_name": {"$in": ["tlj_step_abandon", "tlj_step_complete"]}}),
+        "best_source": db.leads.aggregate(best_source_pipeline).to_list(1),
+        "device_completion": rollup_counts(start, now, ["device", "event_name"], {"event_name": {"$in": ["tlj_wizard_start", "tlj_lead_created"]}, "device": {"$ne": None}}),
+        "uncontacted": db.leads.count_documents({"status": "new", "created_at": {"$lte": now - timedelta(hours=12)}}),
+        "lead_hours": rollup_counts(start, now, ["hour"], {"event_name": "tlj_lead_created"}),
+    }, response)
+
+    # 1. Top drop-off step
+    drop_result = [r for r in q["steps"] if r["event_name"] == "tlj_step_abandon"]
     if drop_result:
-        insights.append({"type": "warning", "category": "funnel", "title": "Top Drop-off Step", "message": f"'{drop_result[0]['_id']}' has the most abandons ({drop_result[0]['count']}) in the last {days} days.", "metric": drop_result[0]["count"]})
+        top = max(drop_result, key=lambda r: r["count"])
+        insights.append({"type": "warning", "category": "funnel", "title": "Top Drop-off Step", "message": f"'{top['wizard_step']}' has the most abandons ({top['count']}) in the last {days} days.", "metric": top["count"]})
 
     # 2. Slowest step
-    slow_pipeline = [
-        {"$match": {**ts_filter, "event_name": "tlj_step_complete", "step_time_ms": {"$exists": True, "$gt": 0}}},
-        {"$group": {"_id": "$wizard_step", "avg_ms": {"$avg": "$step_time_ms"}}},
-        {"$sort": {"avg_ms": -1}},
-        {"$limit": 1}
-    ]
-    slow_result = await db.events.aggregate(slow_pipeline).to_list(1)
+    slow_result = [r for r in q["steps"] if r["event_name"] == "tlj_step_complete" and r["st_n"]]
     if slow_result:
-        secs = round(slow_result[0]["avg_ms"] / 1000, 1)
-        insights.append({"type": "info", "category": "friction", "title": "Slowest Step", "message": f"'{slow_result[0]['_id']}' takes an average of {secs}s to complete.", "metric": secs})
+        slowest = max(slow_result, key=avg_step_time_ms)
+        secs = round(avg_step_time_ms(slowest) / 1000, 1)
+        insights.append({"type": "info", "category": "friction", "title": "Slowest Step", "message": f"'{slowest['wizard_step']}' takes an average of {secs}s to complete.", "metric": secs})
 
     # 3. Best source by quality
-    best_source_pipeline = [
-        {"$match": {**lead_filter, "lead_score": {"$exists": True}}},
-        {"$group": {"_id": {"$ifNull": ["$attribution.utm_source", "direct"]}, "avg_score": {"$avg": "$lead_score"}, "count": {"$sum": 1}}},
-        {"$match": {"count": {"$gte": 2}}},
-        {"$sort": {"avg_score": -1}},
-        {"$limit": 1}
-    ]
-    best_source = await db.leads.aggregate(best_source_pipeline).to_list(1)
+    best_source = q["best_source"]
     if best_source:
         insights.append({"type": "success", "category": "attribution", "title": "Best Quality Source", "message": f"'{best_source[0]['_id']}' produces the highest quality leads (avg score: {round(best_source[0]['avg_score'], 1)}, {best_source[0]['count']} leads).", "metric": round(best_source[0]["avg_score"], 1)})
 
     # 4. Device with worst completion
-    device_completion_pipeline = [
-        {"$match": {**ts_filter, "event_name": {"$in": ["tlj_wizard_start", "tlj_lead_created"]}, "ua_parsed.device": {"$exists": True}}},
-        {"$group": {"_id": {"device": "$ua_parsed.device", "event": "$event_name"}, "count": {"$sum": 1}}}
-    ]
-    device_comp = await db.events.aggregate(device_completion_pipeline).to_list(20)
+    device_comp = q["device_completion"]
     device_starts = {}
     device_completes = {}
     for dc in device_comp:
-        dev = dc["_id"]["device"]
-        if dc["_id"]["event"] == "tlj_wizard_start":
+        dev = dc["device"]
+        if dc["event_name"] == "tlj_wizard_start":
             device_starts[dev] = dc["count"]
-        elif dc["_id"]["event"] == "tlj_lead_created":
+        elif dc["event_name"] == "tlj_lead_created":
             device_completes[dev] = dc["count"]
     worst_device = None
     worst_rate = 100
@@ -885,21 +853,18 @@ async def analytics_smart_insights(
         insights.append({"type": "warning", "category": "device", "title": "Worst Device Completion", "message": f"'{worst_device}' has the lowest completion rate ({worst_rate}%).", "metric": worst_rate})
 
     # 5. Uncontacted leads alert
-    uncontacted = await db.leads.count_documents({"status": "new", "created_at": {"$lte": datetime.now(timezone.utc) - timedelta(hours=12)}})
+    uncontacted = q["uncontacted"]
     if uncontacted > 0:
         insights.append({"type": "critical", "category": "ops", "title": "Uncontacted Leads", "message": f"{uncontacted} leads have been waiting 12+ hours without contact.", "metric": uncontacted})
 
     # 6. Best hour for high-intent
-    hour_pipeline = [
-        {"$match": {**ts_filter, "event_name": "tlj_lead_created"}},
-        {"$group": {"_id": {"$hour": "$server_timestamp"}, "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-        {"$limit": 1}
-    ]
-    hour_result = await db.events.aggregate(hour_pipeline).to_list(1)
-    if hour_result:
-        h = hour_result[0]["_id"]
-        insights.append({"type": "info", "category": "trends", "title": "Peak Lead Hour", "message": f"{h}:00 UTC is when most leads submit ({hour_result[0]['count']} in {days}d).", "metric": hour_result[0]["count"]})
+    by_hour = {}
+    for r in q["lead_hours"]:
+        h = int(r["hour"][-2:])
+        by_hour[h] = by_hour.get(h, 0) + r["count"]
+    if by_hour:
+        h = max(by_hour, key=by_hour.get)
+        insights.append({"type": "info", "category": "trends", "title": "Peak Lead Hour", "message": f"{h}:00 UTC is when most leads submit ({by_hour[h]} in {days}d).", "metric": by_hour[h]})
 
     return {"insights": insights, "period_days": days}
 
@@ -926,7 +891,7 @@ async def analytics_campaigns(admin=Depends(require_admin), days: int = Query(30
 # ── Lead CRM ─────────────────────────────────────────────────
 
 @router.get("/leads")
-async def get_leads(admin=Depends(require_admin), page: int = Query(1, ge=1), limit: int = Query(25, le=100), status: Optional[str] = None, product_type: Optional[str] = None, budget: Optional[str] = None, source: Optional[str] = None, search: Optional[str] = None, date_from: Optional[str] = None, date_to: Optional[str] = None):
+async def get_leads(admin=Depends(require_admin), cursor: Optional[str] = None, page: Optional[int] = Query(None, ge=1), limit: int = Query(25, ge=1, le=100), total: str = Query("estimate"), status: Optional[str] = None, product_type: Optional[str] = None, budget: Optional[str] = None, source: Optional[str] = None, search: Optional[str] = None, date_from: Optional[str] = None, date_to: Optional[str] = None):
     query = {}
     if status:
         query["status"] = status
@@ -937,7 +902,10 @@ async def get_leads(admin=Depends(require_admin), page: int = Query(1, ge=1), li
     if source:
         query["attribution.utm_source"] = source
     if search:
-        query["$or"] = [{"first_name": {"$regex": search, "$options": "i"}}, {"email": {"$regex": search, "$options": "i"}}, {"phone": {"$regex": search, "$options": "i"}}, {"lead_id": {"$regex": search, "$options": "i"}}]
+        from search_index import matching_refs
+        refs = await matching_refs("lead", search)
+        if refs is not None:
+            query["lead_id"] = {"$in": refs}
     if date_from:
         try:
             query["created_at"] = {"$gte": datetime.fromisoformat(date_from.replace("Z", "+00:00"))}
@@ -952,40 +920,57 @@ async def get_leads(admin=Depends(require_admin), page: int = Query(1, ge=1), li
         if dt_to:
             query["created_at"] = dt_to
 
-    total = await db.leads.count_documents(query)
-    skip = (page - 1) * limit
-    cursor = db.leads.find(query).sort("created_at", -1).skip(skip).limit(limit)
-    leads = [serialize_doc(doc) async for doc in cursor]
-    return {"leads": leads, "total": total, "page": page, "limit": limit, "pages": (total + limit - 1) // limit if limit > 0 else 0}
+    from pagination import keyset_page
+    result = await keyset_page(db.leads, query, "created_at", "lead_id", limit, cursor, total=total, page=page)
+    leads = [serialize_doc(doc) for doc in result.pop("items")]
+    return {"leads": leads, "limit": limit, **result}
 
 @router.get("/leads/export.csv")
 async def export_leads_csv(admin=Depends(require_admin), status: Optional[str] = None, date_from: Optional[str] = None, date_to: Optional[str] = None):
-    query = {}
+    from exporter import EXPORT_DATASETS, export_response
+    query = _export_query("created_at", date_from, date_to)
     if status:
         query["status"] = status
+    return export_response("leads", query, EXPORT_DATASETS["leads"]["fields"], limit=50000, filename=f"leads_export_{datetime.now().strftime('%Y%m%d')}.csv")
+
+def _export_query(time_field: str, date_from: Optional[str], date_to: Optional[str]) -> dict:
+    query = {}
     if date_from:
         try:
-            query.setdefault("created_at", {})["$gte"] = datetime.fromisoformat(date_from.replace("Z", "+00:00"))
+            query.setdefault(time_field, {})["$gte"] = datetime.fromisoformat(date_from.replace("Z", "+00:00"))
         except Exception:
             pass
     if date_to:
         try:
-            query.setdefault("created_at", {})["$lte"] = datetime.fromisoformat(date_to.replace("Z", "+00:00"))
+            query.setdefault(time_field, {})["$lte"] = datetime.fromisoformat(date_to.replace("Z", "+00:00"))
         except Exception:
             pass
+    return query
 
-    cursor = db.leads.find(query).sort("created_at", -1).limit(50000)
-    fields = ["lead_id", "first_name", "phone", "email", "product_type", "diamond_shape", "carat_range", "priority", "metal", "budget", "status", "created_at", "notes"]
-
-    output = io.StringIO()
-    writer = csv.DictWriter(output, fieldnames=fields, extrasaction="ignore")
-    writer.writeheader()
-    async for doc in cursor:
-        row = serialize_doc(doc)
-        writer.writerow({f: row.get(f, "") for f in fields})
-
-    output.seek(0)
-    return StreamingResponse(iter([output.getvalue()]), media_type="text/csv", headers={"Content-Disposition": f"attachment; filename=leads_export_{datetime.now().strftime('%Y%m%d')}.csv"})
+@router.get("/export/{dataset}")
+async def export_dataset(
+    dataset: str,
+    request: Request,
+    admin=Depends(require_admin),
+    format: str = Query("csv"),
+    gzip: bool = False,
+    fields: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    limit: int = Query(0, ge=0),
+):
+    """Stream leads / shop_orders / events / message_threads as CSV or JSONL.
+    `fields` is a comma-separated column list (dotted paths allowed); any of
+    the dataset's filter keys can be passed as query params."""
+    from exporter import EXPORT_DATASETS, export_response, parse_fields
+    spec = EXPORT_DATASETS.get(dataset)
+    if not spec:
+        raise HTTPException(status_code=404, detail="Unknown export dataset")
+    query = _export_query(spec["time_field"], date_from, date_to)
+    for key in spec["filters"]:
+        if request.query_params.get(key):
+            query[key] = request.query_params[key]
+    return export_response(dataset, query, parse_fields(fields, spec["fields"]), fmt=format, compress=gzip, limit=limit)
 
 @router.get("/leads/{lead_id}")
 async def get_lead_detail(lead_id: str, admin=Depends(require_admin)):
@@ -1112,15 +1097,14 @@ async def create_order(req: OrderCreate, admin=Depends(require_admin)):
     return serialize_doc(order)
 
 @router.get("/orders")
-async def get_orders(admin=Depends(require_admin), page: int = Query(1, ge=1), limit: int = Query(25, le=100), status: Optional[str] = None):
+async def get_orders(admin=Depends(require_admin), cursor: Optional[str] = None, page: Optional[int] = Query(None, ge=1), limit: int = Query(25, ge=1, le=100), total: str = Query("estimate"), status: Optional[str] = None):
+    from pagination import keyset_page
     query = {}
     if status:
         query["status"] = status
-    total = await db.orders.count_documents(query)
-    skip = (page - 1) * limit
-    cursor = db.orders.find(query).sort("created_at", -1).skip(skip).limit(limit)
-    orders = [serialize_doc(o) async for o in cursor]
-    return {"orders": orders, "total": total, "page": page, "limit": limit}
+    result = await keyset_page(db.orders, query, "created_at", "order_id", limit, cursor, total=total, page=page)
+    orders = [serialize_doc(o) for o in result.pop("items")]
+    return {"orders": orders, "limit": limit, **result}
 
 @router.get("/orders/{order_id}")
 async def get_order(order_id: str, admin=Depends(require_admin)):
@@ -1175,6 +1159,9 @@ SETTINGS_EXTRA_DEFAULTS = {
 }
 
 async def get_settings_doc():
+    return await cached("site_settings", _load_settings_doc)
+
+async def _load_settings_doc():
     doc = await db.settings.find_one({"_type": "site_settings"})
     if not doc:
         doc = {"_type": "site_settings", "phone_number": "+15857108292", "whatsapp_link": "https://wa.me/15857108292", "live_chat_enabled": False, "gia_logo_visible": True, "igi_logo_visible": True, "reviews_count": "70+", "customers_count": "100+", "avg_savings": "$5,000", "email_notify_new_lead": True, "email_notify_quote": True}
@@ -1194,6 +1181,7 @@ async def update_settings(req: SettingsUpdate, admin=Depends(require_admin)):
     update = {k: v for k, v in req.dict(exclude_none=True).items()}
     if update:
         await db.settings.update_one({"_type": "site_settings"}, {"$set": update})
+        await bump_settings_version()
     doc = await get_settings_doc()
     return serialize_doc(doc)
 
@@ -1252,17 +1240,21 @@ async def update_tracking(req: TrackingUpdate, admin=Depends(require_admin)):
 @router.get("/tracking/verify")
 async def verify_tracking(admin=Depends(require_admin)):
     event_names = ["tlj_landing_view", "tlj_wizard_start", "tlj_step_view", "tlj_step_complete", "tlj_step_back", "tlj_step_abandon", "tlj_value_reveal_view", "tlj_contact_submit_attempt", "tlj_lead_created", "tlj_file_upload_start", "tlj_file_upload_success", "tlj_file_upload_fail"]
+    from event_stats import event_health
+    stats = await event_health(event_names)
     verification = []
     for name in event_names:
-        last = await db.events.find_one({"event_name": name}, sort=[("server_timestamp", -1)])
-        count = await db.events.count_documents({"event_name": name})
-        verification.append({"event": name, "total_count": count, "last_seen": last["server_timestamp"].isoformat() if last and "server_timestamp" in last and isinstance(last["server_timestamp"], datetime) else (str(last.get("server_timestamp", "never")) if last else "never")})
+        stat = stats.get(name, {})
+        verification.append({"event": name, "total_count": stat.get("total", 0), "last_seen": stat["last_seen"].isoformat() if stat.get("last_seen") else "never"})
     return {"events": verification}
 
 
 # ── A/B Test Management ─────────────────────────────────────────
 
 async def get_abtest_doc():
+    return await cached("abtest_settings", _load_abtest_doc)
+
+async def _load_abtest_doc():
     doc = await db.settings.find_one({"_type": "abtest_settings"})
     if not doc:
         doc = {"_type": "abtest_settings", "lead_capture_mode": "auto", "variant_a_weight": 50}
@@ -1284,6 +1276,7 @@ async def update_abtest(req: dict, admin=Depends(require_admin)):
         update["variant_a_weight"] = max(0, min(100, int(req["variant_a_weight"])))
     if update:
         await db.settings.update_one({"_type": "abtest_settings"}, {"$set": update})
+        await bump_settings_version()
     return serialize_doc(await get_abtest_doc())
 
 @router.get("/abtest/results")
@@ -1299,13 +1292,19 @@ async def get_abtest_results(admin=Depends(require_admin)):
     pipeline_b = [{"$match": {"event_name": "tlj_ab_form_completed", "event_data.variant": "B", "event_data.time_to_submit_ms": {"$exists": True}}}, {"$group": {"_id": None, "avg_ms": {"$avg": "$event_data.time_to_submit_ms"}}}]
     avg_a = await db.events.aggregate(pipeline_a).to_list(1)
     avg_b = await db.events.aggregate(pipeline_b).to_list(1)
+    # Time-to-submit percentiles from the timing sketches
+    from timing_sketches import percentiles
+    pct = await percentiles("time_to_submit", keys=["A", "B"])
+
+    def pct_sec(variant):
+        return {f"{p}_time_to_submit_sec": round(pct.get(variant, {}).get(p, 0) / 1000, 1) for p in ("p50", "p90", "p99")}
     
     rate_a = round((variant_a_completed / variant_a_shown) * 100, 1) if variant_a_shown > 0 else 0
     rate_b = round((variant_b_completed / variant_b_shown) * 100, 1) if variant_b_shown > 0 else 0
     
     return {
-        "variant_a": {"shown": variant_a_shown, "completed": variant_a_completed, "conversion_rate": rate_a, "avg_time_to_submit_sec": round(avg_a[0]["avg_ms"] / 1000, 1) if avg_a and avg_a[0].get("avg_ms") else 0},
-        "variant_b": {"shown": variant_b_shown, "completed": variant_b_completed, "conversion_rate": rate_b, "avg_time_to_submit_sec": round(avg_b[0]["avg_ms"] / 1000, 1) if avg_b and avg_b[0].get("avg_ms") else 0},
+        "variant_a": {"shown": variant_a_shown, "completed": variant_a_completed, "conversion_rate": rate_a, "avg_time_to_submit_sec": round(avg_a[0]["avg_ms"] / 1000, 1) if avg_a and avg_a[0].get("avg_ms") else 0, **pct_sec("A")},
+        "variant_b": {"shown": variant_b_shown, "completed": variant_b_completed, "conversion_rate": rate_b, "avg_time_to_submit_sec": round(avg_b[0]["avg_ms"] / 1000, 1) if avg_b and avg_b[0].get("avg_ms") else 0, **pct_sec("B")},
     }
 
 
@@ -1471,6 +1470,8 @@ async def admin_create_project(req: ProjectPayload, admin=Depends(require_admin)
     doc["created_at"] = now
     doc["updated_at"] = now
     await db.projects.insert_one(doc)
+    from product_cards import sync_project_card
+    await sync_project_card(doc["slug"])
     await _seo_refresh(f"/projects/{doc['slug']}", "/", "/collections")
     return _project_public_view({k: v for k, v in doc.items() if k != "_id"})
 
@@ -1498,14 +1499,18 @@ async def admin_update_project(project_id: str, req: ProjectPayload, admin=Depen
     update["updated_at"] = datetime.now(timezone.utc)
     await db.projects.update_one({"project_id": project_id}, {"$set": update})
     doc = await db.projects.find_one({"project_id": project_id}, {"_id": 0})
+    from product_cards import sync_project_card
+    await sync_project_card(doc["slug"], previous_slug=existing.get("slug"))
     await _seo_refresh(f"/projects/{doc['slug']}")
     return _project_public_view(doc)
 
 @router.delete("/projects/{project_id}")
 async def admin_delete_project(project_id: str, admin=Depends(require_admin)):
-    result = await db.projects.delete_one({"project_id": project_id})
-    if result.deleted_count == 0:
+    deleted = await db.projects.find_one_and_delete({"project_id": project_id}, {"slug": 1})
+    if not deleted:
         raise HTTPException(404, "Project not found")
+    from product_cards import remove_project_card
+    await remove_project_card(deleted.get("slug"))
     await _regen_sitemap_safe()
     return {"status": "deleted"}
 
@@ -1784,20 +1789,20 @@ def _thread_public_view(doc: dict) -> dict:
     return out
 
 @router.get("/threads")
-async def admin_list_threads(admin=Depends(require_admin), q: Optional[str] = None, status: Optional[str] = None):
+async def admin_list_threads(admin=Depends(require_admin), q: Optional[str] = None, status: Optional[str] = None,
+                             cursor: Optional[str] = None, limit: int = Query(200, ge=1, le=200), total: str = Query("estimate")):
     query = {}
     if status:
         query["status"] = status
     if q:
-        query["$or"] = [
-            {"user_email": {"$regex": q, "$options": "i"}},
-            {"user_phone": {"$regex": q, "$options": "i"}},
-            {"user_name": {"$regex": q, "$options": "i"}},
-            {"project_title": {"$regex": q, "$options": "i"}},
-        ]
-    cursor = db.message_threads.find(query, {"_id": 0}).sort("updated_at", -1).limit(200)
-    threads = [_thread_public_view(doc) async for doc in cursor]
-    return {"threads": threads, "total": len(threads)}
+        from search_index import matching_refs
+        refs = await matching_refs("thread", q)
+        if refs is not None:
+            query["thread_id"] = {"$in": refs}
+    from pagination import keyset_page
+    page = await keyset_page(db.message_threads, query, "updated_at", "thread_id", limit, cursor, projection={"_id": 0}, total=total)
+    threads = [_thread_public_view(doc) for doc in page.pop("items")]
+    return {"threads": threads, "limit": limit, **page}
 
 @router.get("/threads/{thread_id}")
 async def admin_get_thread(thread_id: str, admin=Depends(require_admin)):
@@ -1830,46 +1835,32 @@ async def admin_reply_thread(thread_id: str, req: ThreadReply, admin=Depends(req
             "$set": {"updated_at": now, "status": "active"},
         }
     )
-    # Best-effort notify customer via email + SMS (non-blocking)
+    # Notify customer via email + SMS through the outbox (never blocks the reply)
     try:
-        from server import sg_client, SENDGRID_FROM_EMAIL, twilio_client, TWILIO_PHONE
-        from sendgrid.helpers.mail import Mail as SGMail
+        from outbox import enqueue_email, enqueue_sms
         proj_title = thread.get("project_title", "your inquiry")
-        if sg_client and thread.get("user_email"):
-            try:
-                em = SGMail(
-                    from_email=SENDGRID_FROM_EMAIL,
-                    to_emails=thread["user_email"],
-                    subject=f"The Local Jewel replied about {proj_title}",
-                    html_content=f"""
-                    <div style='font-family: -apple-system, sans-serif; max-width: 520px; margin: 0 auto; padding: 28px 20px;'>
-                        <h2 style='color:#0F5E4C; font-size:20px; margin:0 0 14px;'>You have a new message</h2>
-                        <p style='font-size:14px; color:#374151; margin:0 0 14px;'>Re: <strong>{proj_title}</strong></p>
-                        <div style='padding:14px 16px; background:#F5F5F3; border-radius:10px; color:#1A1A1C; font-size:14px; line-height:1.5;'>{text}</div>
-                        <p style='font-size:13px; color:#6B7280; margin-top:18px;'>
-                            Reply by visiting your <a href='https://thelocaljewel.com/dashboard' style='color:#0F5E4C;'>dashboard</a>.
-                        </p>
-                    </div>
-                    """,
-                )
-                sg_client.send(em)
-            except Exception as e:
-                import logging
-                logging.getLogger(__name__).warning(f"thread email failed: {e}")
-        if twilio_client and thread.get("user_phone") and TWILIO_PHONE:
-            try:
-                sms_preview = text[:120] + ("..." if len(text) > 120 else "")
-                twilio_client.messages.create(
-                    body=f"The Local Jewel replied: {sms_preview}\nView at thelocaljewel.com/dashboard",
-                    from_=TWILIO_PHONE,
-                    to=thread["user_phone"],
-                )
-            except Exception as e:
-                import logging
-                logging.getLogger(__name__).warning(f"thread SMS failed: {e}")
+        if thread.get("user_email"):
+            await enqueue_email(
+                thread["user_email"],
+                subject=f"The Local Jewel replied about {proj_title}",
+                html=f"""
+                <div style='font-family: -apple-system, sans-serif; max-width: 520px; margin: 0 auto; padding: 28px 20px;'>
+                    <h2 style='color:#0F5E4C; font-size:20px; margin:0 0 14px;'>You have a new message</h2>
+                    <p style='font-size:14px; color:#374151; margin:0 0 14px;'>Re: <strong>{proj_title}</strong></p>
+                    <div style='padding:14px 16px; background:#F5F5F3; border-radius:10px; color:#1A1A1C; font-size:14px; line-height:1.5;'>{text}</div>
+                    <p style='font-size:13px; color:#6B7280; margin-top:18px;'>
+                        Reply by visiting your <a href='https://thelocaljewel.com/dashboard' style='color:#0F5E4C;'>dashboard</a>.
+                    </p>
+                </div>
+                """,
+                kind="thread_reply",
+            )
+        if thread.get("user_phone"):
+            sms_preview = text[:120] + ("..." if len(text) > 120 else "")
+            await enqueue_sms(thread["user_phone"], f"The Local Jewel replied: {sms_preview}\nView at thelocaljewel.com/dashboard", kind="thread_reply")
     except Exception as e:
         import logging
-        logging.getLogger(__name__).warning(f"thread notify import failed: {e}")
+        logging.getLogger(__name__).warning(f"thread notify enqueue failed: {e}")
     return {"status": "sent", "message": {**msg, "created_at": now.isoformat()}}
 
 @router.patch("/threads/{thread_id}")
@@ -1887,14 +1878,111 @@ async def admin_update_thread(thread_id: str, payload: dict, admin=Depends(requi
 # ── Admin: Contact form submissions ───────────────────────────
 
 @router.get("/contact-submissions")
-async def admin_list_contact_submissions(admin=Depends(require_admin)):
-    cursor = db.contact_submissions.find({}, {"_id": 0}).sort("created_at", -1).limit(200)
+async def admin_list_contact_submissions(admin=Depends(require_admin), cursor: Optional[str] = None,
+                                         limit: int = Query(200, ge=1, le=200), total: str = Query("estimate")):
+    from pagination import keyset_page
+    page = await keyset_page(db.contact_submissions, {}, "created_at", "submission_id", limit, cursor, projection={"_id": 0}, total=total)
     items = []
-    async for doc in cursor:
+    for doc in page.pop("items"):
         out = {k: v for k, v in doc.items()}
         for k, v in out.items():
             if isinstance(v, datetime):
                 out[k] = v.isoformat()
         items.append(out)
-    return {"submissions": items, "total": len(items)}
+    return {"submissions": items, "limit": limit, **page}
+
+
+
+# ── Admin: Outbound message queue (dead letters) ──────────────
+
+@router.get("/outbox")
+async def admin_list_outbox(admin=Depends(require_admin), status: str = Query("dead"), limit: int = Query(100, ge=1, le=500), cursor: Optional[str] = None):
+    """Outbound email/SMS rows by status (default: dead letters), newest first."""
+    from outbox import STATUSES, stats
+    from pagination import keyset_page
+    if status not in STATUSES:
+        raise HTTPException(400, f"status must be one of {', '.join(STATUSES)}")
+    page = await keyset_page(db.outbox, {"status": status}, "updated_at", "message_id", limit, cursor, projection={"_id": 0, "payload.html": 0}, total="none")
+    return {"messages": [serialize_doc(m) for m in page["items"]], "next_cursor": page["next_cursor"], "counts": await stats()}
+
+@router.post("/outbox/{message_id}/retry")
+async def admin_retry_outbox(message_id: str, admin=Depends(require_admin)):
+    from outbox import requeue
+    if not await requeue(message_id):
+        raise HTTPException(404, "No dead or expired message with that id")
+    return {"status": "requeued", "message_id": message_id}
+
+
+# ── Admin: Lead submission pipeline ───────────────────────────
+
+@router.get("/lead-pipeline")
+async def admin_lead_pipeline(admin=Depends(require_admin), limit: int = Query(50, ge=1, le=200)):
+    """Per-stage counts/latency, queue depth and the leads whose stages gave up."""
+    from lead_pipeline import stats
+    failed = await db.leads.find(
+        {"pipeline_failed": True},
+        {"_id": 0, "lead_id": 1, "first_name": 1, "pipeline_pending": 1, "pipeline_error": 1, "updated_at": 1},
+    ).sort("updated_at", -1).limit(limit).to_list(limit)
+    return {**await stats(), "failed_leads": [serialize_doc(ld) for ld in failed]}
 
+@router.post("/lead-pipeline/{lead_id}/retry")
+async def admin_retry_lead_pipeline(lead_id: str, admin=Depends(require_admin)):
+    from lead_pipeline import requeue
+    if not await requeue(lead_id):
+        raise HTTPException(404, "No failed pipeline for that lead")
+    return {"status": "requeued", "lead_id": lead_id}
+
+
+# ── Admin: Lead scoring rules ─────────────────────────────────
+
+@router.get("/lead-scoring")
+async def admin_get_lead_scoring(admin=Depends(require_admin)):
+    from lead_scoring import get_rules
+    return {"rules": serialize_doc(await get_rules())}
+
+@router.put("/lead-scoring")
+async def admin_save_lead_scoring(spec: dict, admin=Depends(require_admin), rescore: bool = Query(True)):
+    """Save a new rule set (validated and compiled first) and, by default, re-score every lead with it."""
+    from lead_scoring import save_rules, rescore_all
+    try:
+        saved = await save_rules(spec)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    return {"rules": serialize_doc(saved), "rescored": await rescore_all() if rescore else None}
+
+@router.post("/lead-scoring/rescore")
+async def admin_rescore_leads(admin=Depends(require_admin)):
+    from lead_scoring import rescore_all
+    return await rescore_all()
+
+
+# ── Admin: Ranked search over leads and threads ───────────────
+
+@router.get("/search")
+async def admin_search(admin=Depends(require_admin), q: str = Query(..., min_length=1), kind: str = Query("all"), limit: int = Query(20, ge=1, le=100)):
+    """Best matches first for the admin search box (names, emails, phones, ids, project titles)."""
+    from search_index import search
+    if kind not in ("all", "lead", "thread"):
+        raise HTTPException(400, "kind must be all, lead or thread")
+    out = {}
+    if kind in ("all", "lead"):
+        hits = await search("lead", q, limit)
+        docs = {
+            d["lead_id"]: d
+            async for d in db.leads.find(
+                {"lead_id": {"$in": [h["ref"] for h in hits]}},
+                {"_id": 0, "lead_id": 1, "first_name": 1, "email": 1, "phone": 1, "status": 1, "product_type": 1, "created_at": 1},
+            )
+        }
+        out["leads"] = [{**serialize_doc(docs[h["ref"]]), "score": h["score"]} for h in hits if h["ref"] in docs]
+    if kind in ("all", "thread"):
+        hits = await search("thread", q, limit)
+        docs = {
+            d["thread_id"]: d
+            async for d in db.message_threads.find(
+                {"thread_id": {"$in": [h["ref"] for h in hits]}},
+                {"_id": 0, "thread_id": 1, "user_name": 1, "user_email": 1, "user_phone": 1, "project_title": 1, "status": 1, "updated_at": 1},
+            )
+        }
+        out["threads"] = [{**serialize_doc(docs[h["ref"]]), "score": h["score"]} for h in hits if h["ref"] in docs]
+    return out
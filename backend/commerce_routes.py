@@ -11,7 +11,7 @@ import logging
 from datetime import datetime, timezone
 from typing import Optional, List, Dict, Any
 
-from fastapi import APIRouter, HTTPException, Depends, Request
+from fastapi import APIRouter, HTTPException, Depends, Query, Request
 from pydantic import BaseModel, Field
 
 from admin_routes import db, serialize_doc, require_admin
@@ -27,9 +27,12 @@ async def _seo_refresh_safe(*paths: str):
         logging.getLogger(__name__).debug(f"seo refresh failed: {e}")
 from variant_options import (
     METAL_TIERS, CARAT_WEIGHTS, GOLD_COLORS, PRODUCT_TYPES,
-    variant_price, project_from_price, is_buyable, normalize_sale, apply_sale,
-    matrix_tiers, matrix_carats,
+    variant_price, project_from_price, normalize_sale, apply_sale,
+    matrix_tiers, matrix_carats, card_pricing,
 )
+from product_cards import storefront_cards, rebuild_product_cards, collection_product_counts, CARD_SORT
+from settings_cache import cached, bump_settings_version
+from image_derivatives import srcset, sources, original_widths
 
 logger = logging.getLogger(__name__)
 router = APIRouter(tags=["commerce"])
@@ -51,23 +54,36 @@ def _slugify(text: str) -> str:
 
 
 async def _get_sale():
-    """Active site-wide sale (or None) from the settings collection."""
-    doc = await db.settings.find_one({"key": "global_sale"}, {"_id": 0})
+    """Active site-wide sale (or None) from the settings collection.
+    The raw doc is cached; expiry (`ends_at`) is still checked on every call."""
+    doc = await cached("global_sale", lambda: db.settings.find_one({"key": "global_sale"}, {"_id": 0}))
     return normalize_sale(doc)
 
 
-def _project_card(p: dict, sale: Optional[dict]) -> dict:
+def project_image_urls(p: dict) -> List[str]:
+    """Hero + gallery image URLs of a project (for `original_widths`)."""
+    gallery = [g.get("url") for g in p.get("gallery") or [] if g.get("url") and g.get("media_type", "image") != "video"]
+    return [p.get("hero_image_url", "")] + gallery
+
+
+def _project_card(p: dict, sale: Optional[dict], image_widths: Optional[Dict[str, int]] = None) -> dict:
     """Map a Project document into the product-card shape the storefront expects.
 
     Price is the lowest matrix cell ("from"); when a sale is active the sale price
     becomes `price` and the original becomes `compare_at_price` (strike-through).
+    `image_widths` (url -> original width) clamps the srcsets to real sizes.
     """
     base = project_from_price(p)
-    on_sale = bool(sale) and base > 0
-    price = apply_sale(base, sale) if on_sale else base
+    price, compare_at_price, on_sale = card_pricing(base, sale)
+    widths = image_widths or {}
     gallery = p.get("gallery") or []
     images = [
-        {"url": g.get("url"), "alt": g.get("caption", "")}
+        {
+            "url": g.get("url"),
+            "alt": g.get("caption", ""),
+            "srcset": srcset(g.get("url"), width=widths.get(g.get("url"))),
+            "sources": sources(g.get("url"), width=widths.get(g.get("url"))),
+        }
         for g in gallery
         if g.get("url") and g.get("media_type", "image") != "video"
     ]
@@ -92,9 +108,11 @@ def _project_card(p: dict, sale: Optional[dict]) -> dict:
         "title": p.get("title"),
         "subtitle": p.get("subtitle", ""),
         "hero_image_url": p.get("hero_image_url", ""),
+        "hero_srcset": srcset(hero_url, width=widths.get(hero_url)),
+        "hero_sources": sources(hero_url, width=widths.get(hero_url)),
         "images": images,
         "price": price,
-        "compare_at_price": base if on_sale else None,
+        "compare_at_price": compare_at_price,
         "currency": p.get("price_currency", "USD"),
         "on_sale": on_sale,
         "badge": p.get("badge", ""),
@@ -202,6 +220,10 @@ class CheckoutRequest(BaseModel):
     email: Optional[str] = ""
 
 
+class CartQuoteRequest(BaseModel):
+    items: List[CartLine] = []
+
+
 # ---- Default mega-menu (used until an admin customizes it) ----
 
 DEFAULT_MENU = {
@@ -230,7 +252,7 @@ DEFAULT_MENU = {
 
 @router.get("/api/menu")
 async def get_public_menu():
-    doc = await db.menu_config.find_one({"_type": "main_menu"}, {"_id": 0})
+    doc = await cached("main_menu", lambda: db.menu_config.find_one({"_type": "main_menu"}, {"_id": 0}))
     if not doc or not doc.get("items"):
         return DEFAULT_MENU
     return {"items": doc.get("items", [])}
@@ -256,6 +278,7 @@ async def admin_update_menu(req: MenuPayload, admin=Depends(require_admin)):
         {"$set": {"_type": "main_menu", "items": items, "updated_at": _now()}},
         upsert=True,
     )
+    await bump_settings_version()
     return {"items": items}
 
 
@@ -263,17 +286,6 @@ async def admin_update_menu(req: MenuPayload, admin=Depends(require_admin)):
 # PUBLIC: Collections
 # ============================================================
 
-async def _collection_product_count(slug: str) -> int:
-    count = 0
-    async for p in db.projects.find(
-        {"published": True, "collections": slug},
-        {"_id": 0, "price_matrix": 1, "collections": 1, "price": 1},
-    ):
-        if is_buyable(p):
-            count += 1
-    return count
-
-
 @router.get("/api/collections")
 async def get_public_collections(featured: Optional[bool] = None, parent: Optional[str] = None, all: Optional[bool] = None):
     query = {"published": True}
@@ -284,11 +296,12 @@ async def get_public_collections(featured: Optional[bool] = None, parent: Option
     elif not all:
         # default: only top-level collections (no parent)
         query["$or"] = [{"parent_slug": {"$in": ["", None]}}, {"parent_slug": {"$exists": False}}]
-    cursor = db.collections.find(query, {"_id": 0}).sort([("featured", -1), ("position", 1), ("created_at", -1)])
+    docs = await db.collections.find(query, {"_id": 0}).sort([("featured", -1), ("position", 1), ("created_at", -1)]).to_list(1000)
+    counts = await collection_product_counts([d.get("slug", "") for d in docs])
     items = []
-    async for doc in cursor:
+    for doc in docs:
         clean = serialize_doc(doc)
-        clean["product_count"] = await _collection_product_count(doc.get("slug", ""))
+        clean["product_count"] = counts.get(doc.get("slug", ""), 0)
         items.append(clean)
     return {"collections": items, "total": len(items)}
 
@@ -298,21 +311,19 @@ async def get_public_collection(slug: str, sort: Optional[str] = None):
     doc = await db.collections.find_one({"slug": slug, "published": True}, {"_id": 0})
     if not doc:
         raise HTTPException(404, "Collection not found")
-    sale = await _get_sale()
-    pcursor = db.projects.find(
-        {"published": True, "collections": slug}, {"_id": 0}
-    ).sort([("featured", -1), ("position", 1), ("created_at", -1)])
-    cards = [_project_card(p, sale) async for p in pcursor if is_buyable(p)]
+    sort_spec = CARD_SORT
     if sort == "price_asc":
-        cards.sort(key=lambda c: c["from_price"])
+        sort_spec = [("from_price", 1)] + CARD_SORT
     elif sort == "price_desc":
-        cards.sort(key=lambda c: c["from_price"], reverse=True)
+        sort_spec = [("from_price", -1)] + CARD_SORT
+    cards = await storefront_cards({"collections": slug}, sort_spec)
     # sub-collections (children)
-    ccursor = db.collections.find({"published": True, "parent_slug": slug}, {"_id": 0}).sort([("position", 1), ("created_at", -1)])
+    child_docs = await db.collections.find({"published": True, "parent_slug": slug}, {"_id": 0}).sort([("position", 1), ("created_at", -1)]).to_list(1000)
+    counts = await collection_product_counts([c.get("slug", "") for c in child_docs]) if child_docs else {}
     children = []
-    async for c in ccursor:
+    for c in child_docs:
         cc = serialize_doc(c)
-        cc["product_count"] = await _collection_product_count(c.get("slug", ""))
+        cc["product_count"] = counts.get(c.get("slug", ""), 0)
         children.append(cc)
     return {"collection": serialize_doc(doc), "products": cards, "children": children, "total": len(cards)}
 
@@ -329,7 +340,8 @@ async def get_public_products(
     search: Optional[str] = None,
     limit: int = 60,
 ):
-    query = {"published": True, "collections": {"$exists": True, "$ne": []}}
+    # Only projects filed under a collection are listed, as before the read model.
+    query = {"collections": {"$exists": True, "$ne": []}}
     if collection:
         query["collections"] = collection
     if tag:
@@ -342,11 +354,7 @@ async def get_public_products(
             {"subtitle": {"$regex": search, "$options": "i"}},
             {"tags": {"$regex": search, "$options": "i"}},
         ]
-    cursor = db.projects.find(query, {"_id": 0}).sort(
-        [("featured", -1), ("position", 1), ("created_at", -1)]
-    ).limit(min(limit, 200))
-    sale = await _get_sale()
-    items = [_project_card(p, sale) async for p in cursor if is_buyable(p)]
+    items = await storefront_cards(query, limit=min(limit, 200))
     return {"products": items, "total": len(items)}
 
 
@@ -356,7 +364,7 @@ async def get_public_product(slug: str):
     if not p:
         raise HTTPException(404, "Product not found")
     sale = await _get_sale()
-    card = _project_card(p, sale)
+    card = _project_card(p, sale, await original_widths(project_image_urls(p)))
     card["price_matrix"] = p.get("price_matrix") or {}
     card["description_html"] = f"<p>{p.get('description', '')}</p>" if p.get("description") else ""
     card["meta_title"] = p.get("meta_title", "")
@@ -364,14 +372,7 @@ async def get_public_product(slug: str):
     related = []
     cols = p.get("collections") or []
     if cols:
-        rcursor = db.projects.find(
-            {"published": True, "slug": {"$ne": slug}, "collections": {"$in": cols}}, {"_id": 0}
-        ).limit(8)
-        async for r in rcursor:
-            if is_buyable(r):
-                related.append(_project_card(r, sale))
-            if len(related) >= 4:
-                break
+        related = await storefront_cards({"slug": {"$ne": slug}, "collections": {"$in": cols}}, limit=4)
     card["related"] = related
     return card
 
@@ -485,11 +486,12 @@ async def admin_create_product_from_project(project_id: str, admin=Depends(requi
 
 @router.get("/api/admin/collections")
 async def admin_list_collections(admin=Depends(require_admin)):
-    cursor = db.collections.find({}, {"_id": 0}).sort([("position", 1), ("created_at", -1)])
+    docs = await db.collections.find({}, {"_id": 0}).sort([("position", 1), ("created_at", -1)]).to_list(1000)
+    counts = await collection_product_counts()
     items = []
-    async for doc in cursor:
+    for doc in docs:
         clean = serialize_doc(doc)
-        clean["product_count"] = await _collection_product_count(doc.get("slug", ""))
+        clean["product_count"] = counts.get(doc.get("slug", ""), 0)
         items.append(clean)
     return {"collections": items}
 
@@ -605,6 +607,9 @@ async def admin_update_sale(req: SalePayload, admin=Depends(require_admin)):
         "updated_at": _now(),
     }
     await db.settings.update_one({"key": "global_sale"}, {"$set": update}, upsert=True)
+    await bump_settings_version()
+    # Every stored card carries sale pricing — re-price the whole read model.
+    await rebuild_product_cards()
     return {"enabled": req.enabled, "percent": req.percent, "headline": req.headline, "ends_at": req.ends_at}
 
 
@@ -619,35 +624,42 @@ def _stripe(request: Request):
     return StripeCheckout(api_key=STRIPE_API_KEY, webhook_url=webhook_url)
 
 
-@router.post("/api/checkout/session")
-async def create_checkout_session(req: CheckoutRequest, request: Request):
-    from emergentintegrations.payments.stripe.checkout import CheckoutSessionRequest
-    if not req.items:
-        raise HTTPException(400, "Cart is empty")
-    if not STRIPE_API_KEY:
-        raise HTTPException(503, "Payments are not configured")
+_CART_PROJECTION = {"_id": 0, "slug": 1, "title": 1, "hero_image_url": 1, "price_matrix": 1, "price": 1, "price_currency": 1}
+
+
+async def price_cart(items: List[CartLine]) -> dict:
+    """Server-side cart pricing — never trust the client.
+
+    Price = exact metal-tier x carat matrix cell, then the active site-wide sale.
+    All slugs resolve in one `$in` query and every line is priced against the
+    same sale snapshot. Lines that can't be priced go to `unavailable`.
+    """
+    slugs = list({line.product_slug for line in items})
+    projects = {}
+    async for p in db.projects.find({"slug": {"$in": slugs}, "published": True}, _CART_PROJECTION):
+        projects[p["slug"]] = p
+    sale = await _get_sale()
 
-    # Server-side price computation — never trust the client.
-    # Price = exact metal-tier x carat matrix cell, then the active site-wide sale.
     total = 0.0
     currency = "usd"
-    line_summary = []
-    sale = await _get_sale()
-    for line in req.items:
-        project = await db.projects.find_one({"slug": line.product_slug, "published": True}, {"_id": 0})
+    priced, unavailable = [], []
+    for line in items:
+        project = projects.get(line.product_slug)
         if not project:
-            raise HTTPException(400, f"Product not available: {line.product_slug}")
+            unavailable.append({"slug": line.product_slug, "error": f"Product not available: {line.product_slug}"})
+            continue
         qty = max(1, int(line.quantity or 1))
         unit = variant_price(project, line.metal_tier or "", line.carat or "")
         if unit <= 0:
             unit = project_from_price(project)
         if unit <= 0:
-            raise HTTPException(400, f"Price unavailable for {line.product_slug}")
+            unavailable.append({"slug": line.product_slug, "error": f"Price unavailable for {line.product_slug}"})
+            continue
         if sale:
             unit = apply_sale(unit, sale)
         total += unit * qty
         currency = (project.get("price_currency") or "USD").lower()
-        line_summary.append({
+        priced.append({
             "slug": line.product_slug,
             "title": project.get("title", ""),
             "image": project.get("hero_image_url", ""),
@@ -659,8 +671,31 @@ async def create_checkout_session(req: CheckoutRequest, request: Request):
             "carat": line.carat or "",
             "size": line.size or "",
         })
+    return {"items": priced, "unavailable": unavailable, "total": round(total, 2), "currency": currency, "sale": sale}
+
+
+@router.post("/api/cart/quote")
+async def quote_cart(req: CartQuoteRequest):
+    """Server-verified cart totals for the cart drawer — same pricing as
+    checkout, without starting a Stripe session."""
+    return await price_cart(req.items)
+
+
+@router.post("/api/checkout/session")
+async def create_checkout_session(req: CheckoutRequest, request: Request):
+    from emergentintegrations.payments.stripe.checkout import CheckoutSessionRequest
+    if not req.items:
+        raise HTTPException(400, "Cart is empty")
+    if not STRIPE_API_KEY:
+        raise HTTPException(503, "Payments are not configured")
+
+    quote = await price_cart(req.items)
+    if quote["unavailable"]:
+        raise HTTPException(400, quote["unavailable"][0]["error"])
+    total = quote["total"]
+    currency = quote["currency"]
+    line_summary = quote["items"]
 
-    total = round(total, 2)
     if total <= 0:
         raise HTTPException(400, "Invalid cart total")
 
@@ -811,10 +846,12 @@ async def checkout_invoice(session_id: str):
 # ============================================================
 
 @router.get("/api/admin/shop-orders")
-async def admin_list_shop_orders(admin=Depends(require_admin)):
-    cursor = db.shop_orders.find({}, {"_id": 0}).sort("created_at", -1).limit(300)
-    items = [serialize_doc(o) async for o in cursor]
-    return {"orders": items, "total": len(items)}
+async def admin_list_shop_orders(admin=Depends(require_admin), cursor: Optional[str] = None,
+                                 limit: int = Query(100, ge=1, le=300), total: str = Query("estimate")):
+    from pagination import keyset_page
+    page = await keyset_page(db.shop_orders, {}, "created_at", "order_id", limit, cursor, projection={"_id": 0}, total=total)
+    items = [serialize_doc(o) for o in page.pop("items")]
+    return {"orders": items, "limit": limit, **page}
 
 
 @router.get("/api/admin/shop-orders/{order_id}/invoice")
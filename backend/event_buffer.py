@@ -0,0 +1,176 @@
+"""Buffered bulk writes for analytics events.
+
+`/api/events` and `/api/events/batch` hand finished event documents to
+`event_buffer` instead of inserting them one by one. A background task flushes
+the buffer with `insert_many(ordered=False)` whenever it reaches
+EVENT_BUFFER_MAX_BATCH documents or EVENT_BUFFER_FLUSH_SECONDS have passed, so
+an ad-driven traffic spike costs a handful of bulk writes per second instead
+of one write per event.
+
+- Backpressure: once EVENT_BUFFER_MAX_PENDING documents are waiting, `add()`
+  waits for the next flush instead of growing memory without bound — for at
+  most EVENT_BUFFER_MAX_WAIT_SECONDS. If Mongo is down and nothing drains,
+  it raises EventBufferFull (counted as "rejected") so the endpoint can
+  answer 503 instead of hanging every ingest request.
+- Shutdown: `drain()` (called from the app lifespan) writes whatever is left.
+- Late fixes: `patch_pending(fn)` edits documents that are still buffered,
+  for writers that correct events in place after ingestion.
+- Hooks: `on_flush(fn)` registers `async fn(docs)` to run after each batch is
+  stored — derived views (stats, sketches) update from the same batch.
+
+Before `start()` (scripts, one-off tasks) `add()` writes straight through.
+"""
+import os
+import asyncio
+import logging
+from typing import Awaitable, Callable, List
+
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+EVENT_BUFFER_MAX_BATCH = int(os.environ.get("EVENT_BUFFER_MAX_BATCH", "500"))
+EVENT_BUFFER_FLUSH_SECONDS = float(os.environ.get("EVENT_BUFFER_FLUSH_SECONDS", "1.0"))
+EVENT_BUFFER_MAX_PENDING = int(os.environ.get("EVENT_BUFFER_MAX_PENDING", "20000"))
+EVENT_BUFFER_MAX_WAIT_SECONDS = float(os.environ.get("EVENT_BUFFER_MAX_WAIT_SECONDS", "5"))
+
+
+class EventBufferFull(Exception):
+    """Raised by `add()` when backpressure didn't clear within max_wait."""
+
+
+class EventWriteBuffer:
+    def __init__(self, collection: Callable, max_batch: int, flush_seconds: float, max_pending: int, max_wait: float):
+        self._collection = collection
+        self.max_batch = max_batch
+        self.flush_seconds = flush_seconds
+        self.max_pending = max_pending
+        self.max_wait = max_wait
+        self._pending: List[dict] = []
+        self._hooks: List[Callable[[List[dict]], Awaitable[None]]] = []
+        self._wake = asyncio.Event()
+        self._flushed = asyncio.Event()
+        self._task = None
+        self._stopping = False
+        self.stats = {"enqueued": 0, "written": 0, "flushes": 0, "failed": 0, "dropped": 0, "waits": 0, "rejected": 0}
+
+    def on_flush(self, hook: Callable[[List[dict]], Awaitable[None]]):
+        """Register `async hook(docs)` to run after each stored batch."""
+        self._hooks.append(hook)
+        return hook
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def patch_pending(self, fn: Callable[[dict], bool]) -> int:
+        """Apply `fn(doc)` to every buffered document; `fn` edits in place and
+        returns True if it changed the doc. Returns the number changed."""
+        return sum(1 for doc in self._pending if fn(doc))
+
+    async def add(self, docs: List[dict]):
+        if not docs:
+            return
+        self.stats["enqueued"] += len(docs)
+        if self._task is None:
+            await self._write(list(docs))
+            return
+        deadline = asyncio.get_running_loop().time() + self.max_wait
+        if len(self._pending) >= self.max_pending:
+            # Wake the flusher once; if that flush fails, later ones come on
+            # its own timer rather than spinning against a down database.
+            self.stats["waits"] += 1
+            self._wake.set()
+        while len(self._pending) >= self.max_pending:
+            try:
+                await asyncio.wait_for(self._flushed.wait(), max(0.0, deadline - asyncio.get_running_loop().time()))
+            except asyncio.TimeoutError:
+                self.stats["rejected"] += len(docs)
+                raise EventBufferFull(f"{len(self._pending)} events pending") from None
+        self._pending.extend(docs)
+        if len(self._pending) >= self.max_batch:
+            self._wake.set()
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def drain(self):
+        """Stop the flusher and write everything still buffered. The flusher
+        is stopped cooperatively so an in-flight batch is never lost."""
+        task = self._task
+        if task:
+            self._stopping = True
+            self._wake.set()
+            await task
+            self._task = None
+        await self._flush()
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self._flush()
+            except Exception as e:
+                logger.error(f"event buffer flush failed: {e}")
+
+    async def _flush(self):
+        while self._pending:
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            if not await self._write(batch):
+                break
+        # Release anyone held back by backpressure.
+        self._flushed.set()
+        self._flushed.clear()
+
+    async def _write(self, batch: List[dict]) -> bool:
+        """Insert one batch. On a connection-level failure the batch is put
+        back (if there is room) for the next flush."""
+        try:
+            await self._collection().insert_many(batch, ordered=False)
+            self.stats["written"] += len(batch)
+        except BulkWriteError as e:
+            written = e.details.get("nInserted", 0)
+            self.stats["written"] += written
+            self.stats["failed"] += len(batch) - written
+            logger.error(f"event batch partially written ({written}/{len(batch)}): {e.details.get('writeErrors', [])[:1]}")
+            # Hooks only see what was stored (ordered=False: every doc without
+            # a write error was inserted).
+            failed = {err["index"] for err in e.details.get("writeErrors", [])}
+            batch = [doc for i, doc in enumerate(batch) if i not in failed]
+        except Exception as e:
+            logger.error(f"event batch write failed ({len(batch)} docs): {e}")
+            if self._task is not None and len(self._pending) + len(batch) <= self.max_pending:
+                self._pending[:0] = batch
+            else:
+                self.stats["dropped"] += len(batch)
+            return False
+        self.stats["flushes"] += 1
+        if not batch:
+            return True
+        for hook in self._hooks:
+            try:
+                await hook(batch)
+            except Exception as e:
+                logger.error(f"event flush hook {getattr(hook, '__name__', hook)} failed: {e}")
+        return True
+
+
+def _events_collection():
+    from admin_routes import db
+    return db.events
+
+
+event_buffer = EventWriteBuffer(
+    _events_collection,
+    max_batch=EVENT_BUFFER_MAX_BATCH,
+    flush_seconds=EVENT_BUFFER_FLUSH_SECONDS,
+    max_pending=EVENT_BUFFER_MAX_PENDING,
+    max_wait=EVENT_BUFFER_MAX_WAIT_SECONDS,
+)
@@ -0,0 +1,656 @@
+"""Hourly/daily pre-aggregated event rollups for the admin analytics endpoints.
+
+A background job folds finished hours of `db.events` into
+`events_rollup_hourly` and then re-derives `events_rollup_daily` from those
+hours. Rows are written per narrow dimension group (ROLLUP_GROUPS), never for
+the cross product of every dimension, so each group's row count stays near
+the number of distinct values it actually has. Each row carries:
+
+    ts      bucket start (UTC hour or UTC day)
+    g       the group, e.g. "event_name,wizard_step"
+    d       that group's dimension values
+    count   events in the bucket
+    st_sum / st_n / st_max   step_time_ms (> 0) sum, count and max
+
+`landing` is the landing URL's path (no host, query string or fragment) and
+`referrer` the referrer's lowercased host, computed the same way for rolled
+rows and raw scans.
+
+`rollup_counts(start, end, by, match)` answers "group events in this window by
+these dimensions" from the narrowest group covering `by` and `match`: daily
+rows for whole days, hourly rows for whole hours and a raw `events` scan only
+for the partial edge hours and the tail that the job hasn't rolled yet — so
+results match a raw scan while a 90-day window reads a few hundred
+pre-aggregated rows.
+
+Distinct sessions/visitors can't be summed across buckets, so for the
+dimension groups in SKETCH_GROUPS the job also writes `events_sketch_hourly`
+/ `events_sketch_daily` / `events_sketch_monthly` rows {ts, g, d, count, s, v}
+holding HyperLogLog sketches (see hll.py) of session_id (s) and anonymous_id
+(v); months are pre-merged from their days, so a long window merges a few
+monthly rows per value plus the edge days. `distinct_counts(start, end, by,
+match)` merges them over the window the same way, ~1% error, in a worker
+thread so the event loop never runs the merges; `exact=True` falls back to a
+raw `$addToSet` scan.
+
+Rolling an hour is idempotent (its rows are replaced), and the watermark in
+`db.settings {key: "events_rollup_state"}` only advances once an hour's rows
+(and its day's row) are written, so readers never see a half-rolled bucket.
+A lease on the same doc keeps multiple workers from rolling concurrently —
+including the first pass after deploy, which backfills all history: workers
+that don't hold the lease skip it. The lease is renewed before every step,
+and `db.settings.key` is unique, so two workers booting at once can't each
+create (and lease) their own state doc.
+`request_reroll(ts)` asks for already-rolled hours from `ts` on to be rolled
+again (e.g. after events are patched in place); the next pass rewinds the
+watermark under the lease.
+
+Run `python event_rollups.py --rebuild` to re-roll history from scratch.
+"""
+import os
+import uuid
+import asyncio
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional
+
+from pymongo.errors import DuplicateKeyError
+
+from admin_routes import db
+from hll import HLL, hash_value
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_INTERVAL_SECONDS = float(os.environ.get("EVENT_ROLLUP_INTERVAL_SECONDS", "60"))
+# Hours are rolled this long after they end, so buffered/late events land first.
+ROLLUP_LAG = timedelta(minutes=int(os.environ.get("EVENT_ROLLUP_LAG_MINUTES", "10")))
+ROLLUP_MAX_HOURS_PER_PASS = 24 * 7
+ROLLUP_LEASE = timedelta(minutes=5)
+_STATE_KEY = "events_rollup_state"
+_HOUR = timedelta(hours=1)
+_DAY = timedelta(days=1)
+
+ROLLUP_SCHEMA = 3   # bump to drop and re-roll every rollup/sketch row on deploy
+
+
+def _url_part(field: str, regex: str) -> dict:
+    """First capture of `regex` in a string field (None when it doesn't match)."""
+    text = {"$cond": [{"$eq": [{"$type": field}, "string"]}, field, ""]}
+    return {"$let": {
+        "vars": {"m": {"$regexFind": {"input": text, "regex": regex, "options": "i"}}},
+        "in": {"$ifNull": [{"$arrayElemAt": ["$$m.captures", 0]}, None]},
+    }}
+
+
+# "https://site.com/rings/x?utm_source=ig#top" -> "/rings/x" (bare host -> "/")
+_LANDING_PATH = {"$let": {
+    "vars": {"p": _url_part("$attribution.landing_url", r"^(?:[a-z][a-z0-9+.\-]*:)?(?://[^/?#]*)?([^?#]*)")},
+    "in": {"$cond": [{"$and": [{"$eq": ["$$p", ""]}, {"$eq": [{"$type": "$attribution.landing_url"}, "string"]}, {"$ne": ["$attribution.landing_url", ""]}]}, "/", "$$p"]},
+}}
+# "https://Www.Google.com/search?q=..." -> "www.google.com"
+_REFERRER_HOST = {"$toLower": _url_part("$attribution.referrer_url", r"^[a-z][a-z0-9+.\-]*://(?:[^@/?#]*@)?([^/?#:]+)")}
+
+# Rollup dimension -> field path on a raw event.
+FIELDS = {
+    "event_name": "event_name",
+    "wizard_step": "wizard_step",
+    "device": "ua_parsed.device",
+    "browser": "ua_parsed.browser",
+    "os": "ua_parsed.os",
+    "country": "geo.country",
+    "region": "geo.region",
+    "city": "geo.city",
+    "timezone": "geo.timezone",
+    "utm_source": "attribution.utm_source",
+    "visitor_type": "visitor_type",
+    "viewport": "viewport",
+    "field_name": "field_name",
+    "error_code": "error_code",
+    "from_step": "event_data.from_step_id",
+}
+# Rollup dimension -> value expression on a raw event.
+DIMS = {
+    **{dim: f"${path}" for dim, path in FIELDS.items()},
+    "referrer": _REFERRER_HOST,
+    "landing": _LANDING_PATH,
+}
+# Dimension groups rolled together. A query is answered from the smallest
+# group holding every dimension it groups or filters by.
+ROLLUP_GROUPS = [
+    ("event_name", "wizard_step"),
+    ("event_name", "from_step"),
+    ("event_name", "field_name", "error_code"),
+    ("event_name", "device", "browser", "os"),
+    ("event_name", "visitor_type"),
+    ("event_name", "country", "region", "city", "timezone"),
+    ("event_name", "utm_source", "referrer"),
+    ("event_name", "landing"),
+    ("viewport",),
+]
+# Time keys `rollup_counts` can group by, as $dateToString formats.
+TIME_KEYS = {"date": "%Y-%m-%d", "hour": "%Y-%m-%dT%H"}
+
+_STEP_TIME_OK = {"$and": [{"$isNumber": "$step_time_ms"}, {"$gt": ["$step_time_ms", 0]}]}
+_RAW_METRICS = {
+    "count": {"$sum": 1},
+    "st_sum": {"$sum": {"$cond": [_STEP_TIME_OK, "$step_time_ms", 0]}},
+    "st_n": {"$sum": {"$cond": [_STEP_TIME_OK, 1, 0]}},
+    "st_max": {"$max": {"$cond": [_STEP_TIME_OK, "$step_time_ms", 0]}},
+}
+_ROLLUP_METRICS = {
+    "count": {"$sum": "$count"},
+    "st_sum": {"$sum": "$st_sum"},
+    "st_n": {"$sum": "$st_n"},
+    "st_max": {"$max": "$st_max"},
+}
+
+# Dimension groups with per-bucket HLL sketches (for `distinct_counts`).
+SKETCH_GROUPS = [
+    ("event_name",),
+    ("event_name", "wizard_step"),
+    ("country",),
+    ("city", "region", "country"),
+    ("device",),
+    ("browser",),
+    ("os",),
+    ("visitor_type",),
+]
+_SKETCH_DIMS = sorted({dim for group in SKETCH_GROUPS for dim in group})
+
+_owner = uuid.uuid4().hex
+_task = None
+
+
+def _floor_hour(dt: datetime) -> datetime:
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+def _ceil_hour(dt: datetime) -> datetime:
+    floor = _floor_hour(dt)
+    return floor if floor == dt else floor + _HOUR
+
+
+def _floor_day(dt: datetime) -> datetime:
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _ceil_day(dt: datetime) -> datetime:
+    floor = _floor_day(dt)
+    return floor if floor == dt else floor + _DAY
+
+
+def _floor_month(dt: datetime) -> datetime:
+    return _floor_day(dt).replace(day=1)
+
+
+def _next_month(dt: datetime) -> datetime:
+    month = _floor_month(dt)
+    return month.replace(year=month.year + 1, month=1) if month.month == 12 else month.replace(month=month.month + 1)
+
+
+def _ceil_month(dt: datetime) -> datetime:
+    floor = _floor_month(dt)
+    return floor if floor == dt else _next_month(floor)
+
+
+def _aware(dt: Optional[datetime]) -> Optional[datetime]:
+    # Motor returns naive UTC datetimes unless the client is tz_aware.
+    return dt.replace(tzinfo=timezone.utc) if dt and dt.tzinfo is None else dt
+
+
+async def ensure_indexes():
+    for collection in (db.events_rollup_hourly, db.events_rollup_daily):
+        await collection.create_index("ts")
+        await collection.create_index([("g", 1), ("ts", 1)])
+        await collection.create_index([("g", 1), ("d.event_name", 1), ("ts", 1)])
+    await db.events_sketch_hourly.create_index([("g", 1), ("ts", 1)])
+    await db.events_sketch_daily.create_index([("g", 1), ("ts", 1)])
+    await db.events_sketch_monthly.create_index([("g", 1), ("ts", 1)])
+
+
+async def rolled_until() -> Optional[datetime]:
+    """Everything before this instant is in the rollup collections."""
+    state = await db.settings.find_one({"key": _STATE_KEY}, {"_id": 0, "rolled_until": 1})
+    return _aware((state or {}).get("rolled_until"))
+
+
+# ── Rolling ──────────────────────────────────────────────────
+
+async def _acquire_lease(now: datetime) -> bool:
+    try:
+        await db.settings.update_one({"key": _STATE_KEY}, {"$setOnInsert": {"key": _STATE_KEY, "lease_until": now - ROLLUP_LEASE}}, upsert=True)
+    except DuplicateKeyError:
+        pass   # another worker created it first
+    res = await db.settings.update_one(
+        {"key": _STATE_KEY, "$or": [{"lease_until": {"$lt": now}}, {"lease_owner": _owner}]},
+        {"$set": {"lease_until": now + ROLLUP_LEASE, "lease_owner": _owner}},
+    )
+    # matched, not modified: a renewal in the same millisecond changes nothing
+    return res.matched_count == 1
+
+
+async def _release_lease():
+    await db.settings.update_one({"key": _STATE_KEY, "lease_owner": _owner}, {"$set": {"lease_until": datetime.now(timezone.utc)}})
+
+
+async def _first_event_hour() -> Optional[datetime]:
+    first = await db.events.find_one({"server_timestamp": {"$type": "date"}}, {"server_timestamp": 1}, sort=[("server_timestamp", 1)])
+    return _floor_hour(_aware(first["server_timestamp"])) if first else None
+
+
+async def _roll_hours(start: datetime, end: datetime):
+    """Replace hourly rows for [start, end) from raw events, one aggregation per group."""
+    rows = []
+    for group in ROLLUP_GROUPS:
+        pipeline = _group_pipeline("raw", start, end, False, ["hour", *group], {})
+        async for r in db.events.aggregate(pipeline, allowDiskUse=True):
+            key = r.pop("_id")
+            ts = datetime.strptime(key.pop("hour"), TIME_KEYS["hour"]).replace(tzinfo=timezone.utc)
+            rows.append({"ts": ts, "g": ",".join(group), "d": key, **{m: r[m] for m in _RAW_METRICS}})
+    await db.events_rollup_hourly.delete_many({"ts": {"$gte": start, "$lt": end}})
+    if rows:
+        await db.events_rollup_hourly.insert_many(rows, ordered=False)
+
+
+async def _roll_days(start: datetime, end: datetime):
+    """Re-derive daily rows for the days touching [start, end) from hourly rows."""
+    day_start, day_end = _floor_day(start), _ceil_day(end)
+    pipeline = [
+        {"$match": {"ts": {"$gte": day_start, "$lt": day_end}}},
+        {"$group": {"_id": {"g": "$g", "d": "$d", "day": {"$dateToString": {"format": TIME_KEYS["date"], "date": "$ts"}}}, **_ROLLUP_METRICS}},
+    ]
+    rows = []
+    async for r in db.events_rollup_hourly.aggregate(pipeline, allowDiskUse=True):
+        key = r.pop("_id")
+        ts = datetime.strptime(key["day"], TIME_KEYS["date"]).replace(tzinfo=timezone.utc)
+        rows.append({"ts": ts, "g": key["g"], "d": key["d"], **{m: r[m] for m in _ROLLUP_METRICS}})
+    await db.events_rollup_daily.delete_many({"ts": {"$gte": day_start, "$lt": day_end}})
+    if rows:
+        await db.events_rollup_daily.insert_many(rows, ordered=False)
+
+
+def _dig(doc: dict, path: str):
+    for part in path.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+def _sketch_rows(buckets: Dict[tuple, list]) -> List[dict]:
+    return [
+        {"ts": ts, "g": ",".join(group), "d": dict(zip(group, values)), "count": n, "s": s.to_bson(), "v": v.to_bson()}
+        for (ts, group, values), (n, s, v) in buckets.items()
+    ]
+
+
+def _fold_events(buckets: Dict[tuple, list], events: List[dict]):
+    """Add raw events to per-(hour, group, values) sketches. Runs in a thread."""
+    for e in events:
+        ts = _floor_hour(_aware(e["server_timestamp"]))
+        values = {dim: _dig(e, FIELDS[dim]) for dim in _SKETCH_DIMS}
+        sid, aid = e.get("session_id"), e.get("anonymous_id")
+        s_hash = hash_value(sid) if sid else None
+        v_hash = hash_value(aid) if aid else None
+        for group in SKETCH_GROUPS:
+            key = (ts, group, tuple(values[dim] for dim in group))
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = [0, HLL(), HLL()]
+            bucket[0] += 1
+            if s_hash is not None:
+                bucket[1].add_hash(s_hash)
+            if v_hash is not None:
+                bucket[2].add_hash(v_hash)
+
+
+async def _sketch_hours(start: datetime, end: datetime):
+    """Replace hourly sketches for [start, end) from raw events (one pass)."""
+    fields = {FIELDS[dim]: 1 for dim in _SKETCH_DIMS}
+    cursor = db.events.find(
+        {"server_timestamp": {"$gte": start, "$lt": end}},
+        {"_id": 0, "server_timestamp": 1, "session_id": 1, "anonymous_id": 1, **fields},
+    ).batch_size(1000)
+    buckets: Dict[tuple, list] = {}
+    batch = []
+    async for e in cursor:
+        batch.append(e)
+        if len(batch) >= 1000:
+            await asyncio.to_thread(_fold_events, buckets, batch)
+            batch = []
+    if batch:
+        await asyncio.to_thread(_fold_events, buckets, batch)
+    rows = await asyncio.to_thread(_sketch_rows, buckets)
+    await db.events_sketch_hourly.delete_many({"ts": {"$gte": start, "$lt": end}})
+    if rows:
+        await db.events_sketch_hourly.insert_many(rows, ordered=False)
+
+
+def _merge_rows(rows: List[dict], floor) -> List[dict]:
+    """Merge stored sketch rows into coarser buckets (`floor` maps ts to the
+    bucket start). Runs in a thread."""
+    buckets: Dict[tuple, list] = {}
+    for r in rows:
+        group = tuple(r["g"].split(","))
+        key = (floor(_aware(r["ts"])), group, tuple(r["d"].get(dim) for dim in group))
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = [0, HLL(), HLL()]
+        bucket[0] += r["count"]
+        bucket[1].update(HLL.from_bson(r["s"]))
+        bucket[2].update(HLL.from_bson(r["v"]))
+    return _sketch_rows(buckets)
+
+
+async def _resketch(source, target, lo: datetime, hi: datetime, floor):
+    """Replace `target` rows in [lo, hi) with `source` rows merged per bucket."""
+    rows = await source.find({"ts": {"$gte": lo, "$lt": hi}}, {"_id": 0}).to_list(None)
+    merged = await asyncio.to_thread(_merge_rows, rows, floor)
+    await target.delete_many({"ts": {"$gte": lo, "$lt": hi}})
+    if merged:
+        await target.insert_many(merged, ordered=False)
+
+
+async def _sketch_days(start: datetime, end: datetime):
+    """Re-derive daily sketches for the days touching [start, end) by merging hours."""
+    await _resketch(db.events_sketch_hourly, db.events_sketch_daily, _floor_day(start), _ceil_day(end), _floor_day)
+
+
+async def _sketch_months(start: datetime, end: datetime):
+    """Re-derive monthly sketches for the months touching [start, end) by merging days."""
+    await _resketch(db.events_sketch_daily, db.events_sketch_monthly, _floor_month(start), _ceil_month(end), _floor_month)
+
+
+_ROLL_STEPS = (_roll_hours, _roll_days, _sketch_hours, _sketch_days, _sketch_months)
+
+
+async def roll_pending() -> int:
+    """Roll every finished hour past the watermark (bounded per call).
+    Returns the number of hours rolled; 0 if another worker holds the lease."""
+    now = datetime.now(timezone.utc)
+    if not await _acquire_lease(now):
+        return 0
+    try:
+        if not await db.settings.find_one({"key": _STATE_KEY, "schema": ROLLUP_SCHEMA}):
+            # Rows from an older layout can't be read: re-roll history once.
+            await _drop_rows()
+            await db.settings.update_one({"key": _STATE_KEY}, {"$unset": {"rolled_until": ""}, "$set": {"schema": ROLLUP_SCHEMA}})
+        target = _floor_hour(now - ROLLUP_LAG)
+        state = await db.settings.find_one({"key": _STATE_KEY}, {"_id": 0, "rolled_until": 1, "reroll_from": 1})
+        start = _aware((state or {}).get("rolled_until"))
+        reroll = (state or {}).get("reroll_from")
+        if reroll:
+            # Rewind and consume the request in one write, so a failed pass
+            # still re-rolls those hours next time.
+            update = {"$unset": {"reroll_from": ""}}
+            rewind = start and _aware(reroll) < start
+            if rewind:
+                update["$set"] = {"rolled_until": _floor_hour(_aware(reroll))}
+            res = await db.settings.update_one({"key": _STATE_KEY, "reroll_from": reroll}, update)
+            if res.matched_count and rewind:
+                start = _floor_hour(_aware(reroll))
+        start = start or await _first_event_hour() or target
+        end = min(target, start + ROLLUP_MAX_HOURS_PER_PASS * _HOUR)
+        hours = 0
+        while start < end:
+            # Roll at most a day per aggregation to keep $group memory small.
+            chunk_end = min(end, _floor_day(start) + _DAY)
+            lost = False
+            for step in _ROLL_STEPS:
+                # Renew before every step: a day of a big history can take
+                # longer than one lease, and a second roller would interleave
+                # its delete/insert with ours.
+                if not await _acquire_lease(datetime.now(timezone.utc)):
+                    lost = True
+                    break
+                await step(start, chunk_end)
+            if lost:
+                logger.warning("event rollup lease lost; stopping this pass")
+                break
+            await db.settings.update_one({"key": _STATE_KEY}, {"$set": {"rolled_until": chunk_end, "updated_at": datetime.now(timezone.utc)}})
+            hours += int((chunk_end - start) / _HOUR)
+            start = chunk_end
+        if not await rolled_until():
+            await db.settings.update_one({"key": _STATE_KEY}, {"$set": {"rolled_until": start}})
+        return hours
+    finally:
+        await _release_lease()
+
+
+async def request_reroll(since: datetime):
+    """Have the next pass re-roll every rolled hour from `since` on."""
+    await db.settings.update_one({"key": _STATE_KEY}, {"$min": {"reroll_from": since}}, upsert=True)
+
+
+async def _drop_rows():
+    await db.events_rollup_hourly.delete_many({})
+    await db.events_rollup_daily.delete_many({})
+    await db.events_sketch_hourly.delete_many({})
+    await db.events_sketch_daily.delete_many({})
+    await db.events_sketch_monthly.delete_many({})
+
+
+async def rebuild():
+    """Drop all rollups and re-roll history."""
+    await _drop_rows()
+    await db.settings.update_one({"key": _STATE_KEY}, {"$unset": {"rolled_until": ""}})
+    total = 0
+    while True:
+        hours = await roll_pending()
+        total += hours
+        if hours < ROLLUP_MAX_HOURS_PER_PASS:
+            return total
+
+
+async def _run():
+    while True:
+        try:
+            while await roll_pending() >= ROLLUP_MAX_HOURS_PER_PASS:
+                pass   # backfill: keep going until caught up
+        except Exception as e:
+            logger.error(f"event rollup pass failed: {e}")
+        await asyncio.sleep(ROLLUP_INTERVAL_SECONDS)
+
+
+def start():
+    global _task
+    if _task is None:
+        _task = asyncio.create_task(_run())
+
+
+async def stop():
+    global _task
+    if _task:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+
+
+# ── Reading ──────────────────────────────────────────────────
+
+def _segments(start: datetime, end: datetime, watermark: Optional[datetime], hourly_only: bool, monthly: bool = False) -> List[tuple]:
+    """Split [start, end] into (source, lo, hi, hi_inclusive) pieces: "raw" for
+    partial hours and the unrolled tail, "hourly"/"daily" (and with `monthly`,
+    "monthly" for whole months) for rolled buckets."""
+    lo, hi = _ceil_hour(start), min(_floor_hour(end), watermark) if watermark else None
+    if hi is None or lo >= hi:
+        return [("raw", start, end, True)]
+    segments = [("raw", start, lo, False), ("raw", hi, end, True)]
+    d_lo, d_hi = _ceil_day(lo), _floor_day(hi)
+    if hourly_only or d_lo >= d_hi:
+        segments.append(("hourly", lo, hi, False))
+    else:
+        segments += [("hourly", lo, d_lo, False), ("hourly", d_hi, hi, False)]
+        m_lo, m_hi = _ceil_month(d_lo), _floor_month(d_hi)
+        if monthly and m_lo < m_hi:
+            segments += [("daily", d_lo, m_lo, False), ("monthly", m_lo, m_hi, False), ("daily", m_hi, d_hi, False)]
+        else:
+            segments.append(("daily", d_lo, d_hi, False))
+    return [s for s in segments if s[1] < s[2] or s[3]]
+
+
+def cover(dims) -> tuple:
+    """The smallest ROLLUP_GROUPS entry holding every dimension in `dims`."""
+    for group in sorted(ROLLUP_GROUPS, key=len):
+        if set(dims) <= set(group):
+            return group
+    raise ValueError(f"no rollup group covers {sorted(dims)}")
+
+
+def _segment_query(source: str, lo: datetime, hi: datetime, hi_inclusive: bool, match: Optional[Dict]) -> dict:
+    """Index-friendly $match for one segment. On raw events only the plain
+    field dimensions are filtered here; computed ones (referrer, landing)
+    are matched after projection in `_group_pipeline`."""
+    ts_field = "server_timestamp" if source == "raw" else "ts"
+    query = {ts_field: {"$gte": lo, ("$lte" if hi_inclusive else "$lt"): hi}}
+    if source == "raw":
+        query.update({FIELDS[dim]: cond for dim, cond in (match or {}).items() if dim in FIELDS})
+    else:
+        query.update({f"d.{dim}": cond for dim, cond in (match or {}).items()})
+    return query
+
+
+def _group_pipeline(source: str, lo: datetime, hi: datetime, hi_inclusive: bool, by: List[str], match: Dict,
+                    metrics: Optional[Dict] = None, group: Optional[tuple] = None) -> list:
+    """$match/$group over raw events or one rollup group's rows. Raw events
+    are first projected into the rollup shape ({ts, d: {dims}})."""
+    query = _segment_query(source, lo, hi, hi_inclusive, match)
+    stages = [{"$match": query}]
+    if source == "raw":
+        metrics = metrics or _RAW_METRICS
+        dims = {k for k in by if k not in TIME_KEYS} | set(match or {})
+        projection = {"_id": 0, "ts": "$server_timestamp", "step_time_ms": 1, "session_id": 1, "anonymous_id": 1}
+        if dims:
+            projection["d"] = {dim: DIMS[dim] for dim in sorted(dims)}
+        stages.append({"$project": projection})
+        computed = {f"d.{dim}": cond for dim, cond in (match or {}).items() if dim not in FIELDS}
+        if computed:
+            stages.append({"$match": computed})
+    else:
+        metrics = _ROLLUP_METRICS
+        if group is not None:
+            query["g"] = ",".join(group)
+    group_id = {}
+    for key in by:
+        if key in TIME_KEYS:
+            group_id[key] = {"$dateToString": {"format": TIME_KEYS[key], "date": "$ts"}}
+        else:
+            group_id[key] = f"$d.{key}"
+    return stages + [{"$group": {"_id": group_id, **metrics}}]
+
+
+async def rollup_counts(start: datetime, end: datetime, by: List[str], match: Optional[Dict] = None) -> List[dict]:
+    """Events in [start, end] grouped by `by` (DIMS keys plus "date"/"hour").
+
+    `match` filters on DIMS keys with plain Mongo conditions, e.g.
+    {"event_name": {"$in": [...]}, "country": {"$nin": [None, "", "Unknown"]}}.
+    Raises ValueError when no ROLLUP_GROUPS entry covers `by` and `match`.
+    Rows are {<by keys>..., count, st_sum, st_n, st_max}."""
+    start, end = _aware(start), _aware(end)
+    group = cover([k for k in by if k not in TIME_KEYS] + list(match or {}))
+    segments = _segments(start, end, await rolled_until(), hourly_only="hour" in by)
+    collections = {"raw": db.events, "hourly": db.events_rollup_hourly, "daily": db.events_rollup_daily}
+    results = await asyncio.gather(*(
+        collections[source].aggregate(_group_pipeline(source, lo, hi, hi_inclusive, by, match, group=group), allowDiskUse=True).to_list(None)
+        for source, lo, hi, hi_inclusive in segments
+    ))
+    merged: Dict[tuple, dict] = {}
+    for rows in results:
+        for r in rows:
+            key = tuple(r["_id"].get(k) for k in by)
+            row = merged.get(key)
+            if row is None:
+                merged[key] = {**dict(zip(by, key)), "count": r["count"], "st_sum": r["st_sum"], "st_n": r["st_n"], "st_max": r["st_max"] or 0}
+            else:
+                row["count"] += r["count"]
+                row["st_sum"] += r["st_sum"]
+                row["st_n"] += r["st_n"]
+                row["st_max"] = max(row["st_max"], r["st_max"] or 0)
+    return list(merged.values())
+
+
+def avg_step_time_ms(row: dict) -> float:
+    return row["st_sum"] / row["st_n"] if row.get("st_n") else 0
+
+
+_DISTINCT_METRICS = {"count": {"$sum": 1}, "s": {"$addToSet": "$session_id"}, "v": {"$addToSet": "$anonymous_id"}}
+
+
+async def _raw_distinct(lo: datetime, hi: datetime, hi_inclusive: bool, by: List[str], match: Optional[Dict]) -> List[tuple]:
+    pipeline = _group_pipeline("raw", lo, hi, hi_inclusive, by, match, _DISTINCT_METRICS)
+    rows = await db.events.aggregate(pipeline, allowDiskUse=True).to_list(None)
+    return [(tuple(r["_id"].get(k) for k in by), r["count"], [x for x in r["s"] if x], [x for x in r["v"] if x]) for r in rows]
+
+
+async def _sketch_segment(source: str, lo: datetime, hi: datetime, hi_inclusive: bool, by: List[str], group: tuple, match: Optional[Dict]) -> List[tuple]:
+    """(key, count, sessions, visitors) per `by` key for one segment, not yet
+    decoded: id lists for a raw scan, BSON sketches for rolled rows."""
+    if source == "raw":
+        return await _raw_distinct(lo, hi, hi_inclusive, by, match)
+    collection = {"hourly": db.events_sketch_hourly, "daily": db.events_sketch_daily, "monthly": db.events_sketch_monthly}[source]
+    query = {"g": ",".join(group), **_segment_query(source, lo, hi, hi_inclusive, match)}
+    out = []
+    async for r in collection.find(query, {"_id": 0}):
+        ts = _aware(r["ts"])
+        key = tuple(ts.strftime(TIME_KEYS[k]) if k in TIME_KEYS else r["d"].get(k) for k in by)
+        out.append((key, r["count"], r["s"], r["v"]))
+    return out
+
+
+def _sketch(ids_or_bson) -> HLL:
+    if isinstance(ids_or_bson, list):
+        s = HLL()
+        for x in ids_or_bson:
+            s.add(x)
+        return s
+    return HLL.from_bson(ids_or_bson)
+
+
+def _merge_distinct(results: List[List[tuple]], by: List[str]) -> List[dict]:
+    """Decode, merge and count segment rows. Runs in a thread."""
+    merged: Dict[tuple, list] = {}
+    for rows in results:
+        for key, n, s, v in rows:
+            row = merged.get(key)
+            if row is None:
+                merged[key] = [n, _sketch(s), _sketch(v)]
+            else:
+                row[0] += n
+                row[1].update(_sketch(s))
+                row[2].update(_sketch(v))
+    return [{**dict(zip(by, key)), "count": n, "sessions": s.count(), "visitors": v.count()} for key, (n, s, v) in merged.items()]
+
+
+async def distinct_counts(start: datetime, end: datetime, by: List[str], match: Optional[Dict] = None, exact: bool = False) -> List[dict]:
+    """Events plus distinct sessions and visitors in [start, end] grouped by
+    `by` — one of SKETCH_GROUPS, optionally with "date"/"hour".
+
+    Counts come from merged HLL sketches (exact up to hll.SPARSE_MAX ids per
+    row, ~1% error beyond); `exact=True` scans raw events with $addToSet.
+    `match` may only filter on the group's dimensions. Rows are
+    {<by keys>..., count, sessions, visitors}."""
+    start, end = _aware(start), _aware(end)
+    group = tuple(k for k in by if k not in TIME_KEYS)
+    if group not in SKETCH_GROUPS:
+        raise ValueError(f"no HLL sketches for {group}")
+    if exact:
+        rows = await _raw_distinct(start, end, True, by, match)
+        return [{**dict(zip(by, key)), "count": n, "sessions": len(sessions), "visitors": len(visitors)} for key, n, sessions, visitors in rows]
+    time_keyed = any(k in TIME_KEYS for k in by)
+    segments = _segments(start, end, await rolled_until(), hourly_only="hour" in by, monthly=not time_keyed)
+    results = await asyncio.gather(*(
+        _sketch_segment(source, lo, hi, hi_inclusive, by, group, match)
+        for source, lo, hi, hi_inclusive in segments
+    ))
+    return await asyncio.to_thread(_merge_distinct, results, by)
+
+
+if __name__ == "__main__":
+    import sys
+    if "--rebuild" in sys.argv:
+        print(f"rolled {asyncio.run(rebuild())} hours")
+    else:
+        print(f"rolled {asyncio.run(roll_pending())} hours")
@@ -0,0 +1,162 @@
+"""Per-event-name counters behind the events-health and tracking-verify pages.
+
+`db.event_stats` holds one document per event_name:
+
+    {event_name, total, last_seen, hours: {"2026-10-18T14": 37, ...}}
+
+It is maintained by an `event_buffer` flush hook — each stored batch becomes
+one `$inc`/`$max` upsert per event name — so reading health for every tracked
+event is a single indexed `find`, independent of how many events exist.
+`hours` keeps hourly counts for the last EVENT_STATS_KEEP_DAYS days; older
+buckets are pruned in the background.
+
+On first start one worker seeds the table from `db.events` with one
+aggregation, under a seed_claim cutoff so the seed and the live hooks add up
+instead of overwriting each other. `python event_stats.py` clears and
+re-seeds it the same way; run it with ingestion paused, since running
+workers keep counting from the old cutoff.
+"""
+import time
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional
+
+from pymongo import UpdateOne
+
+import seed_claim
+from admin_routes import db
+from event_buffer import event_buffer
+
+logger = logging.getLogger(__name__)
+
+EVENT_STATS_KEEP_DAYS = 8
+PRUNE_INTERVAL_SECONDS = 3600
+_SEEDED_KEY = "event_stats_seeded"
+_HOUR_FMT = "%Y-%m-%dT%H"
+
+_last_prune = 0.0
+_as_of: Optional[datetime] = None   # seed cutoff: earlier events came from the seed
+
+
+def _aware(dt: Optional[datetime]) -> Optional[datetime]:
+    return dt.replace(tzinfo=timezone.utc) if dt and dt.tzinfo is None else dt
+
+
+@event_buffer.on_flush
+async def record_events(docs: List[dict]):
+    """Fold one stored batch of events into the counters."""
+    totals: Dict[str, int] = defaultdict(int)
+    last_seen: Dict[str, datetime] = {}
+    hours: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+    for doc in docs:
+        if not seed_claim.counts(doc, _as_of):
+            continue
+        name = doc.get("event_name")
+        ts = doc.get("server_timestamp")
+        if not name or not isinstance(ts, datetime):
+            continue
+        totals[name] += 1
+        hours[name][ts.strftime(_HOUR_FMT)] += 1
+        if name not in last_seen or ts > last_seen[name]:
+            last_seen[name] = ts
+    if not totals:
+        return
+    ops = [
+        UpdateOne(
+            {"event_name": name},
+            {"$inc": {"total": n, **{f"hours.{h}": c for h, c in hours[name].items()}}, "$max": {"last_seen": last_seen[name]}},
+            upsert=True,
+        )
+        for name, n in totals.items()
+    ]
+    await db.event_stats.bulk_write(ops, ordered=False)
+    if time.monotonic() - _last_prune > PRUNE_INTERVAL_SECONDS:
+        asyncio.create_task(_prune_quietly())
+
+
+async def prune():
+    """Drop hourly buckets older than EVENT_STATS_KEEP_DAYS."""
+    global _last_prune
+    _last_prune = time.monotonic()
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=EVENT_STATS_KEEP_DAYS)).strftime(_HOUR_FMT)
+    async for doc in db.event_stats.find({}, {"event_name": 1, "hours": 1}):
+        stale = [h for h in (doc.get("hours") or {}) if h < cutoff]
+        if stale:
+            await db.event_stats.update_one({"_id": doc["_id"]}, {"$unset": {f"hours.{h}": "" for h in stale}})
+
+
+async def _prune_quietly():
+    try:
+        await prune()
+    except Exception as e:
+        logger.error(f"event_stats prune failed: {e}")
+
+
+async def _seed(before: datetime) -> int:
+    """Add every event before `before` to the counters (one aggregation each)."""
+    since = datetime.now(timezone.utc) - timedelta(days=EVENT_STATS_KEEP_DAYS)
+    totals = await db.events.aggregate([
+        {"$match": {"server_timestamp": {"$lt": before}}},
+        {"$group": {"_id": "$event_name", "total": {"$sum": 1}, "last_seen": {"$max": "$server_timestamp"}}},
+    ], allowDiskUse=True).to_list(None)
+    recent = await db.events.aggregate([
+        {"$match": {"server_timestamp": {"$gte": since, "$lt": before}}},
+        {"$group": {"_id": {"name": "$event_name", "hour": {"$dateToString": {"format": _HOUR_FMT, "date": "$server_timestamp"}}}, "n": {"$sum": 1}}},
+    ], allowDiskUse=True).to_list(None)
+    hours: Dict[str, Dict[str, int]] = defaultdict(dict)
+    for r in recent:
+        hours[r["_id"]["name"]][r["_id"]["hour"]] = r["n"]
+    # Same operators as record_events, so hooks running meanwhile add up.
+    ops = [
+        UpdateOne(
+            {"event_name": t["_id"]},
+            {"$inc": {"total": t["total"], **{f"hours.{h}": n for h, n in hours.get(t["_id"], {}).items()}}, "$max": {"last_seen": t["last_seen"]}},
+            upsert=True,
+        )
+        for t in totals if t["_id"]
+    ]
+    if ops:
+        await db.event_stats.bulk_write(ops, ordered=False)
+    logger.info(f"Seeded {len(ops)} event counters")
+    return len(ops)
+
+
+async def ensure_seeded(background: bool = True):
+    """Index the table; the worker that claims the seed fills it from db.events
+    (in the background unless `background` is False)."""
+    global _as_of
+    try:
+        await db.event_stats.create_index("event_name", unique=True)
+    except Exception:
+        pass
+    claimed, _as_of = await seed_claim.claim(_SEEDED_KEY)
+    if claimed:
+        await seed_claim.run(_SEEDED_KEY, _as_of, _seed, background=background)
+
+
+async def rebuild() -> int:
+    """Clear the counters and re-seed them from db.events."""
+    await seed_claim.reset(_SEEDED_KEY)
+    await db.event_stats.delete_many({})
+    await ensure_seeded(background=False)
+    return await db.event_stats.count_documents({})
+
+
+async def event_health(names: List[str]) -> Dict[str, dict]:
+    """{event_name: {total, last_seen, last_7d}} for the given names."""
+    now = datetime.now(timezone.utc)
+    since = (now - timedelta(days=7)).strftime(_HOUR_FMT)
+    out = {}
+    async for doc in db.event_stats.find({"event_name": {"$in": names}}, {"_id": 0}):
+        out[doc["event_name"]] = {
+            "total": doc.get("total", 0),
+            "last_seen": _aware(doc.get("last_seen")),
+            "last_7d": sum(n for h, n in (doc.get("hours") or {}).items() if h >= since),
+        }
+    return out
+
+
+if __name__ == "__main__":
+    print(f"rebuilt {asyncio.run(rebuild())} event counters")
@@ -0,0 +1,156 @@
+"""Streaming CSV / JSONL exports for admin datasets.
+
+Rows are read from a Motor cursor with a narrow projection and encoded in
+~64 KB chunks as they arrive, so an export of any size holds only one chunk in
+memory and the first bytes reach the client as soon as the query returns its
+first batch. Output can be gzip-compressed on the fly.
+
+    return export_response("events", query, fields=["event_name", "geo.country"], fmt="jsonl", compress=True)
+
+EXPORT_DATASETS lists what can be exported, each with its collection, time
+field (for date filters and ordering), default columns and the equality
+filters it accepts. Columns may be dotted paths into nested documents.
+"""
+import csv
+import io
+import json
+import re
+import zlib
+from datetime import datetime
+from typing import AsyncIterator, Iterable, List, Optional
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+from admin_routes import db
+
+CHUNK_BYTES = 64 * 1024
+CURSOR_BATCH = 1000
+
+EXPORT_DATASETS = {
+    "leads": {
+        "collection": "leads",
+        "time_field": "created_at",
+        "fields": ["lead_id", "first_name", "phone", "email", "product_type", "diamond_shape", "carat_range", "priority", "metal", "budget", "status", "created_at", "notes"],
+        "filters": ["status", "product_type"],
+    },
+    "shop_orders": {
+        "collection": "shop_orders",
+        "time_field": "created_at",
+        "fields": ["order_id", "invoice_number", "email", "amount", "currency", "status", "fulfillment_status", "items", "created_at"],
+        "filters": ["status", "fulfillment_status"],
+    },
+    "events": {
+        "collection": "events",
+        "time_field": "server_timestamp",
+        "fields": ["server_timestamp", "event_name", "session_id", "anonymous_id", "wizard_step", "step_time_ms", "ua_parsed.device", "ua_parsed.browser", "ua_parsed.os", "geo.country", "geo.city", "attribution.utm_source", "attribution.utm_campaign", "attribution.referrer_url", "attribution.landing_url"],
+        "filters": ["event_name", "session_id", "anonymous_id"],
+    },
+    "message_threads": {
+        "collection": "message_threads",
+        "time_field": "updated_at",
+        "fields": ["thread_id", "user_name", "user_email", "user_phone", "project_slug", "project_title", "status", "admin_unread_count", "created_at", "updated_at"],
+        "filters": ["status", "project_slug"],
+    },
+}
+FORMATS = {"csv": ("text/csv", "csv"), "jsonl": ("application/x-ndjson", "jsonl")}
+
+_FIELD_RE = re.compile(r"^[A-Za-z][A-Za-z0-9_]*(\.[A-Za-z0-9_]+)*$")
+
+
+def parse_fields(raw: Optional[str], default: List[str]) -> List[str]:
+    """Comma-separated column list (dotted paths allowed) or the default set."""
+    if not raw:
+        return list(default)
+    fields = [f.strip() for f in raw.split(",") if f.strip()]
+    bad = [f for f in fields if not _FIELD_RE.match(f)]
+    if bad or not fields:
+        raise HTTPException(status_code=400, detail=f"Invalid export fields: {', '.join(bad) or raw}")
+    return list(dict.fromkeys(fields))
+
+
+def projection(fields: Iterable[str]) -> dict:
+    """Narrow projection; a child path is dropped when its parent is selected
+    (Mongo rejects overlapping paths)."""
+    fields = sorted(set(fields))
+    keep = [f for f in fields if not any(f.startswith(p + ".") for p in fields if p != f)]
+    return {"_id": 0, **{f: 1 for f in keep}}
+
+
+def _get(doc: dict, path: str):
+    value = doc
+    for part in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def _plain(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return {k: _plain(v) for k, v in value.items() if k != "_id"}
+    if isinstance(value, list):
+        return [_plain(v) for v in value]
+    return value
+
+
+def _csv_cell(value):
+    value = _plain(value)
+    if value is None:
+        return ""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, separators=(",", ":"), default=str)
+    return value
+
+
+async def stream_rows(cursor, fields: List[str], fmt: str = "csv", compress: bool = False) -> AsyncIterator[bytes]:
+    """Encode cursor rows as CSV/JSONL chunks (optionally gzip)."""
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buf = io.StringIO()
+    writer = csv.writer(buf) if fmt == "csv" else None
+    if writer:
+        writer.writerow(fields)
+
+    def take() -> bytes:
+        data = buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate()
+        return gz.compress(data) if gz else data
+
+    async for doc in cursor:
+        if writer:
+            writer.writerow([_csv_cell(_get(doc, f)) for f in fields])
+        else:
+            buf.write(json.dumps({f: _plain(_get(doc, f)) for f in fields}, default=str))
+            buf.write("\n")
+        if buf.tell() >= CHUNK_BYTES:
+            chunk = take()
+            if chunk:
+                yield chunk
+    tail = take()
+    if gz:
+        tail += gz.flush()
+    if tail:
+        yield tail
+
+
+def export_response(dataset: str, query: dict, fields: List[str], fmt: str = "csv", compress: bool = False, limit: int = 0, filename: Optional[str] = None) -> StreamingResponse:
+    spec = EXPORT_DATASETS.get(dataset)
+    if not spec:
+        raise HTTPException(status_code=404, detail="Unknown export dataset")
+    if fmt not in FORMATS:
+        raise HTTPException(status_code=400, detail="format must be csv or jsonl")
+    cursor = db[spec["collection"]].find(query, projection(fields)).sort(spec["time_field"], -1).batch_size(CURSOR_BATCH)
+    if limit:
+        cursor = cursor.limit(limit)
+    media_type, ext = FORMATS[fmt]
+    filename = filename or f"{dataset}_export_{datetime.now().strftime('%Y%m%d')}.{ext}"
+    if compress:
+        media_type, filename = "application/gzip", filename + ".gz"
+    return StreamingResponse(
+        stream_rows(cursor, fields, fmt, compress),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
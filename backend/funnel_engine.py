@@ -0,0 +1,251 @@
+"""Session-sequenced funnel engine for the wizard.
+
+A background job reads new funnel events in `server_timestamp` order from a
+checkpoint (`db.settings {key: "funnel_state"}`) and appends them to one
+`db.funnel_sessions` document per session:
+
+    {session_id, first_ts, last_ts, steps: [{s: "tlj_step_view:shape", t: <ts>}, ...]}
+
+`s` is the event name, suffixed with the wizard step for per-step events.
+Appends are `$push` with `$sort` on `t`, so late events still land in order.
+Each pass handles a bounded batch and then moves the checkpoint forward.
+
+`evaluate(start, end, steps)` streams the sessions that started in the window
+and walks each one against a funnel definition — an ordered list of tokens,
+where "tlj_step_view" matches any step view and "tlj_step_view:shape" only
+that step:
+
+- strict conversion: a step counts only after the previous step was reached
+  in the same session, and consecutive repeats (page refreshes) collapse;
+- time between steps as p50/p90 (quantile_sketch);
+- drop-off paths: where sessions that stopped after a step went next.
+
+Memory stays flat however many sessions are in the window: only counters
+and sketches are kept. Results are cached per (window, definition,
+checkpoint), so a new pass invalidates them.
+"""
+import os
+import re
+import uuid
+import asyncio
+import logging
+from collections import Counter, defaultdict
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional
+
+from fastapi import HTTPException
+from pymongo import UpdateOne
+
+from admin_routes import db
+from quantile_sketch import bucket, quantiles
+from ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+FUNNEL_INTERVAL_SECONDS = float(os.environ.get("FUNNEL_INTERVAL_SECONDS", "60"))
+# Events this recent are left for the next pass, so buffered writes land first.
+FUNNEL_LAG = timedelta(minutes=2)
+FUNNEL_BATCH = 20000
+MAX_SESSION_STEPS = 500
+FUNNEL_LEASE = timedelta(minutes=5)
+_STATE_KEY = "funnel_state"
+
+# Events that make up session sequences; these also carry their wizard step.
+FUNNEL_EVENTS = [
+    "tlj_landing_view", "tlj_session_start", "tlj_wizard_start", "tlj_step_view", "tlj_step_complete",
+    "tlj_step_abandon", "tlj_step_back", "tlj_value_reveal_view", "tlj_contact_submit_attempt", "tlj_lead_created",
+]
+_STEP_EVENTS = {"tlj_step_view", "tlj_step_complete", "tlj_step_abandon"}
+DEFAULT_FUNNEL = ["tlj_session_start", "tlj_wizard_start", "tlj_value_reveal_view", "tlj_contact_submit_attempt", "tlj_lead_created"]
+
+_TOKEN_RE = re.compile(r"^[A-Za-z0-9_.\-]+(:[A-Za-z0-9_.\-]+)?$")
+_results = TTLCache("funnel_sequences", maxsize=256, ttl=600)
+_owner = uuid.uuid4().hex
+_task = None
+
+
+def _aware(dt: Optional[datetime]) -> Optional[datetime]:
+    return dt.replace(tzinfo=timezone.utc) if dt and dt.tzinfo is None else dt
+
+
+def step_token(event: dict) -> str:
+    name = event.get("event_name")
+    step = event.get("wizard_step")
+    return f"{name}:{step}" if name in _STEP_EVENTS and step else name
+
+
+async def ensure_indexes():
+    await db.funnel_sessions.create_index("session_id", unique=True)
+    await db.funnel_sessions.create_index("first_ts")
+
+
+async def checkpoint() -> Optional[datetime]:
+    state = await db.settings.find_one({"key": _STATE_KEY}, {"_id": 0, "checkpoint": 1})
+    return _aware((state or {}).get("checkpoint"))
+
+
+# ── Sequencing ───────────────────────────────────────────────
+
+async def _acquire_lease(now: datetime) -> bool:
+    await db.settings.update_one({"key": _STATE_KEY}, {"$setOnInsert": {"key": _STATE_KEY, "lease_until": now - FUNNEL_LEASE}}, upsert=True)
+    res = await db.settings.update_one(
+        {"key": _STATE_KEY, "$or": [{"lease_until": {"$lt": now}}, {"lease_owner": _owner}]},
+        {"$set": {"lease_until": now + FUNNEL_LEASE, "lease_owner": _owner}},
+    )
+    return res.modified_count == 1
+
+
+async def _release_lease():
+    await db.settings.update_one({"key": _STATE_KEY, "lease_owner": _owner}, {"$set": {"lease_until": datetime.now(timezone.utc)}})
+
+
+async def sequence_pending() -> int:
+    """Append the next batch of events past the checkpoint to their sessions.
+    Returns the number of events sequenced; 0 if another worker holds the lease."""
+    now = datetime.now(timezone.utc)
+    if not await _acquire_lease(now):
+        return 0
+    try:
+        since = await checkpoint()
+        query = {"event_name": {"$in": FUNNEL_EVENTS}, "server_timestamp": {"$lte": now - FUNNEL_LAG}}
+        if since:
+            query["server_timestamp"]["$gt"] = since
+        events = await db.events.find(
+            query, {"_id": 0, "session_id": 1, "event_name": 1, "wizard_step": 1, "server_timestamp": 1}
+        ).sort("server_timestamp", 1).limit(FUNNEL_BATCH).to_list(FUNNEL_BATCH)
+        if not events:
+            return 0
+        last_ts = events[-1]["server_timestamp"]
+        if len(events) == FUNNEL_BATCH and events[0]["server_timestamp"] != last_ts:
+            # The batch may have cut through a timestamp; leave it whole for the next pass.
+            events = [e for e in events if e["server_timestamp"] != last_ts]
+            last_ts = events[-1]["server_timestamp"]
+        per_session: Dict[str, list] = defaultdict(list)
+        for e in events:
+            if e.get("session_id"):
+                per_session[e["session_id"]].append({"s": step_token(e), "t": e["server_timestamp"]})
+        ops = [
+            UpdateOne(
+                {"session_id": sid},
+                {
+                    "$push": {"steps": {"$each": steps, "$sort": {"t": 1}, "$slice": -MAX_SESSION_STEPS}},
+                    "$min": {"first_ts": steps[0]["t"]},
+                    "$max": {"last_ts": steps[-1]["t"]},
+                },
+                upsert=True,
+            )
+            for sid, steps in per_session.items()
+        ]
+        if ops:
+            await db.funnel_sessions.bulk_write(ops, ordered=False)
+        await db.settings.update_one({"key": _STATE_KEY}, {"$set": {"checkpoint": last_ts, "updated_at": datetime.now(timezone.utc)}})
+        return len(events)
+    finally:
+        await _release_lease()
+
+
+async def rebuild():
+    """Drop all sequences and re-sequence history."""
+    await db.funnel_sessions.delete_many({})
+    await db.settings.update_one({"key": _STATE_KEY}, {"$unset": {"checkpoint": ""}})
+    total = 0
+    while True:
+        n = await sequence_pending()
+        total += n
+        if n == 0:
+            return total
+
+
+async def _run():
+    while True:
+        try:
+            while await sequence_pending():
+                pass   # backfill: keep going until caught up
+        except Exception as e:
+            logger.error(f"funnel sequencing pass failed: {e}")
+        await asyncio.sleep(FUNNEL_INTERVAL_SECONDS)
+
+
+def start():
+    global _task
+    if _task is None:
+        _task = asyncio.create_task(_run())
+
+
+async def stop():
+    global _task
+    if _task:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+
+
+# ── Evaluation ───────────────────────────────────────────────
+
+def parse_definition(raw: Optional[str]) -> List[str]:
+    """Comma-separated step tokens (2-12), or the default funnel."""
+    if not raw:
+        return list(DEFAULT_FUNNEL)
+    steps = [s.strip() for s in raw.split(",") if s.strip()]
+    if not 2 <= len(steps) <= 12 or not all(_TOKEN_RE.match(s) for s in steps):
+        raise HTTPException(status_code=400, detail="steps must be 2-12 comma-separated event tokens (event_name or event_name:wizard_step)")
+    return steps
+
+def _matches(token: str, wanted: str) -> bool:
+    return token == wanted or (":" not in wanted and token.split(":", 1)[0] == wanted)
+
+
+async def _evaluate(start: datetime, end: datetime, steps: List[str]) -> dict:
+    reached = [0] * len(steps)
+    gaps = [dict() for _ in steps]          # step k -> time-from-previous sketch
+    drop_offs = [Counter() for _ in steps]  # step k -> next token for sessions that stopped there
+    sessions = 0
+    cursor = db.funnel_sessions.find({"first_ts": {"$gte": start, "$lte": end}}, {"_id": 0, "steps": 1}).batch_size(1000)
+    async for doc in cursor:
+        sessions += 1
+        seq, prev = [], None
+        for entry in doc.get("steps") or []:
+            if entry["s"] != prev and _aware(entry["t"]) <= end:
+                seq.append(entry)
+            prev = entry["s"]
+        k, last_t, stop_at = 0, None, -1
+        for i, entry in enumerate(seq):
+            if k < len(steps) and _matches(entry["s"], steps[k]):
+                reached[k] += 1
+                if last_t is not None:
+                    b = bucket((entry["t"] - last_t).total_seconds() * 1000)
+                    if b is not None:
+                        gaps[k][b] = gaps[k].get(b, 0) + 1
+                last_t, stop_at, k = entry["t"], i, k + 1
+        if 0 < k < len(steps):
+            drop_offs[k - 1][seq[stop_at + 1]["s"] if stop_at + 1 < len(seq) else "exit"] += 1
+    out = []
+    for k, step in enumerate(steps):
+        q = quantiles(gaps[k], (0.5, 0.9)) if k else {}
+        prev = reached[k - 1] if k else reached[0]
+        out.append({
+            "step": step,
+            "sessions": reached[k],
+            "conversion_from_prev": round(reached[k] / prev * 100, 1) if prev else 0,
+            "conversion_from_start": round(reached[k] / reached[0] * 100, 1) if reached[0] else 0,
+            "time_from_prev_sec": {"p50": round(q.get(0.5, 0) / 1000, 1), "p90": round(q.get(0.9, 0) / 1000, 1)} if k else None,
+            "drop_offs": [{"next": token, "sessions": n} for token, n in drop_offs[k].most_common(5)],
+        })
+    return {"sessions": sessions, "steps": out}
+
+
+async def evaluate(start: datetime, end: datetime, steps: Optional[List[str]] = None) -> dict:
+    """Strict ordered funnel over sessions that started in [start, end]."""
+    steps = list(steps or DEFAULT_FUNNEL)
+    start, end = _aware(start).replace(second=0, microsecond=0), _aware(end).replace(second=0, microsecond=0)
+    cp = await checkpoint()
+    key = (start, end, tuple(steps), cp)
+    result = await _results.get_or_load(key, lambda: _evaluate(start, end, steps))
+    return {**result, "definition": steps, "sequenced_until": cp.isoformat() if cp else None}
+
+
+if __name__ == "__main__":
+    print(f"sequenced {asyncio.run(rebuild())} events")
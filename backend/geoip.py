@@ -0,0 +1,227 @@
+"""IP → geo resolution for analytics events.
+
+Lookups go to a local MaxMind-format database (GeoLite2-City / GeoIP2-City
+.mmdb, memory-mapped), so resolving an event's location takes microseconds and
+never waits on a third party. Put the file at GEOIP_DB_PATH (e.g. with
+MaxMind's `geoipupdate`); GEOIP_ASN_DB_PATH optionally adds the ISP name from a
+GeoLite2-ASN database.
+
+ip-api.com is kept as a background enricher: IPs the local database can't
+place are queued, looked up at most ~40/min (their free-tier limit is 45),
+and the recent events for that IP are patched in place. Event ingestion never
+awaits it. GEOIP_HTTP_ENRICH=1 always runs it, =0 never does, and by default
+("auto") it runs only when the city database is missing, so a deploy without
+the .mmdb still gets geo instead of "Unknown" everywhere (an error is logged
+at startup if neither source is available).
+
+A patch covers events already stored and events still in the write buffer
+(event_buffer.patch_pending). Hourly rollups and sketches that were already
+rolled with "Unknown" for those events are re-rolled from the earliest patched
+hour (event_rollups.request_reroll); nothing else derived from events keys on
+geo.
+
+The `geo` shape stored on events is unchanged:
+{country, region, city, timezone, lat, lon, isp}.
+"""
+import os
+import asyncio
+import ipaddress
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import Optional
+
+from ttl_cache import TTLCache
+
+try:
+    import maxminddb
+except ImportError:  # optional dependency — geo falls back to "Unknown"
+    maxminddb = None
+
+logger = logging.getLogger(__name__)
+
+GEOIP_DB_PATH = os.environ.get("GEOIP_DB_PATH", "/app/backend/geoip/GeoLite2-City.mmdb")
+GEOIP_ASN_DB_PATH = os.environ.get("GEOIP_ASN_DB_PATH", "")
+GEOIP_HTTP_ENRICH = os.environ.get("GEOIP_HTTP_ENRICH", "auto").lower()   # "1" / "0" / "auto"
+IP_API_MIN_INTERVAL = 1.5   # seconds between ip-api.com calls (~40/min)
+ENRICH_LOOKBACK = timedelta(hours=1)
+
+UNKNOWN_GEO = {"country": "Unknown", "region": "", "city": "", "timezone": "", "lat": 0, "lon": 0, "isp": ""}
+
+_readers = None
+_geo_cache = TTLCache("geoip", maxsize=20000, ttl=86400)   # ip -> geo (local db or enricher)
+_queue: Optional[asyncio.Queue] = None
+_queued: set = set()
+_enricher = None
+_http_enrich = False
+
+
+def _open_readers() -> dict:
+    global _readers
+    if _readers is not None:
+        return _readers
+    _readers = {}
+    if maxminddb is None:
+        logger.warning("maxminddb not installed — GeoIP lookups disabled")
+        return _readers
+    for name, path in (("city", GEOIP_DB_PATH), ("asn", GEOIP_ASN_DB_PATH)):
+        if not path:
+            continue
+        try:
+            _readers[name] = maxminddb.open_database(path, maxminddb.MODE_MMAP)
+            logger.info(f"GeoIP {name} database loaded from {path}")
+        except (OSError, ValueError) as e:
+            logger.warning(f"GeoIP {name} database unavailable at {path}: {e}")
+    return _readers
+
+
+def _name(rec: dict, key: str) -> str:
+    return ((rec.get(key) or {}).get("names") or {}).get("en", "")
+
+
+def lookup(ip: str) -> Optional[dict]:
+    """Geo for a public IP from the local database, or None if unknown."""
+    readers = _open_readers()
+    city_db = readers.get("city")
+    if not city_db:
+        return None
+    try:
+        rec = city_db.get(ip)
+    except ValueError:
+        return None
+    if not rec or not rec.get("country"):
+        return None
+    loc = rec.get("location") or {}
+    subdivisions = rec.get("subdivisions") or [{}]
+    isp = ""
+    if readers.get("asn"):
+        asn = readers["asn"].get(ip) or {}
+        isp = asn.get("autonomous_system_organization", "")
+    return {
+        "country": _name(rec, "country") or "Unknown",
+        "region": ((subdivisions[0].get("names") or {}).get("en", "")),
+        "city": _name(rec, "city"),
+        "timezone": loc.get("time_zone", ""),
+        "lat": loc.get("latitude", 0),
+        "lon": loc.get("longitude", 0),
+        "isp": isp,
+    }
+
+
+def _is_public(ip: str) -> bool:
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    return not (addr.is_private or addr.is_loopback or addr.is_reserved or addr.is_link_local)
+
+
+def resolve(ip: str) -> dict:
+    """Geo for an event. Synchronous and local; never blocks on the network."""
+    if not ip or not _is_public(ip):
+        return dict(UNKNOWN_GEO)
+    geo = _geo_cache.get(ip)
+    if geo is None:
+        geo = lookup(ip)
+        if geo:
+            _geo_cache.set(ip, geo)
+    if geo:
+        return dict(geo)
+    if _http_enrich:
+        _enqueue(ip)
+    return dict(UNKNOWN_GEO)
+
+
+# ── Optional ip-api.com background enricher ──────────────────
+
+def _enqueue(ip: str):
+    if _queue is None or ip in _queued or _queue.full():
+        return
+    _queued.add(ip)
+    _queue.put_nowait(ip)
+
+
+async def _fetch_ip_api(http, ip: str) -> Optional[dict]:
+    resp = await http.get(f"http://ip-api.com/json/{ip}?fields=status,country,regionName,city,timezone,lat,lon,isp")
+    if resp.status_code != 200:
+        return None
+    data = resp.json()
+    if data.get("status") != "success":
+        return None
+    return {"country": data.get("country", "Unknown"), "region": data.get("regionName", ""), "city": data.get("city", ""), "timezone": data.get("timezone", ""), "lat": data.get("lat", 0), "lon": data.get("lon", 0), "isp": data.get("isp", "")}
+
+
+def _patch_buffered(ip: str, geo: dict):
+    def patch(doc: dict) -> bool:
+        if doc.get("ip") != ip or (doc.get("geo") or {}).get("country") != "Unknown":
+            return False
+        doc["geo"] = dict(geo)
+        return True
+    return patch
+
+
+async def _patch_events(db, ip: str, geo: dict):
+    """Give recent "Unknown" events from `ip` their resolved geo — buffered
+    and stored ones — and re-roll any rollup hours they were counted in."""
+    from event_buffer import event_buffer
+    import event_rollups
+    event_buffer.patch_pending(_patch_buffered(ip, geo))
+    query = {"server_timestamp": {"$gte": datetime.now(timezone.utc) - ENRICH_LOOKBACK}, "ip": ip, "geo.country": "Unknown"}
+    first = await db.events.find_one(query, {"_id": 0, "server_timestamp": 1}, sort=[("server_timestamp", 1)])
+    if not first:
+        return
+    await db.events.update_many(query, {"$set": {"geo": geo}})
+    watermark = await event_rollups.rolled_until()
+    first_ts = first["server_timestamp"]
+    if first_ts.tzinfo is None:
+        first_ts = first_ts.replace(tzinfo=timezone.utc)
+    if watermark and first_ts < watermark:
+        await event_rollups.request_reroll(first_ts)
+
+
+async def _enrich_loop():
+    import httpx
+    from admin_routes import db
+    async with httpx.AsyncClient(timeout=3) as http:
+        while True:
+            ip = await _queue.get()
+            try:
+                geo = await _fetch_ip_api(http, ip)
+                if geo:
+                    _geo_cache.set(ip, geo)
+                    await _patch_events(db, ip, geo)
+            except Exception as e:
+                logger.debug(f"ip-api enrichment failed for {ip}: {e}")
+            finally:
+                _queued.discard(ip)
+            await asyncio.sleep(IP_API_MIN_INTERVAL)
+
+
+def start_enricher():
+    """Start the ip-api.com enricher when GEOIP_HTTP_ENRICH asks for it (by
+    default: when the city database is missing)."""
+    global _queue, _enricher, _http_enrich
+    has_city = "city" in _open_readers()
+    if GEOIP_HTTP_ENRICH in ("1", "true", "yes"):
+        _http_enrich = True
+    elif GEOIP_HTTP_ENRICH in ("0", "false", "no"):
+        _http_enrich = False
+        if not has_city:
+            logger.error(f"No GeoIP city database at {GEOIP_DB_PATH} and GEOIP_HTTP_ENRICH is off — every event will get geo \"Unknown\"")
+    else:
+        _http_enrich = not has_city
+        if _http_enrich:
+            logger.warning(f"No GeoIP city database at {GEOIP_DB_PATH} — falling back to the ip-api.com enricher")
+    if _http_enrich and _enricher is None:
+        _queue = asyncio.Queue(maxsize=1000)
+        _enricher = asyncio.create_task(_enrich_loop())
+
+
+async def stop_enricher():
+    global _enricher
+    if _enricher:
+        _enricher.cancel()
+        try:
+            await _enricher
+        except asyncio.CancelledError:
+            pass
+        _enricher = None
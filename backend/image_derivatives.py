@@ -0,0 +1,242 @@
+"""Responsive image derivatives (fixed widths, WebP/AVIF) for uploaded media.
+
+Every raster image stored through `storage.upload_file` gets a fixed set of
+resized, re-encoded copies stored alongside the original:
+
+    thelocaljewel/projects/<uuid>.jpg            original
+    thelocaljewel/projects/<uuid>.jpg.w640.webp  derivative
+
+They are rendered in the background once an upload request has fully
+succeeded and, for images that predate this module, lazily on first request of
+`?w=<width>&fm=<format>` on the cloud proxy. Resizing runs in a small process
+pool so Pillow never competes with the event loop. `delete(path)` removes an
+original together with its derivatives.
+
+The original's (EXIF-rotated) size is kept in `db.image_derivatives`
+{path, width, height} so `srcset(url, width=...)` never advertises a width the
+original can't fill; `sources(url, width=...)` adds one srcset per format
+(AVIF first when this Pillow can encode it) for a <picture> element.
+`original_widths(urls)` loads the widths for a set of cloud URLs.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set, Tuple
+
+from PIL import features
+
+from storage import delete_object, download_file, object_exists, put_object
+
+logger = logging.getLogger(__name__)
+
+WIDTHS = (320, 640, 960, 1440)
+FORMATS = ("avif", "webp") if features.check("avif") else ("webp",)
+DEFAULT_FORMAT = "webp"
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", "2"))
+
+CLOUD_URL_PREFIX = "/api/uploads/cloud/"
+_RASTER_EXTS = {"jpg", "jpeg", "png", "webp", "bmp", "tiff"}
+_DERIVATIVE_RE = re.compile(r"\.w\d+\.(webp|avif)$")
+_MIME = {"webp": "image/webp", "avif": "image/avif"}
+_ENCODE = {"webp": {"quality": 80, "method": 4}, "avif": {"quality": 55}}
+
+_pool = None
+_done: "OrderedDict[str, bool]" = OrderedDict()   # originals whose set is stored
+_inflight: Dict[str, asyncio.Future] = {}
+_background: Set[asyncio.Task] = set()   # strong refs so running renders aren't collected
+
+
+def is_raster(path: str) -> bool:
+    """Original raster image we can derive from (not a derivative itself)."""
+    ext = path.rsplit(".", 1)[-1].lower() if "." in path else ""
+    return ext in _RASTER_EXTS and not _DERIVATIVE_RE.search(path)
+
+
+def derivative_path(path: str, width: int, fmt: str) -> str:
+    return f"{path}.w{width}.{fmt}"
+
+
+def snap_width(width: int) -> int:
+    """Smallest configured width >= the requested one (largest if none)."""
+    return next((w for w in WIDTHS if w >= width), WIDTHS[-1])
+
+
+def srcset(url: str, fmt: str = DEFAULT_FORMAT, width: Optional[int] = None) -> List[dict]:
+    """srcset-ready derivative list for a cloud-proxy URL ([] for anything else).
+    With the original's `width`, sizes it can't fill collapse into one entry
+    at its real width (derivatives are never upscaled)."""
+    if not url or not url.startswith(CLOUD_URL_PREFIX) or not is_raster(url):
+        return []
+    out = []
+    for w in WIDTHS:
+        if width and w >= width:
+            out.append({"url": f"{url}?w={w}&fm={fmt}", "width": width, "type": _MIME[fmt]})
+            break
+        out.append({"url": f"{url}?w={w}&fm={fmt}", "width": w, "type": _MIME[fmt]})
+    return out
+
+
+def sources(url: str, width: Optional[int] = None) -> List[dict]:
+    """[{type, srcset}] per rendered format, best compression first."""
+    return [{"type": _MIME[fmt], "srcset": entries} for fmt in FORMATS if (entries := srcset(url, fmt, width))]
+
+
+def _path(url: str) -> str:
+    return url[len(CLOUD_URL_PREFIX):]
+
+
+async def original_widths(urls: List[str]) -> Dict[str, int]:
+    """url -> original width for the cloud-proxy image URLs we know the size of."""
+    from admin_routes import db
+    paths = {_path(u): u for u in urls if u and u.startswith(CLOUD_URL_PREFIX) and is_raster(u)}
+    if not paths:
+        return {}
+    return {
+        paths[doc["path"]]: doc["width"]
+        async for doc in db.image_derivatives.find({"path": {"$in": list(paths)}}, {"_id": 0, "path": 1, "width": 1})
+    }
+
+
+def _oriented_size(data: bytes) -> Tuple[int, int]:
+    """(width, height) after EXIF rotation, from the header only."""
+    from PIL import Image
+    img = Image.open(BytesIO(data))
+    w, h = img.size
+    if img.getexif().get(0x0112) in (5, 6, 7, 8):   # rotated 90/270
+        w, h = h, w
+    return w, h
+
+
+async def _save_size(path: str, width: int, height: int):
+    from admin_routes import db
+    await db.image_derivatives.update_one(
+        {"path": path},
+        {"$set": {"path": path, "width": width, "height": height, "updated_at": datetime.now(timezone.utc)}},
+        upsert=True,
+    )
+
+
+async def record_original(path: str, data: bytes):
+    """Store an uploaded original's size (best-effort) so cards built right
+    after the upload already get clamped srcsets."""
+    if not is_raster(path):
+        return
+    try:
+        await _save_size(path, *await asyncio.to_thread(_oriented_size, data))
+    except Exception as e:
+        logger.error(f"image size lookup failed for {path}: {e}")
+
+
+def _render(data: bytes, widths: tuple, formats: tuple) -> tuple:
+    """Runs in the process pool: ((width, height), [(width, fmt, bytes)]) for
+    every width x format. Never upscales — widths above the original are
+    rendered at full size."""
+    from PIL import Image, ImageOps
+    img = ImageOps.exif_transpose(Image.open(BytesIO(data)))
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if "transparency" in img.info or "A" in img.getbands() else "RGB")
+    out = []
+    for w in widths:
+        target = min(w, img.width)
+        resized = img if target == img.width else img.resize(
+            (target, max(1, round(img.height * target / img.width))), Image.LANCZOS,
+        )
+        for fmt in formats:
+            buf = BytesIO()
+            resized.save(buf, fmt.upper(), **_ENCODE[fmt])
+            out.append((w, fmt, buf.getvalue()))
+    return img.size, out
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn, not fork: the parent holds Motor/boto3 threads and sockets.
+        _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def _mark_done(path: str):
+    _done[path] = True
+    while len(_done) > 20000:
+        _done.popitem(last=False)
+
+
+async def _generate(path: str, data: bytes = None):
+    if data is None:
+        data, _ = await download_file(path)
+    loop = asyncio.get_running_loop()
+    size, rendered = await loop.run_in_executor(_get_pool(), _render, data, WIDTHS, FORMATS)
+    await asyncio.gather(*(
+        put_object(derivative_path(path, w, fmt), blob, _MIME[fmt]) for w, fmt, blob in rendered
+    ))
+    await _save_size(path, *size)
+    _mark_done(path)
+
+
+async def generate(path: str, data: bytes = None):
+    """Render and store the full derivative set for one original. Concurrent
+    calls for the same path share one render."""
+    pending = _inflight.get(path)
+    if pending is None:
+        pending = asyncio.ensure_future(_generate(path, data))
+        _inflight[path] = pending
+        pending.add_done_callback(lambda _: _inflight.pop(path, None))
+    await asyncio.shield(pending)
+
+
+async def _generate_quietly(path: str, data: bytes):
+    try:
+        await generate(path, data)
+    except Exception as e:
+        logger.error(f"image derivatives failed for {path}: {e}")
+
+
+def generate_in_background(path: str, data: bytes):
+    """Fire-and-forget derivative render after a successful upload."""
+    if is_raster(path):
+        task = asyncio.create_task(_generate_quietly(path, data))
+        _background.add(task)
+        task.add_done_callback(_background.discard)
+
+
+async def delete(path: str) -> bool:
+    """Delete an original and every derivative that may exist for it."""
+    from admin_routes import db
+    ok = await delete_object(path)
+    if is_raster(path):
+        pending = _inflight.get(path)
+        if pending is not None:
+            await asyncio.wait([pending])   # don't let a running render re-create them
+        await asyncio.gather(*(delete_object(derivative_path(path, w, fmt)) for w in WIDTHS for fmt in _MIME))
+        _done.pop(path, None)
+        try:
+            await db.image_derivatives.delete_one({"path": path})
+        except Exception as e:
+            logger.error(f"image size cleanup failed for {path}: {e}")
+    return ok
+
+
+def shutdown():
+    """Stop the render pool (lifespan shutdown)."""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+async def ensure(path: str, width: int, fmt: str = DEFAULT_FORMAT) -> str:
+    """Storage path of the requested derivative, rendering the set on first use."""
+    fmt = fmt if fmt in FORMATS else DEFAULT_FORMAT
+    target = derivative_path(path, snap_width(width), fmt)
+    if path in _done or await object_exists(target):
+        _mark_done(path)
+        return target
+    await generate(path)
+    return target
@@ -21,8 +21,12 @@ BUSINESS_DEFAULTS = {
 
 
 async def get_business(db) -> dict:
-    """Business details for invoice headers — editable in Admin → Settings."""
-    doc = await db.settings.find_one({"_type": "site_settings"}, {"_id": 0}) or {}
+    """Business details for invoice headers — editable in Admin → Settings.
+
+    Read from the same cached settings document the admin and public
+    settings endpoints use; `db` is kept for existing callers."""
+    from admin_routes import get_settings_doc
+    doc = await get_settings_doc()
     return {k: (doc.get(k) or v) for k, v in BUSINESS_DEFAULTS.items()}
 
 
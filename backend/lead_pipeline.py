@@ -0,0 +1,298 @@
+"""Staged post-processing for wizard lead submissions.
+
+`submit_lead` makes one write: `submit(lead)` upserts the lead together with
+the stages still to run (`pipeline_pending`) and when they are due
+(`pipeline_next_at`), and the handler returns a token. Background workers
+claim due leads atomically (the claim pushes `pipeline_next_at` out by
+LEAD_PIPELINE_CLAIM, which doubles as the lease) and run the stages in order:
+
+    score       lead_score / intent_bucket / quality_flags (lead_scoring rules)
+    link_user   find the user by phone/email or create one; sets lead.user_id
+    session     stamp the wizard session completed
+    notify      queue the admin "New Lead" email in the outbox
+    index       the lead's admin search entry (search_index)
+
+Every stage is idempotent, so a failed stage (or a worker that died mid-lead)
+is simply run again: finished stages are `$pull`ed from `pipeline_pending`,
+failures back off exponentially, and after LEAD_PIPELINE_MAX_ATTEMPTS the lead
+is marked `pipeline_failed` for the admin view. Writes are guarded by the
+lead's `submission_id`, so a resubmission restarts the stages cleanly.
+
+The submit token is minted for the provisional `pending_user_id` and carries
+the lead_id; `resolve_user` maps it to the linked user, running `link_user`
+inline if the workers haven't got there yet.
+"""
+import os
+import time
+import uuid
+import random
+import asyncio
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from admin_routes import db
+from lead_scoring import score_lead
+from outbox import channel_ready, enqueue_email
+from quantile_sketch import bucket, quantiles
+from search_index import index_lead
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("score", "link_user", "session", "notify", "index")
+LEAD_PIPELINE_WORKERS = int(os.environ.get("LEAD_PIPELINE_WORKERS", "2"))
+LEAD_PIPELINE_MAX_ATTEMPTS = 8
+LEAD_PIPELINE_BACKOFF_SECONDS = 15
+LEAD_PIPELINE_BACKOFF_MAX_SECONDS = 1800
+LEAD_PIPELINE_POLL_SECONDS = float(os.environ.get("LEAD_PIPELINE_POLL_SECONDS", "5"))
+LEAD_PIPELINE_CLAIM = timedelta(minutes=2)
+
+# stage -> {ok, failed, ms: duration sketch}; per process, reset on restart
+_metrics: Dict[str, dict] = {stage: {"ok": 0, "failed": 0, "ms": {}} for stage in STAGES}
+_wake = asyncio.Event()
+_tasks: List[asyncio.Task] = []
+
+
+async def submit(lead: dict):
+    """Persist a submitted lead and queue all of its stages."""
+    await db.leads.update_one(
+        {"lead_id": lead["lead_id"]},
+        {
+            "$set": {**lead, "pipeline_pending": list(STAGES), "pipeline_next_at": datetime.now(timezone.utc), "pipeline_attempts": 0},
+            "$unset": {"pipeline_failed": "", "pipeline_error": ""},
+        },
+        upsert=True,
+    )
+    _wake.set()
+
+
+# ── Stages ───────────────────────────────────────────────────
+
+async def score(lead: dict):
+    await db.leads.update_one({"lead_id": lead["lead_id"]}, {"$set": await score_lead(lead)})
+
+
+async def _find_user(lead: dict) -> Optional[dict]:
+    user = None
+    if lead.get("phone"):
+        user = await db.users.find_one({"phone": lead["phone"]})
+    if not user and lead.get("email"):
+        user = await db.users.find_one({"email": lead["email"]})
+    if not user and lead.get("pending_user_id"):
+        user = await db.users.find_one({"user_id": lead["pending_user_id"]})
+    return user
+
+
+async def link_user(lead: dict) -> str:
+    """Attach the lead to the user with its phone/email, creating one if needed."""
+    phone, email_val = lead.get("phone"), lead.get("email")
+    user = await _find_user(lead)
+    if user:
+        user_id = user["user_id"]
+        if email_val and not user.get("email"):
+            await db.users.update_one({"user_id": user_id}, {"$set": {"email": email_val}})
+    else:
+        user_id = lead.get("pending_user_id") or f"user_{uuid.uuid4().hex[:12]}"
+        user_doc = {"user_id": user_id, "first_name": lead.get("first_name"), "phone": phone, "created_at": datetime.now(timezone.utc)}
+        if email_val:
+            user_doc["email"] = email_val
+        try:
+            await db.users.insert_one(user_doc)
+        except DuplicateKeyError:
+            user = await _find_user(lead)
+            if user:
+                user_id = user["user_id"]
+    await db.leads.update_one({"lead_id": lead["lead_id"]}, {"$set": {"user_id": user_id}})
+    return user_id
+
+
+async def complete_session(lead: dict):
+    await db.wizard_sessions.update_one({"lead_id": lead["lead_id"]}, {"$set": {"completed_at": lead.get("updated_at") or datetime.now(timezone.utc)}})
+
+
+def _pretty(value) -> str:
+    return (value or "").replace("_", " ")
+
+
+async def notify(lead: dict):
+    """Queue the admin "New Lead" email; the message id makes this once per submission."""
+    from server import SENDGRID_FROM_EMAIL
+    if not channel_ready("email"):
+        return
+    product = _pretty(lead.get("product_type")).title()
+    diamond = _pretty(lead.get("diamond_shape")).title()
+    carat = _pretty(lead.get("carat_range"))
+    budget = _pretty(lead.get("budget"))
+    first_name, phone, email_val, notes = lead.get("first_name"), lead.get("phone"), lead.get("email"), lead.get("notes")
+    await enqueue_email(
+        SENDGRID_FROM_EMAIL,
+        subject=f"New Lead: {first_name} — {product}",
+        html=f"""
+        <div style="font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif; max-width: 520px; margin: 0 auto; padding: 30px 20px;">
+            <h2 style="color: #0F5E4C; font-size: 20px; margin: 0 0 20px;">New Lead Submitted</h2>
+            <table style="width: 100%; border-collapse: collapse; font-size: 14px;">
+                <tr><td style="padding: 8px 0; color: #6B7280; border-bottom: 1px solid #E5E5E3;">Name</td><td style="padding: 8px 0; color: #1A1A1C; font-weight: 600; border-bottom: 1px solid #E5E5E3; text-align: right;">{first_name}</td></tr>
+                <tr><td style="padding: 8px 0; color: #6B7280; border-bottom: 1px solid #E5E5E3;">Phone</td><td style="padding: 8px 0; color: #1A1A1C; font-weight: 600; border-bottom: 1px solid #E5E5E3; text-align: right;">{phone or '—'}</td></tr>
+                <tr><td style="padding: 8px 0; color: #6B7280; border-bottom: 1px solid #E5E5E3;">Email</td><td style="padding: 8px 0; color: #1A1A1C; font-weight: 600; border-bottom: 1px solid #E5E5E3; text-align: right;">{email_val or '—'}</td></tr>
+                <tr><td style="padding: 8px 0; color: #6B7280; border-bottom: 1px solid #E5E5E3;">Product</td><td style="padding: 8px 0; color: #1A1A1C; font-weight: 600; border-bottom: 1px solid #E5E5E3; text-align: right;">{product}</td></tr>
+                <tr><td style="padding: 8px 0; color: #6B7280; border-bottom: 1px solid #E5E5E3;">Diamond</td><td style="padding: 8px 0; color: #1A1A1C; font-weight: 600; border-bottom: 1px solid #E5E5E3; text-align: right;">{diamond} {carat}</td></tr>
+                <tr><td style="padding: 8px 0; color: #6B7280;">Budget</td><td style="padding: 8px 0; color: #1A1A1C; font-weight: 600; text-align: right;">{budget}</td></tr>
+            </table>
+            {f'<p style="margin: 16px 0 0; padding: 12px; background: #F5F5F3; border-radius: 8px; font-size: 13px; color: #6B7280;">Note: {notes}</p>' if notes else ''}
+            <hr style="border: none; border-top: 1px solid #E5E5E3; margin: 20px 0;" />
+            <p style="font-size: 12px; color: #9CA3AF;">Lead ID: {lead["lead_id"]} • The Local Jewel</p>
+        </div>
+        """,
+        kind="lead_notify",
+        message_id=f"msg_lead_{lead.get('submission_id') or lead['lead_id']}",
+    )
+
+
+_STAGE_FUNCS = {"score": score, "link_user": link_user, "session": complete_session, "notify": notify, "index": index_lead}
+
+
+# ── Workers ──────────────────────────────────────────────────
+
+async def _run_stage(stage: str, lead: dict):
+    started = time.perf_counter()
+    try:
+        result = await _STAGE_FUNCS[stage](lead)
+    except Exception:
+        _metrics[stage]["failed"] += 1
+        raise
+    m = _metrics[stage]
+    m["ok"] += 1
+    b = bucket((time.perf_counter() - started) * 1000)
+    if b is not None:
+        m["ms"][b] = m["ms"].get(b, 0) + 1
+    return result
+
+
+def backoff(attempts: int) -> timedelta:
+    delay = LEAD_PIPELINE_BACKOFF_SECONDS * 2 ** max(attempts - 1, 0) * random.uniform(0.8, 1.2)
+    return timedelta(seconds=min(delay, LEAD_PIPELINE_BACKOFF_MAX_SECONDS))
+
+
+async def _claim() -> Optional[dict]:
+    now = datetime.now(timezone.utc)
+    return await db.leads.find_one_and_update(
+        {"pipeline_next_at": {"$lte": now}},
+        {"$set": {"pipeline_next_at": now + LEAD_PIPELINE_CLAIM}, "$inc": {"pipeline_attempts": 1}},
+        sort=[("pipeline_next_at", 1)],
+        projection={"_id": 0, "internal_notes": 0, "comments": 0},
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def process(lead: dict) -> bool:
+    """Run a claimed lead's pending stages. Returns True once all are done."""
+    this_run = {"lead_id": lead["lead_id"], "submission_id": lead.get("submission_id")}
+    pending = lead.get("pipeline_pending") or []
+    for stage in [s for s in STAGES if s in pending]:
+        try:
+            await _run_stage(stage, lead)
+        except Exception as e:
+            error = f"{stage}: {type(e).__name__}: {e}"[:500]
+            attempts = lead.get("pipeline_attempts", 1)
+            if attempts >= LEAD_PIPELINE_MAX_ATTEMPTS:
+                ops = {"$set": {"pipeline_failed": True, "pipeline_error": error}, "$unset": {"pipeline_next_at": ""}}
+                logger.error(f"lead pipeline {lead['lead_id']} gave up after {attempts} attempts: {error}")
+            else:
+                ops = {"$set": {"pipeline_error": error, "pipeline_next_at": datetime.now(timezone.utc) + backoff(attempts)}}
+                logger.warning(f"lead pipeline {lead['lead_id']} attempt {attempts} failed: {error}")
+            await db.leads.update_one(this_run, ops)
+            return False
+        await db.leads.update_one(this_run, {"$pull": {"pipeline_pending": stage}})
+    await db.leads.update_one(
+        {**this_run, "pipeline_pending": {"$size": 0}},
+        {"$unset": {"pipeline_next_at": "", "pipeline_attempts": "", "pipeline_error": ""}},
+    )
+    return True
+
+
+async def process_due(limit: int = 100) -> int:
+    """Process up to `limit` due leads in this task. Returns how many were handled."""
+    handled = 0
+    while handled < limit:
+        lead = await _claim()
+        if not lead:
+            break
+        await process(lead)
+        handled += 1
+    return handled
+
+
+async def _worker():
+    while True:
+        try:
+            if await process_due():
+                continue
+        except Exception as e:
+            logger.error(f"lead pipeline worker pass failed: {e}")
+        try:
+            await asyncio.wait_for(_wake.wait(), timeout=LEAD_PIPELINE_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        _wake.clear()
+
+
+async def resolve_user(lead_id: str) -> Optional[str]:
+    """The user a submit token belongs to; links the lead now if still pending."""
+    lead = await db.leads.find_one({"lead_id": lead_id}, {"_id": 0, "internal_notes": 0, "comments": 0})
+    if not lead:
+        return None
+    if lead.get("user_id") and "link_user" not in (lead.get("pipeline_pending") or []):
+        return lead["user_id"]
+    return await _run_stage("link_user", lead)
+
+
+async def ensure_indexes():
+    await db.leads.create_index("pipeline_next_at", sparse=True)
+    try:
+        await db.users.create_index("user_id", unique=True)
+    except Exception as e:
+        logger.error(f"users.user_id unique index failed: {e}")
+
+
+def start():
+    if not _tasks:
+        _tasks.extend(asyncio.create_task(_worker()) for _ in range(LEAD_PIPELINE_WORKERS))
+
+
+async def stop():
+    for task in _tasks:
+        task.cancel()
+    for task in _tasks:
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    _tasks.clear()
+
+
+# ── Admin ────────────────────────────────────────────────────
+
+async def stats() -> dict:
+    stages = {}
+    for stage, m in _metrics.items():
+        q = quantiles(m["ms"], (0.5, 0.9, 0.99))
+        stages[stage] = {"ok": m["ok"], "failed": m["failed"], **{f"p{round(p * 100)}_ms": round(v, 1) for p, v in q.items()}}
+    return {
+        "stages": stages,
+        "queued": await db.leads.count_documents({"pipeline_next_at": {"$exists": True}}),
+        "failed": await db.leads.count_documents({"pipeline_failed": True}),
+    }
+
+
+async def requeue(lead_id: str) -> bool:
+    """Retry a failed lead's remaining stages with a fresh attempt budget."""
+    res = await db.leads.update_one(
+        {"lead_id": lead_id, "pipeline_failed": True},
+        {"$set": {"pipeline_next_at": datetime.now(timezone.utc), "pipeline_attempts": 0}, "$unset": {"pipeline_failed": ""}},
+    )
+    if res.modified_count:
+        _wake.set()
+    return res.modified_count == 1
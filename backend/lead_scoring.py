@@ -0,0 +1,211 @@
+"""Declarative lead scoring shared by every lead entry point.
+
+The rules live in `db.settings {key: "lead_scoring_rules"}` (DEFAULT_RULES
+until an admin saves some) and look like:
+
+    {"base": 30, "max": 100,
+     "buckets": [{"name": "high", "min": 70}, {"name": "medium", "min": 45}, {"name": "low", "min": 0}],
+     "rules": [{"field": "product_type", "op": "in", "value": ["engagement_ring"], "points": 15, "flag": "high_value_product"},
+               {"field": "visitor.sessions", "op": "gt", "value": 1, "points": 10, "flag": "returning_visitor"}, ...]}
+
+`field` is a dotted path into the lead; `visitor.*` reads the visitor's
+features from visitor_features (looked up by attribution.anonymous_id, and
+only when some rule needs them). Each saved rule set gets a new version and
+is compiled once per process into plain closures; processes re-read the
+settings doc at most once a minute.
+
+`score_lead(lead)` returns {lead_score, intent_bucket, quality_flags};
+`rescore_all()` re-applies the current rules to every lead with bulk_write.
+"""
+import logging
+from datetime import datetime, timezone
+from typing import Callable, Dict, List
+
+from pymongo import ReturnDocument, UpdateOne
+
+from admin_routes import db
+from ttl_cache import TTLCache
+import visitor_features
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RULES = {
+    "base": 30,
+    "max": 100,
+    "buckets": [{"name": "high", "min": 70}, {"name": "medium", "min": 45}, {"name": "low", "min": 0}],
+    "rules": [
+        {"field": "product_type", "op": "in", "value": ["engagement_ring", "wedding_bands"], "points": 15, "flag": "high_value_product"},
+        {"field": "carat_range", "op": "in", "value": ["2.0_2.9", "3.0_plus"], "points": 10, "flag": "large_carat"},
+        {"field": "priority", "op": "in", "value": ["biggest_look", "best_sparkle"], "points": 5},
+        {"field": "has_inspiration", "op": "eq", "value": "yes", "points": 10, "flag": "has_inspiration"},
+        {"field": "phone", "op": "truthy", "points": 10, "flag": "has_phone"},
+        {"field": "email", "op": "truthy", "points": 5, "flag": "has_email"},
+        {"field": "sms_opt_in", "op": "truthy", "points": 5, "flag": "sms_opt_in"},
+        {"field": "visitor.sessions", "op": "gt", "value": 1, "points": 10, "flag": "returning_visitor"},
+        {"field": "source", "op": "eq", "value": "project_inquiry", "points": 0, "flag": "project_inquiry"},
+        {"field": "source", "op": "eq", "value": "quick_quote_hero", "points": 0, "flag": "quick_quote"},
+    ],
+}
+SCORE_FIELDS = ("lead_score", "intent_bucket", "quality_flags")
+_SETTINGS_KEY = "lead_scoring_rules"
+
+_OPS: Dict[str, Callable] = {
+    "eq": lambda want: lambda v: v == want,
+    "ne": lambda want: lambda v: v != want,
+    "in": lambda want: lambda v: v in want,
+    "nin": lambda want: lambda v: v not in want,
+    "gt": lambda want: lambda v: v is not None and v > want,
+    "gte": lambda want: lambda v: v is not None and v >= want,
+    "lt": lambda want: lambda v: v is not None and v < want,
+    "lte": lambda want: lambda v: v is not None and v <= want,
+    "truthy": lambda _: bool,
+}
+
+_spec_cache = TTLCache("lead_scoring_rules", maxsize=1, ttl=60)
+_compiled: Dict[int, Callable[[dict], dict]] = {}   # rules version -> scorer
+
+
+def _getter(path: str) -> Callable[[dict], object]:
+    parts = path.split(".")
+
+    def get(doc: dict):
+        for part in parts:
+            if not isinstance(doc, dict):
+                return None
+            doc = doc.get(part)
+        return doc
+    return get
+
+
+def compile_rules(spec: dict) -> Callable[[dict], dict]:
+    """Validate a rule set and turn it into `scorer(doc) -> score fields`.
+    Raises ValueError describing the first problem found."""
+    try:
+        base, cap = float(spec.get("base", DEFAULT_RULES["base"])), float(spec.get("max", DEFAULT_RULES["max"]))
+    except (TypeError, ValueError):
+        raise ValueError("base and max must be numbers")
+    if not isinstance(spec.get("rules"), list):
+        raise ValueError("rules must be a list")
+    buckets = spec.get("buckets") or DEFAULT_RULES["buckets"]
+    if not all(isinstance(b, dict) and isinstance(b.get("name"), str) and isinstance(b.get("min"), (int, float)) for b in buckets):
+        raise ValueError("each bucket needs a name and a numeric min")
+    buckets = sorted(buckets, key=lambda b: -b["min"])
+    checks = []
+    for i, rule in enumerate(spec["rules"]):
+        if not isinstance(rule, dict) or not isinstance(rule.get("field"), str) or not rule["field"]:
+            raise ValueError(f"rule {i}: field is required")
+        if rule.get("op") not in _OPS:
+            raise ValueError(f"rule {i}: op must be one of {', '.join(_OPS)}")
+        if rule["op"] in ("in", "nin") and not isinstance(rule.get("value"), list):
+            raise ValueError(f"rule {i}: {rule['op']} needs a list value")
+        if not isinstance(rule.get("points", 0), (int, float)):
+            raise ValueError(f"rule {i}: points must be a number")
+        checks.append((_getter(rule["field"]), _OPS[rule["op"]](rule.get("value")), rule.get("points", 0), rule.get("flag")))
+
+    def scorer(doc: dict) -> dict:
+        total, flags = base, []
+        for get, test, points, flag in checks:
+            try:
+                hit = test(get(doc))
+            except TypeError:   # e.g. comparing a string field with a number
+                hit = False
+            if hit:
+                total += points
+                if flag:
+                    flags.append(flag)
+        total = max(0, min(total, cap))
+        total = int(total) if float(total).is_integer() else round(total, 1)
+        intent_bucket = next((b["name"] for b in buckets if total >= b["min"]), buckets[-1]["name"])
+        return {"lead_score": total, "intent_bucket": intent_bucket, "quality_flags": flags}
+
+    scorer.uses_visitor = any(rule["field"].startswith("visitor.") for rule in spec["rules"])
+    return scorer
+
+
+async def _load_spec() -> dict:
+    doc = await db.settings.find_one({"key": _SETTINGS_KEY}, {"_id": 0, "key": 0})
+    return doc or {**DEFAULT_RULES, "version": 0}
+
+
+async def get_rules() -> dict:
+    return await _spec_cache.get_or_load("spec", _load_spec)
+
+
+async def current_scorer() -> Callable[[dict], dict]:
+    spec = await get_rules()
+    version = spec.get("version", 0)
+    scorer = _compiled.get(version)
+    if scorer is None:
+        try:
+            scorer = compile_rules(spec)
+        except ValueError as e:
+            logger.error(f"lead scoring rules v{version} invalid, using defaults: {e}")
+            scorer = compile_rules(DEFAULT_RULES)
+        _compiled.clear()
+        _compiled[version] = scorer
+    return scorer
+
+
+async def score_lead(lead: dict) -> dict:
+    """{lead_score, intent_bucket, quality_flags} for a lead document."""
+    scorer = await current_scorer()
+    features = {}
+    if scorer.uses_visitor:
+        features = await visitor_features.get((lead.get("attribution") or {}).get("anonymous_id"))
+    return scorer({**lead, "visitor": features})
+
+
+async def save_rules(spec: dict) -> dict:
+    """Validate and store a new rule set; returns it with its version."""
+    compile_rules(spec)
+    fields = {
+        "base": spec.get("base", DEFAULT_RULES["base"]),
+        "max": spec.get("max", DEFAULT_RULES["max"]),
+        "buckets": spec.get("buckets") or DEFAULT_RULES["buckets"],
+        "rules": spec["rules"],
+    }
+    saved = await db.settings.find_one_and_update(
+        {"key": _SETTINGS_KEY},
+        {"$set": {**fields, "updated_at": datetime.now(timezone.utc)}, "$inc": {"version": 1}},
+        projection={"_id": 0, "key": 0},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    _spec_cache.clear()
+    return saved
+
+
+async def rescore_all(batch_size: int = 500) -> dict:
+    """Re-apply the current rules to every lead; only changed leads are written."""
+    scorer = await current_scorer()
+    scanned = updated = 0
+    projection = {"_id": 0, "comments": 0, "internal_notes": 0, "cad_renders": 0, "inspiration_files": 0}
+    cursor = db.leads.find({}, projection).batch_size(batch_size)
+
+    async def flush(batch: List[dict]):
+        nonlocal updated
+        features = {}
+        if scorer.uses_visitor:
+            features = await visitor_features.get_many([(ld.get("attribution") or {}).get("anonymous_id") for ld in batch])
+        ops = []
+        for ld in batch:
+            anonymous_id = (ld.get("attribution") or {}).get("anonymous_id")
+            fields = scorer({**ld, "visitor": features.get(anonymous_id, {})})
+            if any(ld.get(k) != fields[k] for k in SCORE_FIELDS):
+                ops.append(UpdateOne({"lead_id": ld["lead_id"]}, {"$set": fields}))
+        if ops:
+            await db.leads.bulk_write(ops, ordered=False)
+            updated += len(ops)
+
+    batch = []
+    async for ld in cursor:
+        if not ld.get("lead_id"):
+            continue
+        batch.append(ld)
+        scanned += 1
+        if len(batch) >= batch_size:
+            await flush(batch)
+            batch = []
+    if batch:
+        await flush(batch)
+    return {"scanned": scanned, "updated": updated, "version": (await get_rules()).get("version", 0)}
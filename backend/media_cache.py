@@ -0,0 +1,361 @@
+"""Disk-backed LRU cache in front of object storage for hot media.
+
+Storefront images are proxied through /api/uploads/cloud/{path}; without a
+cache every view re-downloads the object from R2. Storage paths produced by
+`storage.upload_file` embed a fresh UUID and are never overwritten, so a cached
+copy never needs revalidation.
+
+- Content-addressed: blobs live at MEDIA_CACHE_DIR/ab/<sha256(path)> with a
+  `.json` sidecar holding content type, ETag and Last-Modified.
+- Byte budget: MEDIA_CACHE_MAX_BYTES for the whole directory, least-recently-
+  used (blob mtime, refreshed on hits) evicted first. Objects above
+  MEDIA_CACHE_MAX_OBJECT_BYTES (videos) are never cached; they keep streaming
+  from R2 with Range support.
+- Single-flight: concurrent misses for one path share one R2 download.
+- Hits never touch the storage thread pool: `CachedFileResponse` hands the
+  open blob to the server as a zero-copy sendfile when it offers the ASGI
+  `http.response.zerocopysend` extension, and otherwise reads it on a small
+  pool of its own (MEDIA_CACHE_READERS threads), so cache hits don't queue
+  behind R2 calls under load.
+- Shared by every worker: the directory is the source of truth. Each process
+  keeps an index that it rebuilds from a scan of the directory (under a
+  `.lock` flock, which is also where eviction happens) at startup, every
+  MEDIA_CACHE_SYNC_SECONDS, and whenever its own fills push it over budget.
+  A miss checks the sidecar on disk before downloading, and a blob evicted
+  by another worker is dropped from the index and served from storage.
+- Best effort: a local disk error (full disk, unwritable directory) is
+  counted in `disk_errors`, the request is served from storage, and fills
+  pause for DISK_ERROR_BACKOFF_SECONDS.
+
+Set MEDIA_CACHE_MAX_BYTES=0 to disable.
+"""
+import os
+import json
+import time
+import uuid
+import fcntl
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import aiofiles
+from starlette.responses import Response
+
+from storage import LocalBackend, STREAM_CHUNK_SIZE, open_object, iter_body
+
+logger = logging.getLogger(__name__)
+
+MEDIA_CACHE_DIR = os.environ.get("MEDIA_CACHE_DIR", "/app/backend/media_cache")
+MEDIA_CACHE_MAX_BYTES = int(os.environ.get("MEDIA_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+MEDIA_CACHE_MAX_OBJECT_BYTES = int(os.environ.get("MEDIA_CACHE_MAX_OBJECT_BYTES", str(20 * 1024 ** 2)))
+MEDIA_CACHE_SYNC_SECONDS = float(os.environ.get("MEDIA_CACHE_SYNC_SECONDS", "30"))
+MEDIA_CACHE_READERS = int(os.environ.get("MEDIA_CACHE_READERS", "4"))
+TOUCH_INTERVAL_SECONDS = 60
+ORPHAN_GRACE_SECONDS = 3600   # temp files / half-written entries older than this are debris
+DISK_ERROR_BACKOFF_SECONDS = 30
+
+_index: "OrderedDict[str, dict]" = OrderedDict()   # key -> entry, LRU first
+_total_bytes = 0
+_inflight: Dict[str, asyncio.Future] = {}
+_uncacheable: "OrderedDict[str, bool]" = OrderedDict()   # paths known to be too big
+_touched: Dict[str, float] = {}   # key -> monotonic time of the last mtime refresh
+_loaded = False
+_last_sync = 0.0
+_sync_task: Optional[asyncio.Task] = None
+_fills_paused_until = 0.0   # after a disk error, misses go straight to storage
+_disk = LocalBackend(MEDIA_CACHE_DIR)
+_readers = ThreadPoolExecutor(max_workers=MEDIA_CACHE_READERS, thread_name_prefix="media-cache")
+_stats = {"hits": 0, "misses": 0, "fills": 0, "evictions": 0, "vanished": 0, "disk_errors": 0}
+
+
+def _key(path: str) -> str:
+    return hashlib.sha256(path.encode()).hexdigest()
+
+
+def _blob(key: str) -> str:
+    """Blob location relative to MEDIA_CACHE_DIR."""
+    return os.path.join(key[:2], key)
+
+
+def _unlink(full: str):
+    try:
+        os.remove(full)
+    except OSError:
+        pass
+
+
+def _scan_and_evict() -> Tuple[List[Tuple[str, dict]], int]:
+    """Scan the cache directory under its lock: clear stale debris, evict the
+    least recently used blobs until the directory fits the budget, and return
+    ([(key, entry)] oldest first, evicted count). Runs in a thread."""
+    os.makedirs(MEDIA_CACHE_DIR, exist_ok=True)
+    now = time.time()
+    with open(os.path.join(MEDIA_CACHE_DIR, ".lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        found = []
+        for shard in os.listdir(MEDIA_CACHE_DIR):
+            shard_dir = os.path.join(MEDIA_CACHE_DIR, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            for name in os.listdir(shard_dir):
+                full = os.path.join(shard_dir, name)
+                try:
+                    st = os.stat(full)
+                except OSError:
+                    continue
+                stale = now - st.st_mtime > ORPHAN_GRACE_SECONDS
+                if name.endswith(".tmp"):
+                    if stale:
+                        _unlink(full)   # interrupted fill
+                    continue
+                if name.endswith(".json"):
+                    if stale and not os.path.exists(full[:-len(".json")]):
+                        _unlink(full)
+                    continue
+                try:
+                    with open(full + ".json") as f:
+                        entry = json.load(f)
+                except (OSError, ValueError):
+                    if stale:
+                        _unlink(full)
+                    continue
+                entry["size"] = st.st_size
+                found.append((st.st_mtime, name, entry))
+        found.sort(key=lambda t: t[0])
+        total = sum(entry["size"] for _, _, entry in found)
+        evicted = 0
+        while total > MEDIA_CACHE_MAX_BYTES and found:
+            _, _, entry = found.pop(0)
+            full = os.path.join(MEDIA_CACHE_DIR, entry["blob"])
+            _unlink(full)
+            _unlink(full + ".json")
+            total -= entry["size"]
+            evicted += 1
+    return [(key, entry) for _, key, entry in found], evicted
+
+
+async def _sync():
+    """Rebuild the index from the directory, evicting down to the budget."""
+    global _index, _total_bytes, _last_sync
+    _last_sync = time.monotonic()
+    try:
+        entries, evicted = await asyncio.to_thread(_scan_and_evict)
+    except Exception as e:
+        logger.error(f"Media cache scan failed: {e}")
+        return
+    _index = OrderedDict(entries)
+    _total_bytes = sum(entry["size"] for entry in _index.values())
+    _touched.clear()
+    _stats["evictions"] += evicted
+
+
+def _maybe_sync(force: bool = False):
+    global _sync_task
+    if _sync_task and not _sync_task.done():
+        return
+    if force or time.monotonic() - _last_sync > MEDIA_CACHE_SYNC_SECONDS:
+        _sync_task = asyncio.ensure_future(_sync())
+
+
+async def load():
+    """Build the index from disk (startup)."""
+    global _loaded
+    _loaded = True
+    if MEDIA_CACHE_MAX_BYTES <= 0:
+        return
+    await _sync()
+    logger.info(f"Media cache: {len(_index)} objects, {_total_bytes / 1024 ** 2:.1f} MB")
+
+
+def _read_sidecar(key: str) -> Optional[dict]:
+    """Entry written by any worker, or None if the blob isn't on disk."""
+    full = os.path.join(MEDIA_CACHE_DIR, _blob(key))
+    try:
+        with open(full + ".json") as f:
+            entry = json.load(f)
+        entry["size"] = os.stat(full).st_size
+    except (OSError, ValueError):
+        return None
+    return entry
+
+
+def _add(key: str, entry: dict):
+    global _total_bytes
+    old = _index.pop(key, None)
+    if old:
+        _total_bytes -= old["size"]
+    _index[key] = entry
+    _total_bytes += entry["size"]
+
+
+def _forget(key: str):
+    """Drop an index entry whose blob is gone (the files are not touched)."""
+    global _total_bytes
+    entry = _index.pop(key, None)
+    if entry:
+        _total_bytes -= entry["size"]
+    _touched.pop(key, None)
+
+
+async def _touch(key: str, entry: dict):
+    """Refresh the blob's mtime (the shared LRU clock) at most once a minute."""
+    now = time.monotonic()
+    if now - _touched.get(key, 0) < TOUCH_INTERVAL_SECONDS:
+        return
+    _touched[key] = now
+    try:
+        await asyncio.to_thread(os.utime, os.path.join(MEDIA_CACHE_DIR, entry["blob"]))
+    except OSError:
+        pass
+
+
+def _disk_failed(message: str):
+    """Count a local disk error and pause fills for DISK_ERROR_BACKOFF_SECONDS."""
+    global _fills_paused_until
+    _stats["disk_errors"] += 1
+    _fills_paused_until = time.monotonic() + DISK_ERROR_BACKOFF_SECONDS
+    logger.error(message)
+
+
+def _write_file(full: str, data: str):
+    tmp = f"{full}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "w") as f:
+        f.write(data)
+    os.replace(tmp, full)
+
+
+async def _fill(path: str, key: str) -> Optional[dict]:
+    """Download one object into the cache. None if it is too big to cache."""
+    obj = await open_object(path)
+    size = obj.get("content_length") or 0
+    if size > MEDIA_CACHE_MAX_OBJECT_BYTES or size > MEDIA_CACHE_MAX_BYTES:
+        obj["body"].close()
+        _uncacheable[path] = True
+        while len(_uncacheable) > 10000:
+            _uncacheable.popitem(last=False)
+        return None
+
+    blob = _blob(key)
+    full = os.path.join(MEDIA_CACHE_DIR, blob)
+    last_modified = obj.get("last_modified")
+    entry = {
+        "blob": blob,
+        "size": size,
+        "content_type": obj["content_type"],
+        "etag": obj.get("etag", ""),
+        "last_modified": last_modified.isoformat() if isinstance(last_modified, datetime) else None,
+    }
+    tmp = f"{full}.{uuid.uuid4().hex}.tmp"
+    try:
+        await asyncio.to_thread(os.makedirs, os.path.dirname(full), exist_ok=True)
+        # Sidecar first: a scan only indexes blobs that already have one.
+        await asyncio.to_thread(_write_file, full + ".json", json.dumps(entry))
+        async with aiofiles.open(tmp, "wb") as f:
+            async for chunk in iter_body(obj["body"]):
+                await f.write(chunk)
+        await asyncio.to_thread(os.replace, tmp, full)
+    except OSError as e:
+        # Full disk, unwritable MEDIA_CACHE_DIR, ...: serve from storage.
+        obj["body"].close()
+        _disk_failed(f"Media cache fill failed for {path}: {e}")
+        return None
+    finally:
+        await asyncio.to_thread(_unlink, tmp)
+    _add(key, entry)
+    _stats["fills"] += 1
+    _maybe_sync(force=_total_bytes > MEDIA_CACHE_MAX_BYTES)
+    return entry
+
+
+async def lookup(path: str, fill: bool = True) -> Optional[dict]:
+    """Cached entry for `path`, downloading it first on a miss when `fill`.
+    Returns None when the object should be streamed from storage instead."""
+    if MEDIA_CACHE_MAX_BYTES <= 0:
+        return None
+    if not _loaded:
+        await load()
+    _maybe_sync()
+    key = _key(path)
+    entry = _index.get(key)
+    if entry is None:
+        entry = await asyncio.to_thread(_read_sidecar, key)   # cached by another worker
+        if entry:
+            _add(key, entry)
+    if entry:
+        _index.move_to_end(key)
+        _stats["hits"] += 1
+        await _touch(key, entry)
+        return entry
+    _stats["misses"] += 1
+    if not fill or path in _uncacheable or time.monotonic() < _fills_paused_until:
+        return None
+    pending = _inflight.get(key)
+    if pending is None:
+        pending = asyncio.ensure_future(_fill(path, key))
+        _inflight[key] = pending
+        pending.add_done_callback(lambda _: _inflight.pop(key, None))
+    return await asyncio.shield(pending)
+
+
+async def open_cached(entry: dict, byte_range: str = "") -> Optional[dict]:
+    """Open a cached blob; same shape as `storage.open_object`. None when the
+    blob has been evicted meanwhile: the caller falls back to storage. The
+    returned body holds the file open, so a later eviction can't cut it off."""
+    try:
+        obj = await asyncio.to_thread(_disk.open, entry["blob"], byte_range)
+    except FileNotFoundError:
+        _forget(os.path.basename(entry["blob"]))
+        _stats["vanished"] += 1
+        return None
+    except OSError as e:
+        _disk_failed(f"Media cache read failed for {entry['blob']}: {e}")
+        return None
+    obj["content_type"] = entry["content_type"]
+    obj["etag"] = entry["etag"]
+    if entry.get("last_modified"):
+        obj["last_modified"] = datetime.fromisoformat(entry["last_modified"])
+    return obj
+
+
+class CachedFileResponse(Response):
+    """Serve a blob opened by `open_cached` (whole or one byte range) the way
+    Starlette's FileResponse does — sendfile when the server supports it —
+    but from the already-open file, so an eviction mid-response is harmless."""
+
+    def __init__(self, obj: dict, status_code: int = 200, headers: Optional[dict] = None):
+        super().__init__(status_code=status_code, headers=headers, media_type=obj["content_type"])
+        self.body_file = obj["body"]
+
+    async def __call__(self, scope, receive, send):
+        body = self.body_file
+        try:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            if scope.get("method", "GET").upper() == "HEAD":
+                pass
+            elif "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send({"type": "http.response.zerocopysend", "file": body.fileno(), "offset": body.tell(), "count": body.remaining, "more_body": False})
+                return
+            else:
+                loop = asyncio.get_running_loop()
+                while True:
+                    chunk = await loop.run_in_executor(_readers, body.read, STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            body.close()
+
+
+def cache_stats() -> dict:
+    return {
+        **_stats,
+        "objects": len(_index),
+        "bytes": _total_bytes,
+        "max_bytes": MEDIA_CACHE_MAX_BYTES,
+        "inflight": len(_inflight),
+    }
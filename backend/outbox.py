@@ -0,0 +1,301 @@
+"""Durable outbound-message queue for SendGrid email and Twilio SMS.
+
+Handlers call `enqueue_email(...)` / `enqueue_sms(...)`, which write one row
+to `db.outbox` and return; nothing talks to a provider on the request path.
+A pool of OUTBOX_WORKERS background workers claims due rows atomically
+(`find_one_and_update`, so several app processes can share the queue), sends
+them through the provider in a thread (both SDKs are blocking), and records
+the outcome:
+
+    pending --claim--> sending --ok--> sent
+                          |--error--> pending (next_attempt_at = now + backoff)
+                          |--error, attempts == OUTBOX_MAX_ATTEMPTS--> dead
+                          '--past expires_at--> expired
+
+Backoff is exponential (OUTBOX_BACKOFF_SECONDS * 2^(attempt-1), capped, with
+jitter). Rows stuck in "sending" (worker died) are reclaimed once their
+claim lapses. Dead rows stay for the admin dead-letter view, which can
+requeue them.
+
+A row may carry a `fallback` message (built with `sms_message`): the OTP
+email sets one when the user has a phone. Its first failed send then marks
+it dead and queues the fallback instead of retrying, with whatever is left
+of the row's expiry, the way the old synchronous send fell back to SMS.
+
+OUTBOX_PROVIDER=fake swaps both channels for `FakeProvider`, which records
+messages in memory (and can be told to fail), so the queue runs offline.
+"""
+import os
+import uuid
+import random
+import asyncio
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from admin_routes import db
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_WORKERS = int(os.environ.get("OUTBOX_WORKERS", "4"))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "6"))
+OUTBOX_BACKOFF_SECONDS = float(os.environ.get("OUTBOX_BACKOFF_SECONDS", "30"))
+OUTBOX_BACKOFF_MAX_SECONDS = 3600
+OUTBOX_POLL_SECONDS = float(os.environ.get("OUTBOX_POLL_SECONDS", "5"))
+OUTBOX_SEND_TIMEOUT = 30
+OUTBOX_CLAIM = timedelta(minutes=2)
+OUTBOX_PROVIDER = os.environ.get("OUTBOX_PROVIDER", "")
+STATUSES = ("pending", "sending", "sent", "dead", "expired")
+
+
+# ── Providers ────────────────────────────────────────────────
+
+class SendGridProvider:
+    channel = "email"
+
+    def ready(self) -> bool:
+        from server import sg_client
+        return sg_client is not None
+
+    def send(self, to: str, payload: dict):
+        from server import sg_client, SENDGRID_FROM_EMAIL
+        from sendgrid.helpers.mail import Mail as SGMail
+        message = SGMail(from_email=SENDGRID_FROM_EMAIL, to_emails=to, subject=payload["subject"], html_content=payload["html"])
+        resp = sg_client.send(message)
+        if getattr(resp, "status_code", 202) >= 400:
+            raise RuntimeError(f"SendGrid returned {resp.status_code}")
+
+
+class TwilioProvider:
+    channel = "sms"
+
+    def ready(self) -> bool:
+        from server import twilio_client, TWILIO_PHONE
+        return twilio_client is not None and bool(TWILIO_PHONE)
+
+    def send(self, to: str, payload: dict):
+        from server import twilio_client, TWILIO_PHONE
+        twilio_client.messages.create(body=payload["body"], from_=TWILIO_PHONE, to=to)
+
+
+class FakeProvider:
+    """In-memory provider for offline runs: `sent` collects (to, payload);
+    `fail_next` makes that many upcoming sends raise."""
+
+    def __init__(self, channel: str):
+        self.channel = channel
+        self.sent: List[tuple] = []
+        self.fail_next = 0
+
+    def ready(self) -> bool:
+        return True
+
+    def send(self, to: str, payload: dict):
+        if self.fail_next > 0:
+            self.fail_next -= 1
+            raise RuntimeError("fake provider failure")
+        self.sent.append((to, payload))
+
+
+if OUTBOX_PROVIDER == "fake":
+    providers: Dict[str, object] = {"email": FakeProvider("email"), "sms": FakeProvider("sms")}
+else:
+    providers = {"email": SendGridProvider(), "sms": TwilioProvider()}
+
+
+def channel_ready(channel: str) -> bool:
+    try:
+        return providers[channel].ready()
+    except Exception:
+        return False
+
+
+# ── Enqueue ──────────────────────────────────────────────────
+
+def _aware(dt: Optional[datetime]) -> Optional[datetime]:
+    return dt.replace(tzinfo=timezone.utc) if dt and dt.tzinfo is None else dt
+
+
+def sms_message(to: str, body: str) -> Optional[dict]:
+    """A `fallback` for enqueue_email, or None when SMS can't be sent."""
+    if not to or not channel_ready("sms"):
+        return None
+    return {"channel": "sms", "to": to, "payload": {"body": body}}
+
+
+async def enqueue(channel: str, to: str, payload: dict, kind: str, expires_in: Optional[timedelta] = None,
+                  message_id: Optional[str] = None, fallback: Optional[dict] = None) -> Optional[str]:
+    """Queue one message. Returns its message_id, or None when the channel
+    has no provider configured (matching the old "if sg_client:" guards).
+    A caller-chosen `message_id` makes the enqueue idempotent: repeating it
+    is a no-op."""
+    if not to or not channel_ready(channel):
+        return None
+    now = datetime.now(timezone.utc)
+    doc = {
+        "message_id": message_id or f"msg_{uuid.uuid4().hex[:16]}",
+        "channel": channel,
+        "kind": kind,
+        "to": to,
+        "payload": payload,
+        "status": "pending",
+        "attempts": 0,
+        "next_attempt_at": now,
+        "created_at": now,
+        "updated_at": now,
+    }
+    if expires_in:
+        doc["expires_at"] = now + expires_in
+    if fallback:
+        doc["fallback"] = fallback
+    try:
+        await db.outbox.insert_one(doc)
+    except DuplicateKeyError:
+        return doc["message_id"]
+    _wake.set()
+    return doc["message_id"]
+
+
+async def enqueue_email(to: str, subject: str, html: str, kind: str, expires_in: Optional[timedelta] = None,
+                        message_id: Optional[str] = None, fallback: Optional[dict] = None) -> Optional[str]:
+    return await enqueue("email", to, {"subject": subject, "html": html}, kind, expires_in, message_id, fallback)
+
+
+async def enqueue_sms(to: str, body: str, kind: str, expires_in: Optional[timedelta] = None) -> Optional[str]:
+    return await enqueue("sms", to, {"body": body}, kind, expires_in)
+
+
+# ── Workers ──────────────────────────────────────────────────
+
+_wake = asyncio.Event()
+_tasks: List[asyncio.Task] = []
+
+
+def backoff(attempts: int) -> timedelta:
+    delay = OUTBOX_BACKOFF_SECONDS * 2 ** max(attempts - 1, 0) * random.uniform(0.8, 1.2)
+    return timedelta(seconds=min(delay, OUTBOX_BACKOFF_MAX_SECONDS))
+
+
+async def _claim() -> Optional[dict]:
+    now = datetime.now(timezone.utc)
+    return await db.outbox.find_one_and_update(
+        {"$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            {"status": "sending", "claimed_until": {"$lt": now}},
+        ]},
+        {"$set": {"status": "sending", "claimed_until": now + OUTBOX_CLAIM, "updated_at": now}, "$inc": {"attempts": 1}},
+        sort=[("next_attempt_at", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def _queue_fallback(row: dict) -> Optional[str]:
+    """Queue `row`'s fallback message (once, however often this runs)."""
+    fallback = row["fallback"]
+    expires_in = None
+    if row.get("expires_at"):
+        expires_in = _aware(row["expires_at"]) - datetime.now(timezone.utc)
+        if expires_in <= timedelta(0):
+            return None
+    return await enqueue(fallback["channel"], fallback["to"], fallback["payload"], row["kind"], expires_in,
+                         message_id=f"{row['message_id']}_fallback")
+
+
+async def _deliver(row: dict):
+    now = datetime.now(timezone.utc)
+    expires_at = _aware(row.get("expires_at"))
+    if expires_at and expires_at < now:
+        await db.outbox.update_one({"_id": row["_id"]}, {"$set": {"status": "expired", "updated_at": now}})
+        return
+    try:
+        provider = providers[row["channel"]]
+        await asyncio.wait_for(asyncio.to_thread(provider.send, row["to"], row["payload"]), OUTBOX_SEND_TIMEOUT)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"[:500]
+        fallback_id = await _queue_fallback(row) if row.get("fallback") else None
+        now = datetime.now(timezone.utc)
+        if fallback_id:
+            update = {"status": "dead", "last_error": error, "fallback_id": fallback_id, "updated_at": now}
+            logger.warning(f"outbox {row['kind']} {row['message_id']} failed, queued {fallback_id} instead: {error}")
+        elif row["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+            update = {"status": "dead", "last_error": error, "updated_at": now}
+            logger.error(f"outbox {row['kind']} {row['message_id']} dead after {row['attempts']} attempts: {error}")
+        else:
+            update = {"status": "pending", "last_error": error, "next_attempt_at": now + backoff(row["attempts"]), "updated_at": now}
+            logger.warning(f"outbox {row['kind']} {row['message_id']} attempt {row['attempts']} failed: {error}")
+        await db.outbox.update_one({"_id": row["_id"]}, {"$set": update, "$unset": {"claimed_until": ""}})
+        return
+    now = datetime.now(timezone.utc)
+    await db.outbox.update_one({"_id": row["_id"]}, {"$set": {"status": "sent", "sent_at": now, "updated_at": now}, "$unset": {"claimed_until": "", "last_error": ""}})
+
+
+async def process_due(limit: int = 100) -> int:
+    """Send up to `limit` due messages in this task. Returns how many were handled."""
+    handled = 0
+    while handled < limit:
+        row = await _claim()
+        if not row:
+            break
+        await _deliver(row)
+        handled += 1
+    return handled
+
+
+async def _worker():
+    while True:
+        try:
+            if await process_due():
+                continue
+        except Exception as e:
+            logger.error(f"outbox worker pass failed: {e}")
+        try:
+            await asyncio.wait_for(_wake.wait(), timeout=OUTBOX_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        _wake.clear()
+
+
+async def ensure_indexes():
+    await db.outbox.create_index("message_id", unique=True)
+    await db.outbox.create_index([("status", 1), ("next_attempt_at", 1)])
+    await db.outbox.create_index([("status", 1), ("updated_at", -1), ("message_id", -1)])
+
+
+def start():
+    if not _tasks:
+        _tasks.extend(asyncio.create_task(_worker()) for _ in range(OUTBOX_WORKERS))
+
+
+async def stop():
+    for task in _tasks:
+        task.cancel()
+    for task in _tasks:
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    _tasks.clear()
+
+
+# ── Admin ────────────────────────────────────────────────────
+
+async def stats() -> Dict[str, int]:
+    counts = {s: 0 for s in STATUSES}
+    async for r in db.outbox.aggregate([{"$group": {"_id": "$status", "n": {"$sum": 1}}}]):
+        counts[r["_id"]] = r["n"]
+    return counts
+
+
+async def requeue(message_id: str) -> bool:
+    """Put a dead/expired message back in the queue with a fresh attempt budget."""
+    now = datetime.now(timezone.utc)
+    res = await db.outbox.update_one(
+        {"message_id": message_id, "status": {"$in": ["dead", "expired"]}},
+        {"$set": {"status": "pending", "attempts": 0, "next_attempt_at": now, "updated_at": now}, "$unset": {"expires_at": ""}},
+    )
+    if res.modified_count:
+        _wake.set()
+    return res.modified_count == 1
@@ -0,0 +1,87 @@
+"""Keyset ("cursor") pagination for the admin list endpoints.
+
+Lists are ordered newest first by (time field, id field) — e.g.
+(created_at, lead_id) — and a page is fetched with a range condition on
+that pair instead of `skip()`, so page 500 costs the same index seek as
+page 1 and rows inserted meanwhile don't shift later pages:
+
+    page = await keyset_page(db.leads, query, "created_at", "lead_id", limit, cursor)
+    # {"items": [...], "next_cursor": "..." | None, "total": 1234, "total_exact": True}
+
+The cursor is opaque to clients (URL-safe base64 of the last row's sort
+key). Totals are optional: "none" skips counting, "estimate" (default) uses
+collection metadata when unfiltered and otherwise counts up to TOTAL_CAP,
+"exact" runs a full count.
+
+Older clients that still send `?page=N` get the N-th page by `skip()` as a
+fallback (pass `page=`); its response carries `next_cursor` so they can
+switch over.
+"""
+import json
+import base64
+from datetime import datetime
+from typing import List, Optional
+
+from fastapi import HTTPException
+
+TOTAL_CAP = 1000
+TOTAL_MODES = ("none", "estimate", "exact")
+
+
+def encode_cursor(ts, ref) -> str:
+    key = [{"$dt": ts.isoformat()} if isinstance(ts, datetime) else ts, ref]
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        ts, ref = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if isinstance(ts, dict):
+            ts = datetime.fromisoformat(ts["$dt"])
+        return ts, ref
+    except Exception:
+        raise HTTPException(400, "Invalid cursor")
+
+
+def _after(time_field: str, id_field: str, ts, ref) -> dict:
+    """Rows strictly after (ts, ref) in (time desc, id desc) order; missing times sort last."""
+    if ts is None:
+        return {time_field: None, id_field: {"$lt": ref}}
+    return {"$or": [
+        {time_field: {"$lt": ts}},
+        {time_field: ts, id_field: {"$lt": ref}},
+        {time_field: None},
+    ]}
+
+
+async def count_total(collection, query: dict, mode: str) -> dict:
+    if mode not in TOTAL_MODES:
+        raise HTTPException(400, f"total must be one of {', '.join(TOTAL_MODES)}")
+    if mode == "none":
+        return {"total": None, "total_exact": False}
+    if mode == "exact":
+        return {"total": await collection.count_documents(query), "total_exact": True}
+    if not query:
+        return {"total": await collection.estimated_document_count(), "total_exact": False}
+    n = await collection.count_documents(query, limit=TOTAL_CAP)
+    return {"total": n, "total_exact": n < TOTAL_CAP}
+
+
+async def keyset_page(collection, query: dict, time_field: str, id_field: str, limit: int,
+                      cursor: Optional[str] = None, projection: Optional[dict] = None, total: str = "estimate",
+                      page: Optional[int] = None) -> dict:
+    counted = await count_total(collection, query, total)
+    page_query = query
+    if cursor:
+        after = _after(time_field, id_field, *decode_cursor(cursor))
+        page_query = {"$and": [query, after]} if query else after
+    found = collection.find(page_query, projection).sort([(time_field, -1), (id_field, -1)])
+    if page and page > 1 and not cursor:
+        found = found.skip((page - 1) * limit)   # legacy ?page= callers
+    rows: List[dict] = await found.limit(limit + 1).to_list(limit + 1)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(last.get(time_field), last.get(id_field))
+    return {"items": rows, "next_cursor": next_cursor, **counted}
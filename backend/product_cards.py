@@ -0,0 +1,203 @@
+"""Materialized product-card read model for the storefront catalog.
+
+`db.product_cards` holds one row per project: the final card shape served by
+the storefront (sale already applied) plus the indexed fields list endpoints
+filter and sort on (`published`, `buyable`, `from_price`, `collections`,
+`tags`, `featured`, `position`, `created_at`).
+
+Rows are rewritten whenever a project, its price matrix or the global sale
+changes. On startup one worker (seed_claim) rebuilds them in the background
+only when the set is missing or stale: a new CARDS_VERSION (bump it when the
+card shape changes), or a project count that no longer matches the row count
+(projects added or removed behind the API's back). Storefront lists then
+become a single indexed projection read instead of re-running `_project_card`
+per request.
+
+Run `python product_cards.py` to rebuild by hand, e.g. after a one-off script
+edits `db.projects` in place.
+"""
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from pymongo import UpdateOne
+
+import seed_claim
+from admin_routes import db
+from image_derivatives import original_widths
+from variant_options import is_buyable, project_from_price, card_pricing
+
+logger = logging.getLogger(__name__)
+
+# Same ordering the storefront has always used for project lists.
+CARD_SORT = [("featured", -1), ("position", 1), ("created_at", -1)]
+# Rows a shopper may see.
+STOREFRONT_FILTER = {"published": True, "buyable": True}
+
+CARDS_VERSION = 1
+_BUILT_KEY = f"product_cards_built_v{CARDS_VERSION}"
+
+_rebuild_lock = asyncio.Lock()
+
+
+def sale_signature(sale: Optional[dict]) -> str:
+    """Only the sale percent changes card prices; the headline/end time don't."""
+    return f"{float(sale['percent']):g}" if sale else ""
+
+
+def _card_row(project: dict, sale: Optional[dict], image_widths: Optional[Dict[str, int]] = None) -> dict:
+    from commerce_routes import _project_card
+    return {
+        "slug": project.get("slug"),
+        "project_id": project.get("project_id"),
+        "title": project.get("title", ""),
+        "subtitle": project.get("subtitle", ""),
+        "published": bool(project.get("published")),
+        "buyable": is_buyable(project),
+        "featured": bool(project.get("featured")),
+        "position": project.get("position", 0),
+        "created_at": project.get("created_at"),
+        "from_price": project_from_price(project),
+        "collections": project.get("collections") or [],
+        "tags": project.get("tags") or [],
+        "card": _project_card(project, sale, image_widths),
+        "sale_sig": sale_signature(sale),
+        "updated_at": datetime.now(timezone.utc),
+    }
+
+
+async def ensure_indexes():
+    try:
+        await db.product_cards.create_index("slug", unique=True)
+    except Exception:
+        pass
+    await db.product_cards.create_index([("published", 1), ("buyable", 1), ("featured", -1), ("position", 1), ("created_at", -1)])
+    await db.product_cards.create_index([("collections", 1), ("buyable", 1)])
+    await db.product_cards.create_index("tags")
+    await db.product_cards.create_index("from_price")
+
+
+async def ensure_built():
+    """Claim a rebuild when the card set is missing or stale; the claiming
+    worker runs it in the background."""
+    projects = await db.projects.count_documents({"slug": {"$nin": [None, ""]}})
+    if projects != await db.product_cards.count_documents({}):
+        await db.settings.delete_one({"key": _BUILT_KEY, "state": "done"})
+    claimed, as_of = await seed_claim.claim(_BUILT_KEY)
+    if claimed:
+        await seed_claim.run(_BUILT_KEY, as_of, lambda _: rebuild_product_cards(), settle=False)
+
+
+async def sync_project_card(slug: str, previous_slug: Optional[str] = None):
+    """Rewrite (or drop) the card row for one project. Best-effort — a failed
+    refresh must never fail the admin/API write that triggered it; a manual
+    rebuild repairs any drift."""
+    try:
+        from commerce_routes import _get_sale, project_image_urls
+        if previous_slug and previous_slug != slug:
+            await db.product_cards.delete_one({"slug": previous_slug})
+        project = await db.projects.find_one({"slug": slug}, {"_id": 0})
+        if not project:
+            await db.product_cards.delete_one({"slug": slug})
+            return
+        row = _card_row(project, await _get_sale(), await original_widths(project_image_urls(project)))
+        await db.product_cards.update_one({"slug": slug}, {"$set": row}, upsert=True)
+    except Exception as e:
+        logger.error(f"product card refresh failed for {slug}: {e}")
+
+
+async def remove_project_card(slug: str):
+    try:
+        await db.product_cards.delete_one({"slug": slug})
+    except Exception as e:
+        logger.error(f"product card delete failed for {slug}: {e}")
+
+
+async def rebuild_product_cards() -> int:
+    """Rebuild every card row (startup, sale changes). Returns rows written."""
+    from commerce_routes import _get_sale, project_image_urls
+    async with _rebuild_lock:
+        sale = await _get_sale()
+        batch, slugs = [], []
+
+        async def flush(projects: list):
+            widths = await original_widths([u for p in projects for u in project_image_urls(p)])
+            await db.product_cards.bulk_write([
+                UpdateOne({"slug": p["slug"]}, {"$set": _card_row(p, sale, widths)}, upsert=True) for p in projects
+            ], ordered=False)
+
+        async for p in db.projects.find({}, {"_id": 0}):
+            if not p.get("slug"):
+                continue
+            slugs.append(p["slug"])
+            batch.append(p)
+            if len(batch) >= 500:
+                await flush(batch)
+                batch = []
+        if batch:
+            await flush(batch)
+        await db.product_cards.delete_many({"slug": {"$nin": slugs}})
+        logger.info(f"Rebuilt {len(slugs)} product cards")
+        return len(slugs)
+
+
+def _reprice(card: dict, sale: Optional[dict]) -> dict:
+    price, compare_at, on_sale = card_pricing(card.get("from_price") or 0.0, sale)
+    return {**card, "price": price, "compare_at_price": compare_at, "on_sale": on_sale}
+
+
+async def _rebuild_quietly():
+    try:
+        await rebuild_product_cards()
+    except Exception as e:
+        logger.error(f"product card rebuild failed: {e}")
+
+
+async def storefront_cards(query: dict, sort: Optional[list] = None, limit: int = 0) -> list:
+    """Read finished cards for the storefront.
+
+    Rows carry the sale they were priced with. If the live sale differs (e.g. it
+    expired on its own, with no admin write) the cards are re-priced in flight
+    and a background rebuild brings the rows back in line.
+    """
+    from commerce_routes import _get_sale
+    sale = await _get_sale()
+    sig = sale_signature(sale)
+    cursor = db.product_cards.find({**STOREFRONT_FILTER, **query}, {"_id": 0, "card": 1, "sale_sig": 1})
+    cursor = cursor.sort(sort or CARD_SORT)
+    if limit:
+        cursor = cursor.limit(limit)
+    cards, stale = [], False
+    async for row in cursor:
+        if row.get("sale_sig", "") != sig:
+            stale = True
+            cards.append(_reprice(row["card"], sale))
+        else:
+            cards.append(row["card"])
+    if stale and not _rebuild_lock.locked():
+        asyncio.create_task(_rebuild_quietly())
+    return cards
+
+
+async def collection_product_counts(slugs: Optional[list] = None) -> dict:
+    """{collection_slug: buyable product count} in one aggregation pass.
+    Pass `slugs` to restrict the count to those collections."""
+    match = dict(STOREFRONT_FILTER)
+    if slugs is not None:
+        match["collections"] = {"$in": list(slugs)}
+    pipeline = [
+        {"$match": match},
+        {"$project": {"_id": 0, "collections": 1}},
+        {"$unwind": "$collections"},
+        {"$group": {"_id": "$collections", "count": {"$sum": 1}}},
+    ]
+    counts = {}
+    async for row in db.product_cards.aggregate(pipeline):
+        counts[row["_id"]] = row["count"]
+    return counts
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    print(f"rebuilt {asyncio.run(rebuild_product_cards())} product cards")
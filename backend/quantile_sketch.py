@@ -0,0 +1,52 @@
+"""Mergeable quantile sketch for durations (step times, time-to-submit).
+
+A log-bucketed histogram (DDSketch): a positive value v lands in bucket
+ceil(log_gamma(v)) with gamma = (1 + ALPHA) / (1 - ALPHA), so every quantile is
+returned within ALPHA (1%) relative error. A sketch is just {bucket: count};
+merging is adding counts, which also means Mongo can maintain one with `$inc`:
+
+    counts = merge([hour_a["b"], hour_b["b"]])
+    quantiles(counts, (0.5, 0.9, 0.99))   # {0.5: 8123.4, 0.9: ..., 0.99: ...}
+"""
+import math
+from typing import Dict, Iterable, Mapping, Optional
+
+ALPHA = 0.01
+GAMMA = (1 + ALPHA) / (1 - ALPHA)
+_LOG_GAMMA = math.log(GAMMA)
+
+
+def bucket(value: float) -> Optional[int]:
+    """Bucket index for a positive number; None for anything else."""
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not value > 0 or math.isinf(value):
+        return None
+    return math.ceil(math.log(value) / _LOG_GAMMA)
+
+
+def bucket_value(index: int) -> float:
+    return 2 * GAMMA ** index / (GAMMA + 1)
+
+
+def merge(sketches: Iterable[Mapping]) -> Dict[int, int]:
+    """Sum bucket counts (keys may be ints or the strings Mongo stores)."""
+    out: Dict[int, int] = {}
+    for sketch in sketches:
+        for k, n in (sketch or {}).items():
+            out[int(k)] = out.get(int(k), 0) + n
+    return out
+
+
+def quantiles(counts: Mapping[int, int], qs: Iterable[float]) -> Dict[float, float]:
+    qs = sorted(qs)
+    total = sum(counts.values())
+    if not total:
+        return {q: 0.0 for q in qs}
+    out, seen, items = {}, 0, sorted(counts.items())
+    i = 0
+    for q in qs:
+        rank = q * (total - 1)
+        while i < len(items) - 1 and seen + items[i][1] <= rank:
+            seen += items[i][1]
+            i += 1
+        out[q] = bucket_value(items[i][0])
+    return out
@@ -0,0 +1,61 @@
+"""Concurrent fan-out for independent dashboard queries.
+
+Admin analytics endpoints describe their queries as a dict of named,
+not-yet-awaited coroutines and hand them to `fan_out`, which runs them
+concurrently (bounded by ANALYTICS_QUERY_CONCURRENCY so one dashboard load
+can't monopolize the Mongo pool) and returns the results by name:
+
+    r = await fan_out({
+        "sessions": rollup_counts(start, end, ["event_name"]),
+        "leads": db.leads.aggregate(pipeline).to_list(10),
+    }, response)
+
+The concurrency limit is per `fan_out` call, so one heavy dashboard request
+can't starve the others of slots; the total across requests is bounded by
+the Motor connection pool.
+
+Per-query wall time can be reported in a `Server-Timing` header, so the
+browser's network panel shows which query dominates a slow load. It's a
+debug aid that exposes internal query names, so endpoints take the response
+through the `server_timing` dependency, which only hands it over when
+ANALYTICS_SERVER_TIMING is set or the (admin) caller sends
+`X-Debug-Timing: 1`.
+"""
+import os
+import asyncio
+import time
+from typing import Any, Awaitable, Dict, Optional
+
+from fastapi import Request, Response
+
+ANALYTICS_QUERY_CONCURRENCY = int(os.environ.get("ANALYTICS_QUERY_CONCURRENCY", "8"))
+ANALYTICS_SERVER_TIMING = os.environ.get("ANALYTICS_SERVER_TIMING", "").lower() in ("1", "true", "yes")
+
+
+def server_timing(request: Request, response: Response) -> Optional[Response]:
+    """Dependency: the response to put `Server-Timing` on, or None when
+    timing wasn't asked for."""
+    if ANALYTICS_SERVER_TIMING or request.headers.get("x-debug-timing") == "1":
+        return response
+    return None
+
+
+async def fan_out(queries: Dict[str, Awaitable], response: Optional[Response] = None) -> Dict[str, Any]:
+    timings: Dict[str, float] = {}
+    semaphore = asyncio.Semaphore(ANALYTICS_QUERY_CONCURRENCY)
+
+    async def timed(name: str, query: Awaitable):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                return await query
+            finally:
+                timings[name] = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(timed(name, q) for name, q in queries.items()))
+    if response is not None:
+        total = (time.perf_counter() - started) * 1000
+        metrics = [f"{name.replace(' ', '_')};dur={ms:.1f}" for name, ms in timings.items()]
+        response.headers["Server-Timing"] = ", ".join(metrics + [f"total;dur={total:.1f}"])
+    return dict(zip(queries, results))
@@ -0,0 +1,183 @@
+"""Prefix search over leads and message threads for the admin search boxes.
+
+`db.search_index` holds one entry per searchable document:
+
+    {kind: "lead" | "thread", ref: <lead_id | thread_id>, ts, tokens: [...], terms: [...]}
+
+`tokens` are the normalized words of the searchable fields (accents folded,
+lowercased, split on anything that isn't a letter or digit); `terms` are their
+edge n-grams, so "jo" finds "Johnson" through the multikey (kind, terms, ts)
+index instead of a regex scan. Phone numbers are indexed as digits, with and
+without the country code and as the 7-digit local number, plus the last 4
+digits, so "585-710", "(585) 710", "710-82" and "8292" all find "+15857108292".
+
+Entries are written when leads/threads are created (`index_lead`,
+`index_thread`; wizard leads get theirs from a lead_pipeline stage).
+`matching_refs` feeds the list endpoints' filters with every match (they
+apply status/date filters and paging themselves); `search` ranks the newest
+SEARCH_CANDIDATES matches: a query word that equals a whole indexed word
+scores above a prefix hit, then newer documents first. `python
+search_index.py` rebuilds every entry.
+"""
+import re
+import asyncio
+import logging
+import unicodedata
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+import seed_claim
+from admin_routes import db
+
+logger = logging.getLogger(__name__)
+
+MAX_GRAM = 20
+MAX_QUERY_TERMS = 8
+SEARCH_CANDIDATES = 1000
+_SEEDED_KEY = "search_index_built"
+
+# kind -> (collection, id field, text fields, phone fields, time field)
+KINDS = {
+    "lead": ("leads", "lead_id", ("first_name", "last_name", "email", "lead_id"), ("phone",), "created_at"),
+    "thread": ("message_threads", "thread_id", ("user_name", "user_email", "project_title", "thread_id"), ("user_phone",), "created_at"),
+}
+
+_SPLIT = re.compile(r"[^0-9a-z]+")
+_PHONE_QUERY = re.compile(r"^[\d\s()+\-.]+$")
+
+
+def _fold(text: str) -> str:
+    text = unicodedata.normalize("NFKD", str(text))
+    return "".join(c for c in text if not unicodedata.combining(c)).lower()
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    return [t for t in _SPLIT.split(_fold(text or "")) if t]
+
+
+def _edge_ngrams(token: str) -> List[str]:
+    return [token[:i] for i in range(1, min(len(token), MAX_GRAM) + 1)]
+
+
+def _phone_forms(phone: Optional[str]) -> Tuple[List[str], List[str]]:
+    """(prefix-searchable digit strings, exact-only tails) for a phone number."""
+    digits = re.sub(r"\D", "", phone or "")
+    if len(digits) < 4:
+        return [], []
+    # full, national (no country code) and local number, so a search can start at any of them
+    forms = [digits] + [digits[-n:] for n in (10, 7) if len(digits) > n]
+    return forms, [digits[-4:]]
+
+
+def entry_for(kind: str, doc: dict) -> dict:
+    """The search_index fields for one lead/thread document."""
+    _, id_field, text_fields, phone_fields, time_field = KINDS[kind]
+    tokens, terms = set(), set()
+    for field in text_fields:
+        for token in tokenize(doc.get(field)):
+            tokens.add(token)
+            terms.update(_edge_ngrams(token))
+    for field in phone_fields:
+        forms, tails = _phone_forms(doc.get(field))
+        for form in forms:
+            tokens.add(form)
+            terms.update(_edge_ngrams(form))
+        tokens.update(tails)
+        terms.update(tails)
+    return {"kind": kind, "ref": doc[id_field], "ts": doc.get(time_field), "tokens": sorted(tokens), "terms": sorted(terms)}
+
+
+def query_terms(q: Optional[str]) -> List[str]:
+    """Normalize a search box string the way documents are indexed."""
+    q = (q or "").strip()
+    digits = re.sub(r"\D", "", q)
+    if _PHONE_QUERY.match(q) and len(digits) >= 3:
+        return [digits[:MAX_GRAM]]
+    return [t[:MAX_GRAM] for t in tokenize(q)][:MAX_QUERY_TERMS]
+
+
+# ── Writing ──────────────────────────────────────────────────
+
+def _upsert(entry: dict) -> UpdateOne:
+    return UpdateOne({"kind": entry["kind"], "ref": entry["ref"]}, {"$set": entry}, upsert=True)
+
+
+async def index_doc(kind: str, doc: dict):
+    entry = entry_for(kind, doc)
+    await db.search_index.update_one({"kind": kind, "ref": entry["ref"]}, {"$set": entry}, upsert=True)
+
+
+async def index_lead(lead: dict):
+    await index_doc("lead", lead)
+
+
+async def index_thread(thread: dict):
+    await index_doc("thread", thread)
+
+
+async def rebuild() -> int:
+    """Re-index every lead and thread."""
+    total = 0
+    for kind, (collection, id_field, text_fields, phone_fields, time_field) in KINDS.items():
+        projection = {"_id": 0, id_field: 1, time_field: 1, **{f: 1 for f in text_fields + phone_fields}}
+        ops: List[UpdateOne] = []
+        async for doc in db[collection].find({id_field: {"$exists": True}}, projection).batch_size(1000):
+            ops.append(_upsert(entry_for(kind, doc)))
+            if len(ops) >= 1000:
+                await db.search_index.bulk_write(ops, ordered=False)
+                total += len(ops)
+                ops = []
+        if ops:
+            await db.search_index.bulk_write(ops, ordered=False)
+            total += len(ops)
+    logger.info(f"Indexed {total} documents for search")
+    return total
+
+
+async def ensure_indexes():
+    """Index the search entries. The first time, one worker (seed_claim)
+    builds them from scratch in the background."""
+    await db.search_index.create_index([("kind", 1), ("ref", 1)], unique=True)
+    await db.search_index.create_index([("kind", 1), ("terms", 1), ("ts", -1)])
+    claimed, as_of = await seed_claim.claim(_SEEDED_KEY)
+    if claimed:
+        await seed_claim.run(_SEEDED_KEY, as_of, lambda _: rebuild(), settle=False)
+
+
+# ── Querying ─────────────────────────────────────────────────
+
+async def _candidates(kind: str, terms: List[str]) -> List[dict]:
+    return await db.search_index.find(
+        {"kind": kind, "terms": {"$all": terms}}, {"_id": 0, "ref": 1, "tokens": 1, "ts": 1}
+    ).sort("ts", -1).limit(SEARCH_CANDIDATES).to_list(SEARCH_CANDIDATES)
+
+
+async def matching_refs(kind: str, q: Optional[str]) -> Optional[List[str]]:
+    """Ids of every document matching every query word, or None when the query
+    has nothing searchable in it. Not capped: the list endpoints combine it
+    with their own filters and paging, so a truncated set would drop older
+    matches."""
+    terms = query_terms(q)
+    if not terms:
+        return None
+    cursor = db.search_index.find({"kind": kind, "terms": {"$all": terms}}, {"_id": 0, "ref": 1}).batch_size(10000)
+    return [c["ref"] async for c in cursor]
+
+
+async def search(kind: str, q: Optional[str], limit: int = 20) -> List[Dict]:
+    """[{ref, score}] best first: whole-word hits outrank prefix hits, then newest."""
+    terms = query_terms(q)
+    if not terms:
+        return []
+    ranked = []
+    for i, c in enumerate(await _candidates(kind, terms)):
+        tokens = set(c.get("tokens") or [])
+        score = sum(2 if t in tokens else 1 for t in terms)
+        ranked.append((-score, i, c["ref"], score))   # i keeps the newest-first order within a score
+    ranked.sort()
+    return [{"ref": ref, "score": score} for _, _, ref, score in ranked[:limit]]
+
+
+if __name__ == "__main__":
+    print(f"indexed {asyncio.run(rebuild())} documents")
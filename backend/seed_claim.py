@@ -0,0 +1,131 @@
+"""One-time seeding of event-derived tables, claimed by a single worker.
+
+event_stats, timing_sketches and visitor_features are kept current by
+`event_buffer` flush hooks that `$inc` into them from every worker, and are
+seeded once from `db.events`. Seeding must neither run on every worker nor
+overwrite increments the hooks make while it scans, so:
+
+- `claim(key)` atomically marks `db.settings {key}` as seeding, owned by
+  this process, with a cutoff `as_of` (now). Only the winner gets
+  `claimed=True`; the others skip. An already-seeded marker means skip too.
+- The winner hands its seed to `run(key, as_of, fill)`, which runs it in a
+  background task so startup isn't held up by a full `db.events` scan: it
+  waits SEED_SETTLE (so events stamped before the cutoff but still in some
+  worker's write buffer are stored first), calls `fill(as_of)` and marks the
+  seed done.
+- Every worker's hook counts only events at or after the cutoff
+  (`counts(doc, as_of)`); the seeder counts only events before it and writes
+  with the same commutative operators (`$inc`, `$min`, `$max`), so the two
+  add up instead of racing.
+- A seeder that dies (or is stopped mid-seed) leaves the claim to
+  expire after SEED_LEASE; the next worker to start takes it over with the
+  original cutoff (the other workers already count from it). Whatever the
+  dead seeder wrote stays, so a takeover is logged: re-run that module's
+  rebuild with ingestion paused if it matters.
+
+Markers written before the cutoff existed ({key, at}) count as done, with
+no cutoff. One-off rebuilds that need no cutoff (search entries, product
+cards) use the same claim so only one worker runs them.
+"""
+import uuid
+import asyncio
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import Awaitable, Callable, Optional, Set, Tuple
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from admin_routes import db
+
+logger = logging.getLogger(__name__)
+
+SEED_LEASE = timedelta(hours=1)
+SEED_SETTLE = timedelta(seconds=5)   # > event_buffer's flush interval
+
+_owner = uuid.uuid4().hex
+_tasks: Set[asyncio.Task] = set()
+
+
+def _aware(dt: Optional[datetime]) -> Optional[datetime]:
+    return dt.replace(tzinfo=timezone.utc) if dt and dt.tzinfo is None else dt
+
+
+def counts(doc: dict, as_of: Optional[datetime]) -> bool:
+    """Whether a flush hook should count `doc` given the seed cutoff."""
+    if as_of is None:
+        return True
+    ts = doc.get("server_timestamp")
+    return isinstance(ts, datetime) and _aware(ts) >= as_of
+
+
+async def claim(key: str) -> Tuple[bool, Optional[datetime]]:
+    """(claimed, as_of): whether this process must seed `key` now, and the
+    cutoff every hook should count from."""
+    now = datetime.now(timezone.utc)
+    now = now.replace(microsecond=now.microsecond - now.microsecond % 1000)   # BSON dates are ms
+    marker = await db.settings.find_one({"key": key})
+    if marker and marker.get("state", "done") == "done":
+        return False, _aware(marker.get("as_of"))
+    try:
+        doc = await db.settings.find_one_and_update(
+            {"key": key, "$or": [{"state": {"$exists": False}}, {"state": "seeding", "lease_until": {"$lt": now}}]},
+            [{"$set": {"key": key, "state": "seeding", "owner": _owner, "as_of": {"$ifNull": ["$as_of", now]}, "lease_until": now + SEED_LEASE}}],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        doc = None   # another worker holds (or just finished) the claim
+    if doc and doc.get("owner") == _owner:
+        as_of = _aware(doc["as_of"])
+        if as_of < now:
+            logger.warning(f"taking over an expired {key} seed (cutoff {as_of.isoformat()}); partial writes from the previous seeder remain")
+        return True, as_of
+    marker = await db.settings.find_one({"key": key}) or {}
+    return False, _aware(marker.get("as_of"))
+
+
+async def _seed(key: str, as_of: datetime, fill: Callable[[datetime], Awaitable[int]], settle: bool):
+    if settle:
+        await asyncio.sleep(SEED_SETTLE.total_seconds())
+    await fill(as_of)
+    await finish(key)
+
+
+async def _seed_quietly(key: str, as_of: datetime, fill: Callable[[datetime], Awaitable[int]], settle: bool):
+    try:
+        await _seed(key, as_of, fill, settle)
+    except Exception as e:
+        logger.error(f"{key} seed failed (retried after the lease expires): {e}")
+
+
+async def run(key: str, as_of: datetime, fill: Callable[[datetime], Awaitable[int]], background: bool = True, settle: bool = True):
+    """Seed a claimed `key`: wait SEED_SETTLE (unless `settle` is False), call
+    `fill(as_of)` and mark it done. In a background task unless `background`
+    is False (manual rebuilds, which want errors raised)."""
+    if not background:
+        await _seed(key, as_of, fill, settle)
+        return
+    task = asyncio.create_task(_seed_quietly(key, as_of, fill, settle))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def stop():
+    """Cancel seeds still running (shutdown); their claims expire and the
+    next start takes them over."""
+    for task in list(_tasks):
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+
+
+async def finish(key: str):
+    await db.settings.update_one(
+        {"key": key, "owner": _owner},
+        {"$set": {"state": "done", "at": datetime.now(timezone.utc)}, "$unset": {"lease_until": ""}},
+    )
+
+
+async def reset(key: str):
+    """Forget the marker so the next start seeds again (manual rebuilds)."""
+    await db.settings.delete_many({"key": key})
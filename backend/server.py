@@ -1,5 +1,6 @@
 import os
 import uuid
+import asyncio
 import logging
 
 logger = logging.getLogger(__name__)
@@ -15,7 +16,7 @@ load_dotenv("/app/backend/.env")
 from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Depends, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, Response, RedirectResponse
+from fastapi.responses import FileResponse, Response, RedirectResponse, StreamingResponse
 from pydantic import BaseModel, Field
 from motor.motor_asyncio import AsyncIOMotorClient
 import jwt
@@ -25,7 +26,6 @@ import aiofiles
 from twilio.rest import Client as TwilioClient
 # SendGrid for email OTP
 from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail as SGMail
 
 # Environment
 MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
@@ -54,18 +54,30 @@ async def lifespan(app: FastAPI):
     # Initialize cloud storage
     try:
         from storage import init_storage
-        init_storage()
+        await init_storage()
         logger.info("Cloud storage initialized")
     except Exception as e:
         logger.error(f"Cloud storage init failed: {e}")
+    try:
+        import media_cache
+        await media_cache.load()
+    except Exception as e:
+        logger.error(f"Media cache load failed: {e}")
     # Drop problematic phone index
     try:
         await db.users.drop_index("phone_1")
     except Exception:
         pass
+    # One doc per settings key: state/lease docs are created by concurrent
+    # upserts from every worker on first boot.
+    try:
+        await db.settings.create_index("key", unique=True, partialFilterExpression={"key": {"$type": "string"}})
+    except Exception as e:
+        logger.error(f"settings key index failed (duplicate keys?): {e}")
     await db.leads.create_index("lead_id", unique=True)
     await db.leads.create_index("email")
     await db.leads.create_index("created_at")
+    await db.leads.create_index([("created_at", -1), ("lead_id", -1)])
     await db.wizard_sessions.create_index("lead_id", unique=True)
     await db.users.create_index("email", unique=True, sparse=True)
     try:
@@ -88,6 +100,7 @@ async def lifespan(app: FastAPI):
     await db.quotes.create_index("lead_id")
     await db.orders.create_index("order_id", unique=True)
     await db.orders.create_index("lead_id")
+    await db.orders.create_index([("created_at", -1), ("order_id", -1)])
     # Projects (Past Custom Work CMS)
     try:
         await db.projects.create_index("slug", unique=True)
@@ -96,6 +109,14 @@ async def lifespan(app: FastAPI):
     await db.projects.create_index("published")
     await db.projects.create_index("tags")
     await db.projects.create_index([("published", 1), ("featured", -1), ("position", 1)])
+    # Storefront product-card read model — rebuilt (by one worker, in the
+    # background) only when missing or stale; writes keep it current.
+    try:
+        from product_cards import ensure_indexes as ensure_card_indexes, ensure_built as ensure_cards_built
+        await ensure_card_indexes()
+        await ensure_cards_built()
+    except Exception as e:
+        logger.error(f"product card rebuild on startup failed: {e}")
     # Blog posts
     try:
         await db.blog_posts.create_index("slug", unique=True)
@@ -107,7 +128,12 @@ async def lifespan(app: FastAPI):
     await db.message_threads.create_index("user_id")
     await db.message_threads.create_index("project_slug")
     await db.message_threads.create_index([("updated_at", -1)])
+    await db.message_threads.create_index([("updated_at", -1), ("thread_id", -1)])
     await db.shop_orders.create_index("email")
+    await db.shop_orders.create_index("created_at")
+    await db.shop_orders.create_index([("created_at", -1), ("order_id", -1)])
+    await db.contact_submissions.create_index([("created_at", -1), ("submission_id", -1)])
+    await db.image_derivatives.create_index("path", unique=True)
     await db.user_sessions.create_index("session_token")
     await db.users.update_many({"phone": ""}, {"$unset": {"phone": ""}})
     # Ensure IndexNow key exists & verification file is written
@@ -120,7 +146,72 @@ async def lifespan(app: FastAPI):
         await regenerate_static_sitemap()
     except Exception as e:
         logger.error(f"sitemap regen on startup failed: {e}")
+    from event_buffer import event_buffer
+    import seed_claim
+    # Per-event counters (events-health) — registers its flush hook on import.
+    # These three seed from db.events on one worker, in the background.
+    try:
+        import event_stats
+        await event_stats.ensure_seeded()
+    except Exception as e:
+        logger.error(f"event_stats seed failed: {e}")
+    # Per-visitor features for lead scoring — also a flush hook.
+    try:
+        import visitor_features
+        await visitor_features.ensure_seeded()
+    except Exception as e:
+        logger.error(f"visitor_features seed failed: {e}")
+    # Step-time / time-to-submit percentile sketches — also a flush hook.
+    try:
+        import timing_sketches
+        await timing_sketches.ensure_seeded()
+    except Exception as e:
+        logger.error(f"timing_sketches seed failed: {e}")
+    event_buffer.start()
+    geoip.start_enricher()
+    # Hourly/daily event rollups behind the admin analytics endpoints
+    import event_rollups
+    try:
+        await event_rollups.ensure_indexes()
+    except Exception as e:
+        logger.error(f"event rollup index setup failed: {e}")
+    event_rollups.start()
+    # Per-session step sequences for the strict funnel
+    import funnel_engine
+    try:
+        await funnel_engine.ensure_indexes()
+    except Exception as e:
+        logger.error(f"funnel index setup failed: {e}")
+    funnel_engine.start()
+    # Outbound email/SMS workers
+    import outbox
+    try:
+        await outbox.ensure_indexes()
+    except Exception as e:
+        logger.error(f"outbox index setup failed: {e}")
+    outbox.start()
+    # Admin search entries for leads and threads
+    import search_index
+    try:
+        await search_index.ensure_indexes()
+    except Exception as e:
+        logger.error(f"search index setup failed: {e}")
+    # Background stages for wizard lead submissions
+    try:
+        await lead_pipeline.ensure_indexes()
+    except Exception as e:
+        logger.error(f"lead pipeline index setup failed: {e}")
+    lead_pipeline.start()
     yield
+    await seed_claim.stop()
+    await lead_pipeline.stop()
+    await outbox.stop()
+    await funnel_engine.stop()
+    await event_rollups.stop()
+    await geoip.stop_enricher()
+    await event_buffer.drain()
+    import image_derivatives
+    image_derivatives.shutdown()
     client.close()
 
 app = FastAPI(lifespan=lifespan)
@@ -143,6 +234,13 @@ app.include_router(admin_router)
 from commerce_routes import router as commerce_router
 app.include_router(commerce_router)
 
+# Outbound email/SMS go through the outbox worker, never the request path
+from outbox import channel_ready, enqueue_email, enqueue_sms, sms_message
+import lead_pipeline
+from lead_scoring import score_lead
+from search_index import index_lead, index_thread
+from ttl_cache import TTLCache
+
 # ── Helpers ──────────────────────────────────────────────────
 
 def serialize_doc(doc):
@@ -160,29 +258,60 @@ def serialize_doc(doc):
             doc[key] = serialize_doc(value)
     return doc
 
-def create_jwt(user_id: str, email: str = None):
+def create_jwt(user_id: str, email: str = None, lead_id: str = None):
     payload = {
         "user_id": user_id,
         "email": email,
         "exp": datetime.now(timezone.utc) + timedelta(days=30),
         "iat": datetime.now(timezone.utc),
     }
+    if lead_id:
+        # Lead-submit tokens: user_id is provisional until lead_pipeline links the lead.
+        payload["lead_id"] = lead_id
     return jwt.encode(payload, JWT_SECRET, algorithm="HS256")
 
-async def get_current_user(authorization: Optional[str] = Header(None)):
+# Verified tokens (by digest) -> user_id. Portal pages fire several /api/me/*
+# calls at once; each token costs one JWT decode (and, for lead tokens, one
+# lead lookup) per PRINCIPAL_TTL. The mapping never changes for a token, so it
+# is safe per worker. Profiles are not cached: a write on one worker must be
+# visible on the next request whichever worker serves it, and the indexed
+# users lookup is cheap.
+PRINCIPAL_TTL = 30
+_token_cache = TTLCache("auth_tokens", maxsize=10000, ttl=PRINCIPAL_TTL)
+
+async def _verified_user_id(authorization: Optional[str]) -> str:
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Not authenticated")
     token = authorization.split(" ")[1]
+    digest = hashlib.sha256(token.encode()).digest()
+    user_id = _token_cache.get(digest)
+    if user_id is not None:
+        return user_id
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
-        user = await db.users.find_one({"user_id": payload["user_id"]})
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
-        return serialize_doc(user)
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    user_id = await lead_pipeline.resolve_user(payload["lead_id"]) if payload.get("lead_id") else payload.get("user_id")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    # Never serve a token from cache past its own expiry.
+    ttl = min(PRINCIPAL_TTL, payload["exp"] - time.time()) if "exp" in payload else PRINCIPAL_TTL
+    if ttl > 0:
+        _token_cache.set(digest, user_id, ttl=ttl)
+    return user_id
+
+async def get_current_user_id(authorization: Optional[str] = Header(None)) -> str:
+    """Just the verified user_id, for endpoints that only scope queries by it."""
+    return await _verified_user_id(authorization)
+
+async def get_current_user(authorization: Optional[str] = Header(None)):
+    user_id = await _verified_user_id(authorization)
+    user = await db.users.find_one({"user_id": user_id})
+    if not user:
+        raise HTTPException(status_code=401, detail="User not found")
+    return serialize_doc(user)
 
 # ── Models ───────────────────────────────────────────────────
 
@@ -262,77 +391,140 @@ async def wizard_restore(lead_id: str):
 @app.post("/api/uploads")
 async def upload_files(files: List[UploadFile] = File(...)):
     from storage import upload_file as cloud_upload
-    uploaded = []
-    # Allow up to 8 files per call (admin journey/gallery batches). Per-file size cap below.
-    for file in files[:8]:
-        content = await file.read()
-        # 100 MB cap — fits short product videos (HEIC, MP4, MOV)
-        if len(content) > 100 * 1024 * 1024:
-            continue
-        try:
-            result = cloud_upload(
-                data=content,
-                original_filename=file.filename or "file.png",
-                content_type=file.content_type,
-                subfolder="uploads",
-            )
-            ct = (result.get("content_type") or "").lower()
-            if ct.startswith("audio/"):
-                mtype = "audio"
-            elif ct.startswith("video/"):
-                mtype = "video"
-            else:
-                mtype = "image"
-            uploaded.append({
-                "filename": result["filename"],
-                "original_name": result["original_name"],
-                "storage_path": result["storage_path"],
-                "content_type": result["content_type"],
-                "media_type": mtype,
-                "url": f"/api/uploads/cloud/{result['storage_path']}",
-            })
-        except Exception as e:
-            logger.error(f"Cloud upload failed for {file.filename}: {e}")
-            # Fallback to local storage
-            ext = os.path.splitext(file.filename)[1] if file.filename else ".png"
-            filename = f"{uuid.uuid4().hex}{ext}"
-            filepath = os.path.join(UPLOAD_DIR, filename)
-            async with aiofiles.open(filepath, "wb") as f:
-                await f.write(content)
-            ct = (file.content_type or "").lower()
-            if ct.startswith("audio/"):
-                mtype = "audio"
-            elif ct.startswith("video/"):
-                mtype = "video"
-            else:
-                mtype = "image"
-            uploaded.append({
-                "filename": filename,
-                "original_name": file.filename,
-                "media_type": mtype,
-                "url": f"/api/uploads/files/{filename}",
-            })
+    sem = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+    async def store(file: UploadFile):
+        async with sem:
+            content = await file.read()
+            # 100 MB cap — fits short product videos (HEIC, MP4, MOV)
+            if len(content) > 100 * 1024 * 1024:
+                return None
+            try:
+                result = await cloud_upload(
+                    data=content,
+                    original_filename=file.filename or "file.png",
+                    content_type=file.content_type,
+                    subfolder="uploads",
+                )
+                ct = (result.get("content_type") or "").lower()
+                if ct.startswith("audio/"):
+                    mtype = "audio"
+                elif ct.startswith("video/"):
+                    mtype = "video"
+                else:
+                    mtype = "image"
+                    import image_derivatives
+                    await image_derivatives.record_original(result["storage_path"], content)
+                    image_derivatives.generate_in_background(result["storage_path"], content)
+                return {
+                    "filename": result["filename"],
+                    "original_name": result["original_name"],
+                    "storage_path": result["storage_path"],
+                    "content_type": result["content_type"],
+                    "media_type": mtype,
+                    "url": f"/api/uploads/cloud/{result['storage_path']}",
+                }
+            except Exception as e:
+                logger.error(f"Cloud upload failed for {file.filename}: {e}")
+                # Fallback to local storage
+                ext = os.path.splitext(file.filename)[1] if file.filename else ".png"
+                filename = f"{uuid.uuid4().hex}{ext}"
+                filepath = os.path.join(UPLOAD_DIR, filename)
+                async with aiofiles.open(filepath, "wb") as f:
+                    await f.write(content)
+                ct = (file.content_type or "").lower()
+                if ct.startswith("audio/"):
+                    mtype = "audio"
+                elif ct.startswith("video/"):
+                    mtype = "video"
+                else:
+                    mtype = "image"
+                return {
+                    "filename": filename,
+                    "original_name": file.filename,
+                    "media_type": mtype,
+                    "url": f"/api/uploads/files/{filename}",
+                }
+
+    # Allow up to 8 files per call (admin journey/gallery batches), uploaded in
+    # parallel; results keep request order. Per-file size cap above.
+    results = await asyncio.gather(*(store(f) for f in files[:8]))
+    uploaded = [r for r in results if r]
     return {"files": uploaded}
 
+def _object_headers(obj: dict) -> dict:
+    """Passthrough headers for a streamed R2 object."""
+    from email.utils import format_datetime
+    headers = {"Accept-Ranges": "bytes"}
+    if obj.get("content_length") is not None:
+        headers["Content-Length"] = str(obj["content_length"])
+    if obj.get("content_range"):
+        headers["Content-Range"] = obj["content_range"]
+    if obj.get("etag"):
+        headers["ETag"] = obj["etag"]
+    if obj.get("last_modified"):
+        headers["Last-Modified"] = format_datetime(obj["last_modified"], usegmt=True)
+    return headers
+
 @app.get("/api/uploads/cloud/{path:path}")
-async def serve_cloud_file(path: str):
-    """Serve a file from cloud storage"""
-    from storage import download_file as cloud_download
+async def serve_cloud_file(path: str, request: Request, w: Optional[int] = None, fm: Optional[str] = None):
+    """Stream a file from cloud storage (Range / If-None-Match aware).
+    `?w=640&fm=webp` serves a resized derivative of a raster image."""
+    from storage import open_object, iter_body, parse_range, ObjectNotModified, RangeNotSatisfiable
+    import media_cache
+    import image_derivatives
+    if w and image_derivatives.is_raster(path):
+        try:
+            path = await image_derivatives.ensure(path, w, fm or image_derivatives.DEFAULT_FORMAT)
+        except Exception as e:
+            # Serve the original rather than a broken image.
+            logger.error(f"Image derivative failed for {path}: {e}")
+    byte_range = parse_range(request.headers.get("range", ""))
+    if_none_match = request.headers.get("if-none-match", "")
     try:
-        data, content_type = cloud_download(path)
-        return Response(content=data, media_type=content_type)
+        # Hot media is served from the local disk cache; only whole-object
+        # requests fill it, so video scrubbing on a miss still goes to R2.
+        # A blob evicted by another worker meanwhile, or a local disk error,
+        # falls back to R2 too.
+        entry = await media_cache.lookup(path, fill=not byte_range)
+        if entry and if_none_match and if_none_match == entry["etag"]:
+            raise ObjectNotModified(path)
+        cached = await media_cache.open_cached(entry, byte_range) if entry else None
+        obj = cached or await open_object(path, byte_range, if_none_match)
+    except ObjectNotModified:
+        return Response(status_code=304, headers={"ETag": if_none_match})
+    except RangeNotSatisfiable as e:
+        headers = {"Accept-Ranges": "bytes"}
+        if e.size is not None:
+            headers["Content-Range"] = f"bytes */{e.size}"
+        return Response(status_code=416, headers=headers)
     except Exception as e:
         logger.error(f"Cloud download failed for {path}: {e}")
         raise HTTPException(404, "File not found in cloud storage")
+    if cached:
+        return media_cache.CachedFileResponse(
+            obj,
+            status_code=206 if obj["content_range"] else 200,
+            headers=_object_headers(obj),
+        )
+    return StreamingResponse(
+        iter_body(obj["body"]),
+        status_code=206 if obj["content_range"] else 200,
+        media_type=obj["content_type"],
+        headers=_object_headers(obj),
+    )
 
 @app.get("/api/uploads/download/{path:path}")
 async def download_file(path: str):
     """Force-download a file — tries cloud first, then local disk"""
-    from storage import download_file as cloud_download
+    from storage import open_object, iter_body
 
     # Try cloud storage first
     try:
-        data, content_type = cloud_download(path)
+        obj = await open_object(path)
+    except Exception:
+        obj = None
+    if obj:
         # Look up original name from DB
         lead = await db.leads.find_one(
             {"inspiration_files.storage_path": path},
@@ -341,13 +533,13 @@ async def download_file(path: str):
         original_name = path.split("/")[-1]
         if lead and lead.get("inspiration_files"):
             original_name = lead["inspiration_files"][0].get("original_name", original_name)
-        return Response(
-            content=data,
+        headers = _object_headers(obj)
+        headers["Content-Disposition"] = f'attachment; filename="{original_name}"'
+        return StreamingResponse(
+            iter_body(obj["body"]),
             media_type="application/octet-stream",
-            headers={"Content-Disposition": f'attachment; filename="{original_name}"'}
+            headers=headers,
         )
-    except Exception:
-        pass
 
     # Fallback to local file (for old uploads)
     filename = path.split("/")[-1] if "/" in path else path
@@ -431,42 +623,25 @@ async def get_public_project_by_slug(slug: str):
         raise HTTPException(404, "Project not found")
     out = _project_strip_internal(doc)
     # Attach commerce buy-data so the project detail page can render the Buy box
-    from variant_options import project_from_price, is_buyable, normalize_sale, DEFAULT_PRODUCT_TYPE
-    sale_doc = await db.settings.find_one({"key": "global_sale"}, {"_id": 0})
+    from variant_options import project_from_price, is_buyable, DEFAULT_PRODUCT_TYPE
+    from commerce_routes import _get_sale
     out["buyable"] = is_buyable(doc)
     out["from_price"] = project_from_price(doc)
     out["price_matrix"] = doc.get("price_matrix") or {}
     out["collections"] = doc.get("collections") or []
     out["product_type"] = doc.get("product_type") or (DEFAULT_PRODUCT_TYPE if out["buyable"] else "custom_project")
-    out["sale"] = normalize_sale(sale_doc)
+    out["sale"] = await _get_sale()
 
     # "You may also love" — related buyable projects, scoped to same collections,
     # falls back to any buyable project so the section is never empty.
-    from commerce_routes import _project_card
-    sale = normalize_sale(sale_doc)
+    from product_cards import storefront_cards
     related = []
-    seen = {slug}
     cols = out["collections"]
     if cols:
-        async for r in db.projects.find(
-            {"published": True, "slug": {"$ne": slug}, "collections": {"$in": cols}},
-            {"_id": 0},
-        ).limit(12):
-            if is_buyable(r) and r["slug"] not in seen:
-                related.append(_project_card(r, sale))
-                seen.add(r["slug"])
-            if len(related) >= 8:
-                break
+        related = await storefront_cards({"slug": {"$ne": slug}, "collections": {"$in": cols}}, limit=8)
     if len(related) < 4:
-        async for r in db.projects.find(
-            {"published": True, "slug": {"$nin": list(seen)}},
-            {"_id": 0},
-        ).limit(20):
-            if is_buyable(r) and r["slug"] not in seen:
-                related.append(_project_card(r, sale))
-                seen.add(r["slug"])
-            if len(related) >= 8:
-                break
+        seen = [slug] + [r["slug"] for r in related]
+        related += await storefront_cards({"slug": {"$nin": seen}}, limit=8 - len(related))
     out["related"] = related
     return out
 
@@ -534,13 +709,12 @@ async def submit_contact(req: ContactRequest, request: Request):
         "created_at": now,
     }
     await db.contact_submissions.insert_one(doc)
-    if sg_client:
+    if channel_ready("email"):
         try:
-            notif = SGMail(
-                from_email=SENDGRID_FROM_EMAIL,
-                to_emails=SENDGRID_FROM_EMAIL,
+            await enqueue_email(
+                SENDGRID_FROM_EMAIL,
                 subject=f"Contact form: {name}" + (f" — {req.subject}" if req.subject else ""),
-                html_content=f"""
+                html=f"""
                 <div style='font-family:-apple-system,sans-serif;max-width:520px;margin:0 auto;padding:28px 20px;'>
                     <h2 style='color:#0F5E4C;font-size:20px;margin:0 0 14px;'>New Contact Submission</h2>
                     <table style='width:100%;font-size:14px;border-collapse:collapse;'>
@@ -552,8 +726,8 @@ async def submit_contact(req: ContactRequest, request: Request):
                     <div style='margin-top:14px;padding:14px 16px;background:#F5F5F3;border-radius:10px;color:#1A1A1C;font-size:14px;line-height:1.5;'>{msg}</div>
                 </div>
                 """,
+                kind="contact_notify",
             )
-            sg_client.send(notif)
         except Exception as e:
             logger.warning(f"contact notify failed: {e}")
     return {"status": "received", "submission_id": doc["submission_id"]}
@@ -627,10 +801,14 @@ async def project_inquire(slug: str, req: ProjectInquireRequest, request: Reques
         "updated_at": now,
     }
     await db.message_threads.insert_one(thread_doc)
+    try:
+        await index_thread(thread_doc)
+    except Exception as e:
+        logger.warning(f"inquiry thread search index failed: {e}")
 
     lead_id = f"lead_{uuid.uuid4().hex[:12]}"
     try:
-        await db.leads.insert_one({
+        lead_doc = {
             "lead_id": lead_id,
             "user_id": user_id,
             "first_name": name,
@@ -645,23 +823,23 @@ async def project_inquire(slug: str, req: ProjectInquireRequest, request: Reques
             "status": "new",
             "comments": [],
             "internal_notes": [],
-            "score": 40,
-            "quality_flags": ["project_inquiry"],
             "created_at": now,
             "updated_at": now,
-        })
+        }
+        lead_doc.update(await score_lead(lead_doc))
+        await db.leads.insert_one(lead_doc)
+        await index_lead(lead_doc)
     except Exception as e:
         logger.warning(f"inquiry lead insert failed: {e}")
 
     token = create_jwt(user_id, email_val)
 
-    if sg_client:
+    if channel_ready("email"):
         try:
-            notif = SGMail(
-                from_email=SENDGRID_FROM_EMAIL,
-                to_emails=SENDGRID_FROM_EMAIL,
+            await enqueue_email(
+                SENDGRID_FROM_EMAIL,
                 subject=f"New project inquiry: {project.get('title', slug)}",
-                html_content=f"""
+                html=f"""
                 <div style='font-family:-apple-system,sans-serif;max-width:520px;margin:0 auto;padding:28px 20px;'>
                     <h2 style='color:#0F5E4C;font-size:20px;margin:0 0 12px;'>New message about a project</h2>
                     <p style='font-size:14px;color:#374151;margin:0 0 14px;'>Re: <strong>{project.get('title','')}</strong></p>
@@ -674,8 +852,8 @@ async def project_inquire(slug: str, req: ProjectInquireRequest, request: Reques
                     <p style='font-size:13px;color:#6B7280;margin-top:18px;'>Reply from the <a href='https://thelocaljewel.com/admin/messages' style='color:#0F5E4C;'>Messages tab in admin</a>.</p>
                 </div>
                 """,
+                kind="inquiry_notify",
             )
-            sg_client.send(notif)
         except Exception as e:
             logger.warning(f"inquiry notify failed: {e}")
 
@@ -683,8 +861,8 @@ async def project_inquire(slug: str, req: ProjectInquireRequest, request: Reques
 
 
 @app.get("/api/me/threads")
-async def get_my_threads(user=Depends(get_current_user)):
-    cursor = db.message_threads.find({"user_id": user["user_id"]}, {"_id": 0}).sort("updated_at", -1)
+async def get_my_threads(user_id: str = Depends(get_current_user_id)):
+    cursor = db.message_threads.find({"user_id": user_id}, {"_id": 0}).sort("updated_at", -1)
     threads = []
     async for t in cursor:
         out = dict(t)
@@ -699,8 +877,8 @@ async def get_my_threads(user=Depends(get_current_user)):
     return {"threads": threads}
 
 @app.get("/api/me/threads/{thread_id}")
-async def get_my_thread(thread_id: str, user=Depends(get_current_user)):
-    doc = await db.message_threads.find_one({"thread_id": thread_id, "user_id": user["user_id"]}, {"_id": 0})
+async def get_my_thread(thread_id: str, user_id: str = Depends(get_current_user_id)):
+    doc = await db.message_threads.find_one({"thread_id": thread_id, "user_id": user_id}, {"_id": 0})
     if not doc:
         raise HTTPException(404, "Thread not found")
     await db.message_threads.update_one(
@@ -761,19 +939,57 @@ async def _require_projects_api_key(x_api_key: Optional[str] = Header(None, alia
         return True
     raise HTTPException(401, "Invalid or missing X-API-Key header")
 
-async def _upload_to_r2(file: UploadFile, subfolder: str = "projects") -> str:
-    """Upload a single UploadFile to R2, return the public URL."""
+async def _upload_to_r2(file: UploadFile, subfolder: str = "projects") -> tuple:
+    """Upload a single UploadFile to R2, return (public URL, file bytes)."""
     from storage import upload_file as cloud_upload
     content = await file.read()
     if len(content) > 15 * 1024 * 1024:
         raise HTTPException(400, f"File '{file.filename}' exceeds 15 MB limit")
-    result = cloud_upload(
+    result = await cloud_upload(
         data=content,
         original_filename=file.filename or "image.png",
         content_type=file.content_type,
         subfolder=subfolder,
     )
-    return f"/api/uploads/cloud/{result['storage_path']}"
+    return f"{CLOUD_URL_PREFIX}{result['storage_path']}", content
+
+CLOUD_URL_PREFIX = "/api/uploads/cloud/"
+UPLOAD_CONCURRENCY = 6
+
+async def _upload_all(files: list, subfolder: str = "projects") -> list:
+    """Upload every file of one request concurrently (at most UPLOAD_CONCURRENCY
+    in flight). Returns URLs in input order — "" for empty slots — so captions
+    keep their positions. All-or-nothing: if any upload fails, the objects
+    already stored are deleted and the first error is raised. Image
+    derivatives are only started once every upload has succeeded."""
+    import image_derivatives
+    sem = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+    async def one(f):
+        if not f or not f.filename:
+            return ("", b"")
+        async with sem:
+            return await _upload_to_r2(f, subfolder=subfolder)
+
+    results = await asyncio.gather(*(one(f) for f in files), return_exceptions=True)
+    errors = [r for r in results if isinstance(r, BaseException)]
+    stored = [(url[len(CLOUD_URL_PREFIX):], content) for url, content in (r for r in results if isinstance(r, tuple)) if url]
+    if errors:
+        await asyncio.gather(*(image_derivatives.delete(path) for path, _ in stored))
+        raise errors[0]
+    await asyncio.gather(*(image_derivatives.record_original(path, content) for path, content in stored))
+    for path, content in stored:
+        image_derivatives.generate_in_background(path, content)
+    return [url for url, _ in results]
+
+async def _upload_groups(*groups, subfolder: str = "projects") -> list:
+    """`_upload_all` over several file lists at once; returns one URL list per group."""
+    urls = await _upload_all([f for g in groups for f in g], subfolder)
+    out, i = [], 0
+    for g in groups:
+        out.append(urls[i:i + len(g)])
+        i += len(g)
+    return out
 
 def _slugify(s: str) -> str:
     import re
@@ -837,36 +1053,32 @@ async def projects_api_create(
     if await db.projects.find_one({"slug": slug}):
         raise HTTPException(400, f"A project with slug '{slug}' already exists")
 
-    # ── Upload media ──
-    hero_url = ""
-    if hero and hero.filename:
-        hero_url = await _upload_to_r2(hero)
+    # ── Upload media (all files in parallel) ──
+    # `renders` and `render_files` are aliases — accept either
+    all_render_files = (renders or []) + (render_files or [])
+    (hero_url,), gallery_urls, render_file_urls, (client_brief_url,) = await _upload_groups(
+        [hero], gallery or [], all_render_files, [client_brief_image],
+    )
 
     gallery_items = []
     final_captions = data.get("gallery_captions") or []
     render_captions = data.get("render_captions") or []
-    for i, f in enumerate(gallery or []):
-        if not f or not f.filename:
+    for i, url in enumerate(gallery_urls):
+        if not url:
             continue
-        url = await _upload_to_r2(f)
         cap = final_captions[i] if i < len(final_captions) else ""
         gallery_items.append({"url": url, "caption": cap, "type": "final"})
 
-    # `renders` and `render_files` are aliases — accept either
     render_urls = []
-    all_render_files = (renders or []) + (render_files or [])
-    for i, f in enumerate(all_render_files):
-        if not f or not f.filename:
+    for i, url in enumerate(render_file_urls):
+        if not url:
             continue
-        url = await _upload_to_r2(f)
         cap = render_captions[i] if i < len(render_captions) else ""
         gallery_items.append({"url": url, "caption": cap, "type": "render"})
         render_urls.append(url)
 
     # `client_brief_image` — single screenshot. Also added to gallery so it appears in hero gallery.
-    client_brief_url = ""
-    if client_brief_image and client_brief_image.filename:
-        client_brief_url = await _upload_to_r2(client_brief_image)
+    if client_brief_url:
         gallery_items.append({"url": client_brief_url, "caption": "Client brief", "type": "journey"})
 
     # ── Normalize project_story / flat fields → canonical journey[] ──
@@ -915,6 +1127,8 @@ async def projects_api_create(
         "updated_at": now,
     }
     await db.projects.insert_one(doc)
+    from product_cards import sync_project_card
+    await sync_project_card(slug)
     await regenerate_static_sitemap()
     return _project_strip_internal({k: v for k, v in doc.items() if k != "_id"})
 
@@ -1091,33 +1305,32 @@ async def projects_api_update(
                 raise HTTPException(400, f"slug '{new_slug}' already exists")
             update["slug"] = new_slug
 
-    if hero and hero.filename:
-        update["hero_image_url"] = await _upload_to_r2(hero)
+    # renders / render_files alias
+    all_render_files = (renders or []) + (render_files or [])
+    (hero_url,), gallery_urls, render_file_urls, (client_brief_url,) = await _upload_groups(
+        [hero], gallery or [], all_render_files, [client_brief_image],
+    )
+    if hero_url:
+        update["hero_image_url"] = hero_url
 
     new_gallery_items = []
     final_captions = data.get("gallery_captions") or []
     render_captions = data.get("render_captions") or []
-    for i, f in enumerate(gallery or []):
-        if not f or not f.filename:
+    for i, url in enumerate(gallery_urls):
+        if not url:
             continue
-        url = await _upload_to_r2(f)
         cap = final_captions[i] if i < len(final_captions) else ""
         new_gallery_items.append({"url": url, "caption": cap, "type": "final"})
 
-    # renders / render_files alias
     render_urls = []
-    all_render_files = (renders or []) + (render_files or [])
-    for i, f in enumerate(all_render_files):
-        if not f or not f.filename:
+    for i, url in enumerate(render_file_urls):
+        if not url:
             continue
-        url = await _upload_to_r2(f)
         cap = render_captions[i] if i < len(render_captions) else ""
         new_gallery_items.append({"url": url, "caption": cap, "type": "render"})
         render_urls.append(url)
 
-    client_brief_url = ""
-    if client_brief_image and client_brief_image.filename:
-        client_brief_url = await _upload_to_r2(client_brief_image)
+    if client_brief_url:
         new_gallery_items.append({"url": client_brief_url, "caption": "Client brief", "type": "journey"})
 
     if new_gallery_items:
@@ -1171,6 +1384,8 @@ async def projects_api_update(
     target_slug = update.get("slug", slug)
     await db.projects.update_one({"slug": slug}, {"$set": update})
     doc = await db.projects.find_one({"slug": target_slug}, {"_id": 0})
+    from product_cards import sync_project_card
+    await sync_project_card(target_slug, previous_slug=slug)
     await regenerate_static_sitemap()
     return _project_strip_internal(doc)
 
@@ -1180,6 +1395,8 @@ async def projects_api_delete(slug: str, _auth: bool = Depends(_require_projects
     result = await db.projects.delete_one({"slug": slug})
     if result.deleted_count == 0:
         raise HTTPException(404, "Project not found")
+    from product_cards import remove_project_card
+    await remove_project_card(slug)
     return {"status": "deleted", "slug": slug}
 
 
@@ -1298,19 +1515,19 @@ async def blog_api_create(
     """Create a blog post via automation API. See BLOG_API.md / /blog-api-handoff.md for full schema."""
     data = _parse_blog_payload(payload, partial=False)
 
-    if hero is not None and hero.filename:
-        data["hero_image_url"] = await _upload_to_r2(hero, subfolder="blog")
-
-    uploaded_media = []
-    for m in media or []:
-        if m and m.filename:
-            url = await _upload_to_r2(m, subfolder="blog")
-            uploaded_media.append({"original_name": m.filename, "url": url, "content_type": m.content_type})
-
     existing = await db.blog_posts.find_one({"slug": data["slug"]})
     if existing:
         raise HTTPException(400, f"A post with slug '{data['slug']}' already exists. Use PUT /api/blog/api/{data['slug']} to update.")
 
+    media = media or []
+    (hero_url,), media_urls = await _upload_groups([hero], media, subfolder="blog")
+    if hero_url:
+        data["hero_image_url"] = hero_url
+    uploaded_media = [
+        {"original_name": m.filename, "url": url, "content_type": m.content_type}
+        for m, url in zip(media, media_urls) if url
+    ]
+
     now = datetime.now(timezone.utc)
     doc = {
         "post_id": f"post_{uuid.uuid4().hex[:12]}",
@@ -1356,14 +1573,14 @@ async def blog_api_update(
 
     data = _parse_blog_payload(payload, partial=True)
 
-    if hero is not None and hero.filename:
-        data["hero_image_url"] = await _upload_to_r2(hero, subfolder="blog")
-
-    uploaded_media = []
-    for m in media or []:
-        if m and m.filename:
-            url = await _upload_to_r2(m, subfolder="blog")
-            uploaded_media.append({"original_name": m.filename, "url": url, "content_type": m.content_type})
+    media = media or []
+    (hero_url,), media_urls = await _upload_groups([hero], media, subfolder="blog")
+    if hero_url:
+        data["hero_image_url"] = hero_url
+    uploaded_media = [
+        {"original_name": m.filename, "url": url, "content_type": m.content_type}
+        for m, url in zip(media, media_urls) if url
+    ]
 
     new_slug = data.get("slug")
     if new_slug and new_slug != slug:
@@ -1428,12 +1645,11 @@ async def blog_api_upload(
     """Upload media to R2 separately — use the returned URLs in your post content_html/content_markdown."""
     if not files:
         raise HTTPException(400, "No files provided")
-    uploaded = []
-    for f in files:
-        if not f or not f.filename:
-            continue
-        url = await _upload_to_r2(f, subfolder="blog")
-        uploaded.append({"original_name": f.filename, "url": url, "content_type": f.content_type})
+    urls = await _upload_all(files, subfolder="blog")
+    uploaded = [
+        {"original_name": f.filename, "url": url, "content_type": f.content_type}
+        for f, url in zip(files, urls) if url
+    ]
     return {"uploaded": uploaded, "count": len(uploaded)}
 
 
@@ -1470,115 +1686,16 @@ async def submit_lead(req: LeadSubmitRequest, request: Request):
         "status": "new",
         "internal_notes": [],
         "created_at": datetime.now(timezone.utc), "updated_at": datetime.now(timezone.utc),
+        "submission_id": f"sub_{uuid.uuid4().hex[:12]}",
+        "pending_user_id": f"user_{uuid.uuid4().hex[:12]}",
     }
 
-    # Lead scoring v1
-    score = 30  # base score for submitting
-    quality_flags = []
-    if req.answers.get("product_type") in ("engagement_ring", "wedding_bands"):
-        score += 15
-        quality_flags.append("high_value_product")
-    if req.answers.get("carat_range") in ("2.0_2.9", "3.0_plus"):
-        score += 10
-        quality_flags.append("large_carat")
-    if req.answers.get("priority") in ("biggest_look", "best_sparkle"):
-        score += 5
-    if req.answers.get("has_inspiration") == "yes":
-        score += 10
-        quality_flags.append("has_inspiration")
-    if phone:
-        score += 10
-        quality_flags.append("has_phone")
-    if email_val:
-        score += 5
-        quality_flags.append("has_email")
-    if req.sms_opt_in:
-        score += 5
-        quality_flags.append("sms_opt_in")
-    # Check for returning visitor
-    prev_events = await db.events.count_documents({"anonymous_id": req.attribution.get("anonymous_id", ""), "event_name": "tlj_session_start"})
-    if prev_events > 1:
-        score += 10
-        quality_flags.append("returning_visitor")
-    score = min(score, 100)
-    intent_bucket = "high" if score >= 70 else ("medium" if score >= 45 else "low")
-    
-    lead["lead_score"] = score
-    lead["intent_bucket"] = intent_bucket
-    lead["quality_flags"] = quality_flags
-
-    existing = await db.leads.find_one({"lead_id": req.lead_id})
-    if existing:
-        await db.leads.update_one({"lead_id": req.lead_id}, {"$set": lead})
-    else:
-        await db.leads.insert_one(lead)
+    # Scoring, user linking, session completion and the admin email are
+    # lead_pipeline stages; the request path is this one write.
+    await lead_pipeline.submit(lead)
+    token = create_jwt(lead["pending_user_id"], email_val or phone, lead_id=req.lead_id)
 
-    # Mark wizard session as completed
-    await db.wizard_sessions.update_one({"lead_id": req.lead_id}, {"$set": {"completed_at": datetime.now(timezone.utc)}})
-
-    # Auto-create user
-    user = None
-    if phone:
-        user = await db.users.find_one({"phone": phone})
-    if not user and email_val:
-        user = await db.users.find_one({"email": email_val})
-
-    if not user:
-        user_id = f"user_{uuid.uuid4().hex[:12]}"
-        user_doc = {"user_id": user_id, "first_name": req.first_name, "phone": phone, "created_at": datetime.now(timezone.utc)}
-        if email_val:
-            user_doc["email"] = email_val
-        try:
-            await db.users.insert_one(user_doc)
-        except Exception:
-            if phone:
-                user = await db.users.find_one({"phone": phone})
-            if not user and email_val:
-                user = await db.users.find_one({"email": email_val})
-            if user:
-                user_id = user["user_id"]
-    else:
-        user_id = user["user_id"]
-        if email_val and not user.get("email"):
-            await db.users.update_one({"user_id": user_id}, {"$set": {"email": email_val}})
-
-    await db.leads.update_one({"lead_id": req.lead_id}, {"$set": {"user_id": user_id}})
-    token = create_jwt(user_id, email_val or phone)
-
-    # Send new lead notification email to admin
-    if sg_client:
-        try:
-            product = req.answers.get("product_type", "").replace("_", " ").title()
-            budget = req.answers.get("budget", "").replace("_", " ")
-            diamond = req.answers.get("diamond_shape", "").replace("_", " ").title()
-            carat = req.answers.get("carat_range", "").replace("_", " ")
-            notif = SGMail(
-                from_email=SENDGRID_FROM_EMAIL,
-                to_emails=SENDGRID_FROM_EMAIL,
-                subject=f"New Lead: {req.first_name} — {product}",
-                html_content=f"""
-                <div style="font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif; max-width: 520px; margin: 0 auto; padding: 30px 20px;">
-                    <h2 style="color: #0F5E4C; font-size: 20px; margin: 0 0 20px;">New Lead Submitted</h2>
-                    <table style="width: 100%; border-collapse: collapse; font-size: 14px;">
-                        <tr><td style="padding: 8px 0; color: #6B7280; border-bottom: 1px solid #E5E5E3;">Name</td><td style="padding: 8px 0; color: #1A1A1C; font-weight: 600; border-bottom: 1px solid #E5E5E3; text-align: right;">{req.first_name}</td></tr>
-                        <tr><td style="padding: 8px 0; color: #6B7280; border-bottom: 1px solid #E5E5E3;">Phone</td><td style="padding: 8px 0; color: #1A1A1C; font-weight: 600; border-bottom: 1px solid #E5E5E3; text-align: right;">{phone or '—'}</td></tr>
-                        <tr><td style="padding: 8px 0; color: #6B7280; border-bottom: 1px solid #E5E5E3;">Email</td><td style="padding: 8px 0; color: #1A1A1C; font-weight: 600; border-bottom: 1px solid #E5E5E3; text-align: right;">{email_val or '—'}</td></tr>
-                        <tr><td style="padding: 8px 0; color: #6B7280; border-bottom: 1px solid #E5E5E3;">Product</td><td style="padding: 8px 0; color: #1A1A1C; font-weight: 600; border-bottom: 1px solid #E5E5E3; text-align: right;">{product}</td></tr>
-                        <tr><td style="padding: 8px 0; color: #6B7280; border-bottom: 1px solid #E5E5E3;">Diamond</td><td style="padding: 8px 0; color: #1A1A1C; font-weight: 600; border-bottom: 1px solid #E5E5E3; text-align: right;">{diamond} {carat}</td></tr>
-                        <tr><td style="padding: 8px 0; color: #6B7280;">Budget</td><td style="padding: 8px 0; color: #1A1A1C; font-weight: 600; text-align: right;">{budget}</td></tr>
-                    </table>
-                    {f'<p style="margin: 16px 0 0; padding: 12px; background: #F5F5F3; border-radius: 8px; font-size: 13px; color: #6B7280;">Note: {req.notes}</p>' if req.notes else ''}
-                    <hr style="border: none; border-top: 1px solid #E5E5E3; margin: 20px 0;" />
-                    <p style="font-size: 12px; color: #9CA3AF;">Lead ID: {req.lead_id} • The Local Jewel</p>
-                </div>
-                """,
-            )
-            sg_client.send(notif)
-            print(f"[NOTIF] New lead email sent for {req.first_name}")
-        except Exception as e:
-            print(f"[NOTIF] Email failed: {e}")
-
-    return {"status": "submitted", "lead_id": req.lead_id, "user_id": user_id, "token": token, "first_name": req.first_name}
+    return {"status": "submitted", "lead_id": req.lead_id, "user_id": lead["pending_user_id"], "token": token, "first_name": req.first_name}
 
 
 # ── API: Quick-Quote (friction-reduced single submit) ────────
@@ -1662,27 +1779,29 @@ async def submit_quick_quote(req: QuickQuoteRequest, request: Request):
         "status": "new",
         "comments": [],
         "internal_notes": [],
-        "score": 35,
-        "quality_flags": ["quick_quote"],
         "created_at": datetime.now(timezone.utc),
         "updated_at": datetime.now(timezone.utc),
     }
+    lead_doc.update(await score_lead(lead_doc))
     await db.leads.insert_one(lead_doc)
+    try:
+        await index_lead(lead_doc)
+    except Exception as e:
+        logger.warning(f"quick-quote search index failed: {e}")
 
     token = create_jwt(user_id, email_val)
 
     # Admin notification email
-    if sg_client:
+    if channel_ready("email"):
         try:
             has_link = "Yes" if req.inspiration_link else "No"
             has_files = f"{len(req.inspiration_files)} file(s)" if req.inspiration_files else "None"
             has_notes = "Yes" if req.inspiration_notes else "No"
             has_voice = "Yes (see lead detail)" if req.inspiration_voice else "No"
-            notif = SGMail(
-                from_email=SENDGRID_FROM_EMAIL,
-                to_emails=SENDGRID_FROM_EMAIL,
+            await enqueue_email(
+                SENDGRID_FROM_EMAIL,
                 subject=f"Quick Quote Request: {name}",
-                html_content=f"""
+                html=f"""
                 <div style="font-family: -apple-system, sans-serif; max-width: 520px; margin: 0 auto; padding: 30px 20px;">
                     <h2 style="color: #0F5E4C; font-size: 20px; margin: 0 0 20px;">New Quick-Quote Lead</h2>
                     <table style="width: 100%; border-collapse: collapse; font-size: 14px;">
@@ -1698,8 +1817,8 @@ async def submit_quick_quote(req: QuickQuoteRequest, request: Request):
                     <p style="font-size: 12px; color: #9CA3AF; margin-top: 18px;">Lead ID: {lead_id} • Source: Homepage Quick Quote</p>
                 </div>
                 """,
+                kind="quick_quote_notify",
             )
-            sg_client.send(notif)
         except Exception as e:
             print(f"[QUICK-QUOTE NOTIF] {e}")
 
@@ -1733,15 +1852,25 @@ async def request_otp(req: OTPRequest):
     is_email = "@" in identifier
     delivered = False
     delivery_method = ""
+    otp_ttl = timedelta(minutes=10)   # undelivered codes are useless once expired
+    sms_body = f"Your Local Jewel verification code is: {otp}"
+
+    # SMS target: the phone identifier, or the phone on file for an email login
+    phone_to_send = user.get("phone") or (None if is_email else identifier)
+    phone_normalized = None
+    if phone_to_send:
+        phone_normalized = phone_to_send.strip()
+        if not phone_normalized.startswith("+"):
+            phone_normalized = "+1" + phone_normalized.replace("-", "").replace(" ", "").replace("(", "").replace(")", "")
     
-    # Try email delivery via SendGrid
-    if is_email and sg_client:
+    # Queue email delivery via SendGrid; if the send fails the outbox falls
+    # back to SMS when there is a phone on file.
+    if is_email and channel_ready("email"):
         try:
-            message = SGMail(
-                from_email=SENDGRID_FROM_EMAIL,
-                to_emails=identifier,
+            delivered = bool(await enqueue_email(
+                identifier,
                 subject="Your Local Jewel Verification Code",
-                html_content=f"""
+                html=f"""
                 <div style="font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif; max-width: 480px; margin: 0 auto; padding: 40px 20px;">
                     <div style="text-align: center; margin-bottom: 30px;">
                         <h2 style="color: #1A1A1C; font-size: 22px; margin: 0;">The Local Jewel</h2>
@@ -1755,33 +1884,24 @@ async def request_otp(req: OTPRequest):
                     <p style="color: #9CA3AF; font-size: 12px; text-align: center;">The Local Jewel — Diamond Jewelry, Direct to You</p>
                 </div>
                 """,
-            )
-            sg_client.send(message)
-            delivered = True
-            delivery_method = "email"
-            print(f"[OTP] Email sent to {identifier}")
+                kind="otp",
+                expires_in=otp_ttl,
+                fallback=sms_message(phone_normalized, sms_body),
+            ))
+            if delivered:
+                delivery_method = "email"
+                print(f"[OTP] Email queued for {identifier}")
         except Exception as e:
             print(f"[OTP] Email failed: {type(e).__name__}: {e}")
     
-    # Try SMS delivery via Twilio (for phone numbers, or as fallback if email has a phone on file)
+    # Queue SMS delivery via Twilio (for phone numbers, or if email can't be queued)
     if not delivered:
-        phone_to_send = user.get("phone") if not is_email else user.get("phone")
-        if not phone_to_send and not is_email:
-            phone_to_send = identifier
-        
-        if twilio_client and phone_to_send:
+        if channel_ready("sms") and phone_normalized:
             try:
-                phone_normalized = phone_to_send.strip()
-                if not phone_normalized.startswith("+"):
-                    phone_normalized = "+1" + phone_normalized.replace("-", "").replace(" ", "").replace("(", "").replace(")", "")
-                twilio_client.messages.create(
-                    body=f"Your Local Jewel verification code is: {otp}",
-                    from_=TWILIO_PHONE,
-                    to=phone_normalized,
-                )
-                delivered = True
-                delivery_method = "sms"
-                print(f"[OTP] SMS sent to {phone_normalized}")
+                delivered = bool(await enqueue_sms(phone_normalized, sms_body, kind="otp", expires_in=otp_ttl))
+                if delivered:
+                    delivery_method = "sms"
+                    print(f"[OTP] SMS queued for {phone_normalized}")
             except Exception as e:
                 print(f"[OTP] SMS failed: {e}")
     
@@ -1880,13 +2000,13 @@ async def get_me(user=Depends(get_current_user)):
     return {"user": user}
 
 @app.get("/api/me/leads")
-async def get_my_leads(user=Depends(get_current_user)):
-    leads = [serialize_doc(ld) async for ld in db.leads.find({"user_id": user["user_id"]}).sort("created_at", -1)]
+async def get_my_leads(user_id: str = Depends(get_current_user_id)):
+    leads = [serialize_doc(ld) async for ld in db.leads.find({"user_id": user_id}).sort("created_at", -1)]
     return {"leads": leads}
 
 @app.get("/api/me/leads/{lead_id}")
-async def get_my_lead_detail(lead_id: str, user=Depends(get_current_user)):
-    lead = await db.leads.find_one({"lead_id": lead_id, "user_id": user["user_id"]})
+async def get_my_lead_detail(lead_id: str, user_id: str = Depends(get_current_user_id)):
+    lead = await db.leads.find_one({"lead_id": lead_id, "user_id": user_id})
     if not lead:
         raise HTTPException(404, "Lead not found")
     quotes = [serialize_doc(q) async for q in db.quotes.find({"lead_id": lead_id}).sort("created_at", -1)]
@@ -1940,8 +2060,8 @@ async def customer_approve_design(lead_id: str, user=Depends(get_current_user)):
     return {"status": "approved", "order_stage": "in_production"}
 
 @app.get("/api/me/orders")
-async def get_my_orders(user=Depends(get_current_user)):
-    orders = [serialize_doc(o) async for o in db.orders.find({"user_id": user["user_id"]}).sort("created_at", -1)]
+async def get_my_orders(user_id: str = Depends(get_current_user_id)):
+    orders = [serialize_doc(o) async for o in db.orders.find({"user_id": user_id}).sort("created_at", -1)]
     return {"orders": orders}
 
 class ProfileUpdate(BaseModel):
@@ -2018,13 +2138,19 @@ async def get_my_shop_order_invoice(order_id: str, user=Depends(get_current_user
 # ── API: Events (Enhanced with UA + Geo Enrichment) ─────────
 
 from user_agents import parse as ua_parse
-import httpx
+import geoip
 
-# In-memory geo cache: ip -> {data, fetched_date}
-_geo_cache = {}
+# UA strings repeat heavily; parsing is the hottest part of log_event.
+_ua_cache = TTLCache("user_agent", maxsize=20000, ttl=86400)
+UA_CACHE_MAX_KEY = 512
 
 def parse_user_agent(ua_string):
-    """Parse UA string into device/browser/OS buckets."""
+    """Parse UA string into device/browser/OS buckets (cached per UA string)."""
+    if not ua_string or len(ua_string) > UA_CACHE_MAX_KEY:
+        return _parse_user_agent(ua_string)
+    return dict(_ua_cache.get_or_set(ua_string, lambda: _parse_user_agent(ua_string)))
+
+def _parse_user_agent(ua_string):
     if not ua_string:
         return {"device": "unknown", "browser": "unknown", "os": "unknown", "is_mobile": False, "is_tablet": False, "is_bot": False}
     try:
@@ -2044,30 +2170,8 @@ def parse_user_agent(ua_string):
         return {"device": "unknown", "browser": "unknown", "os": "unknown", "is_mobile": False, "is_tablet": False, "is_bot": False}
 
 async def resolve_geo(ip: str):
-    """Resolve IP to geo data using ip-api.com with daily caching."""
-    if not ip or ip in ("127.0.0.1", "::1", "localhost", ""):
-        return {"country": "Unknown", "region": "", "city": "", "timezone": "", "lat": 0, "lon": 0, "isp": ""}
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    cache_key = f"{ip}:{today}"
-    if cache_key in _geo_cache:
-        return _geo_cache[cache_key]
-    try:
-        async with httpx.AsyncClient(timeout=3) as client_http:
-            resp = await client_http.get(f"http://ip-api.com/json/{ip}?fields=status,country,regionName,city,timezone,lat,lon,isp")
-            if resp.status_code == 200:
-                data = resp.json()
-                if data.get("status") == "success":
-                    geo = {"country": data.get("country", "Unknown"), "region": data.get("regionName", ""), "city": data.get("city", ""), "timezone": data.get("timezone", ""), "lat": data.get("lat", 0), "lon": data.get("lon", 0), "isp": data.get("isp", "")}
-                    _geo_cache[cache_key] = geo
-                    # Trim cache to 500 entries
-                    if len(_geo_cache) > 500:
-                        keys = list(_geo_cache.keys())
-                        for k in keys[:100]:
-                            _geo_cache.pop(k, None)
-                    return geo
-    except Exception:
-        pass
-    return {"country": "Unknown", "region": "", "city": "", "timezone": "", "lat": 0, "lon": 0, "isp": ""}
+    """Resolve IP to geo data from the local GeoIP database (see geoip.py)."""
+    return geoip.resolve(ip)
 
 class EnhancedEventRequest(BaseModel):
     event_name: str
@@ -2089,17 +2193,13 @@ class EnhancedEventRequest(BaseModel):
     visit_count: Optional[int] = None
     attribution: Optional[dict] = None
 
-@app.post("/api/events")
-async def log_event(req: EnhancedEventRequest, request: Request):
-    # Extract IP + UA from request
+def _request_origin(request: Request) -> tuple:
+    """(client IP, raw user-agent) for an event request."""
     client_ip = request.headers.get("x-forwarded-for", request.client.host if request.client else "").split(",")[0].strip()
-    ua_string = request.headers.get("user-agent", "")
-    ua_parsed = parse_user_agent(ua_string)
-    
-    # Async geo resolution (non-blocking, fire-and-forget pattern with inline await)
-    geo = await resolve_geo(client_ip)
-    
-    event = {
+    return client_ip, request.headers.get("user-agent", "")
+
+def _build_event(req: EnhancedEventRequest, client_ip: str, ua_string: str, ua_parsed: dict, geo: dict) -> dict:
+    return {
         "event_id": f"evt_{uuid.uuid4().hex[:12]}",
         "event_name": req.event_name,
         "event_data": req.event_data,
@@ -2123,23 +2223,51 @@ async def log_event(req: EnhancedEventRequest, request: Request):
         "ua_parsed": ua_parsed,
         "geo": geo,
     }
-    await db.events.insert_one(event)
+
+@app.post("/api/events")
+async def log_event(req: EnhancedEventRequest, request: Request):
+    # IP + UA from the request; geo is a local lookup (geoip.py). The event
+    # is handed to the write buffer, which stores it with the next bulk insert.
+    client_ip, ua_string = _request_origin(request)
+    ua_parsed = parse_user_agent(ua_string)
+    geo = await resolve_geo(client_ip)
+    await _buffer_events([_build_event(req, client_ip, ua_string, ua_parsed, geo)])
     return {"status": "logged"}
 
+async def _buffer_events(docs: List[dict]):
+    """Queue events for the bulk writer; 503 when it is backed up (Mongo down)."""
+    from event_buffer import event_buffer, EventBufferFull
+    try:
+        await event_buffer.add(docs)
+    except EventBufferFull:
+        raise HTTPException(503, "Event ingestion is backed up, retry later", headers={"Retry-After": "5"})
+
+EVENT_BATCH_MAX = 500
+
+@app.post("/api/events/batch")
+async def log_events_batch(events: List[EnhancedEventRequest], request: Request):
+    """Log many events from one page in a single request. IP, UA and geo are
+    resolved once for the whole batch."""
+    if len(events) > EVENT_BATCH_MAX:
+        raise HTTPException(413, f"At most {EVENT_BATCH_MAX} events per batch")
+    client_ip, ua_string = _request_origin(request)
+    ua_parsed = parse_user_agent(ua_string)
+    geo = await resolve_geo(client_ip)
+    await _buffer_events([_build_event(e, client_ip, ua_string, ua_parsed, geo) for e in events])
+    return {"status": "logged", "count": len(events)}
+
 # ── API: Public Settings ─────────────────────────────────────
 
 @app.get("/api/settings/public")
 async def public_settings():
-    doc = await db.settings.find_one({"_type": "site_settings"})
-    if not doc:
-        return {"phone_number": "+15857108292", "whatsapp_link": "https://wa.me/15857108292", "live_chat_enabled": False, "gia_logo_visible": True, "igi_logo_visible": True, "reviews_count": "70+", "customers_count": "100+", "avg_savings": "$5,000"}
+    from admin_routes import get_settings_doc
+    doc = await get_settings_doc()
     return {"phone_number": doc.get("phone_number", ""), "whatsapp_link": doc.get("whatsapp_link", ""), "live_chat_enabled": doc.get("live_chat_enabled", False), "gia_logo_visible": doc.get("gia_logo_visible", True), "igi_logo_visible": doc.get("igi_logo_visible", True), "reviews_count": doc.get("reviews_count", "70+"), "customers_count": doc.get("customers_count", "100+"), "avg_savings": doc.get("avg_savings", "$5,000")}
 
 @app.get("/api/abtest/config")
 async def get_abtest_config():
-    doc = await db.settings.find_one({"_type": "abtest_settings"})
-    if not doc:
-        return {"lead_capture_mode": "auto", "variant_a_weight": 50}
+    from admin_routes import get_abtest_doc
+    doc = await get_abtest_doc()
     return {"lead_capture_mode": doc.get("lead_capture_mode", "auto"), "variant_a_weight": doc.get("variant_a_weight", 50)}
 
 # ── Health ───────────────────────────────────────────────────
@@ -0,0 +1,90 @@
+"""Process-local cache for the small settings documents read on every page.
+
+The global sale, main menu, site settings and A/B config change a few times a
+week but were fetched from Mongo on nearly every storefront request. Values are
+kept in memory per worker; freshness across workers comes from a single shared
+version counter (`db.settings {key: "settings_cache_version"}`):
+
+- readers poll that counter at most once per `VERSION_TTL_SECONDS` and drop
+  every cached entry when it moves;
+- admin writes call `bump_settings_version()`, which clears this worker's
+  cache immediately and increments the counter for everyone else.
+
+So an admin change is visible everywhere within about a second, and a worker
+costs one tiny `find_one` per second instead of 1–3 per request. Entries also
+expire after `MAX_AGE_SECONDS` so writes made outside the API (mongo shell,
+scripts) are eventually picked up.
+"""
+import asyncio
+import copy
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = "settings_cache_version"
+VERSION_TTL_SECONDS = 1.0
+MAX_AGE_SECONDS = 300.0
+
+T = TypeVar("T")
+
+_entries: Dict[str, Tuple[object, float]] = {}
+_locks: Dict[str, asyncio.Lock] = {}
+_generation = 0          # bumped on every local clear; guards in-flight loads
+_version = None          # last shared version seen
+_version_checked_at = 0.0
+_version_lock = asyncio.Lock()
+
+
+def _clear():
+    global _generation
+    _entries.clear()
+    _generation += 1
+
+
+async def _sync_version():
+    global _version, _version_checked_at
+    if time.monotonic() - _version_checked_at < VERSION_TTL_SECONDS:
+        return
+    async with _version_lock:
+        if time.monotonic() - _version_checked_at < VERSION_TTL_SECONDS:
+            return
+        from admin_routes import db
+        doc = await db.settings.find_one({"key": VERSION_KEY}, {"_id": 0, "version": 1})
+        version = (doc or {}).get("version", 0)
+        if version != _version:
+            _clear()
+            _version = version
+        _version_checked_at = time.monotonic()
+
+
+async def cached(name: str, loader: Callable[[], Awaitable[T]]) -> T:
+    """Return the cached value for `name`, calling `loader()` on a miss.
+    Callers get a private copy, so mutating the result is safe."""
+    await _sync_version()
+    hit = _entries.get(name)
+    if hit and time.monotonic() - hit[1] < MAX_AGE_SECONDS:
+        return copy.deepcopy(hit[0])
+    lock = _locks.setdefault(name, asyncio.Lock())
+    async with lock:
+        hit = _entries.get(name)
+        if hit and time.monotonic() - hit[1] < MAX_AGE_SECONDS:
+            return copy.deepcopy(hit[0])
+        generation = _generation
+        value = await loader()
+        if generation == _generation:
+            _entries[name] = (value, time.monotonic())
+        return copy.deepcopy(value)
+
+
+async def bump_settings_version():
+    """Call after any admin write to a cached settings document."""
+    global _version_checked_at
+    _clear()
+    try:
+        from admin_routes import db
+        await db.settings.update_one({"key": VERSION_KEY}, {"$inc": {"version": 1}}, upsert=True)
+    except Exception as e:
+        logger.error(f"settings cache version bump failed: {e}")
+    _version_checked_at = 0.0
@@ -2,12 +2,29 @@
 Cloudflare R2 Object Storage for The Local Jewel.
 Uses boto3 (S3-compatible) to store files persistently in Cloudflare R2.
 Files are stored in YOUR bucket — you own the data.
+
+boto3 is synchronous, so every storage call runs on a dedicated, bounded
+thread pool (STORAGE_MAX_WORKERS) and is awaited from the event loop — a slow
+R2 request never blocks other requests on the worker. Each call's latency is
+recorded per operation; see `storage_metrics()`.
+
+Set STORAGE_BACKEND=local to keep objects on disk under LOCAL_STORAGE_DIR
+instead of R2 (dev / tests without network). Both backends expose the same
+API: upload_file, download_file, open_object, delete_object.
 """
 import os
+import re
+import time
 import uuid
+import asyncio
 import logging
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
 import boto3
 from botocore.config import Config
+from botocore.exceptions import ClientError
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +35,11 @@ R2_SECRET_ACCESS_KEY = os.environ.get("R2_SECRET_ACCESS_KEY", "")
 R2_BUCKET_NAME = os.environ.get("R2_BUCKET_NAME", "")
 R2_ENDPOINT = f"https://{R2_ACCOUNT_ID}.r2.cloudflarestorage.com"
 
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "r2").lower()
+LOCAL_STORAGE_DIR = os.environ.get("LOCAL_STORAGE_DIR", "/app/backend/cloud_store")
+STORAGE_MAX_WORKERS = int(os.environ.get("STORAGE_MAX_WORKERS", "16"))
+SLOW_CALL_MS = 2000
+
 APP_PREFIX = "thelocaljewel"
 
 # Module-level S3 client — initialized once
@@ -30,6 +52,44 @@ MIME_TYPES = {
     "svg": "image/svg+xml", "bmp": "image/bmp", "tiff": "image/tiff",
 }
 
+# Chunk size used when streaming object bodies back to clients.
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# Single byte range ("bytes=0-1023", "bytes=500-", "bytes=-500"). Multi-range
+# requests are answered with the full body, which RFC 9110 allows.
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class ObjectNotModified(Exception):
+    """Raised by open_object when If-None-Match matches the stored ETag."""
+
+
+class RangeNotSatisfiable(Exception):
+    """Raised by open_object when the requested byte range is outside the object.
+    `size` is the object's length when known (for `Content-Range: bytes */size`)."""
+
+    def __init__(self, path: str, size: Optional[int] = None):
+        super().__init__(path)
+        self.size = size
+
+
+def parse_range(header: str) -> str:
+    """Return a single-range header safe to forward to R2, or "" to serve it all."""
+    m = _RANGE_RE.match((header or "").strip())
+    if not m or not (m.group(1) or m.group(2)):
+        return ""
+    start, end = m.group(1), m.group(2)
+    if start and end and int(end) < int(start):
+        return ""
+    return f"bytes={start}-{end}"
+
+
+def guess_content_type(filename: str) -> str:
+    ext = filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+    return MIME_TYPES.get(ext) or mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
+# ── R2 backend ───────────────────────────────────────────────
 
 def get_s3_client():
     """Get or create the S3 client for R2."""
@@ -48,6 +108,8 @@ def get_s3_client():
         config=Config(
             signature_version="s3v4",
             retries={"max_attempts": 3, "mode": "standard"},
+            # One pooled connection per storage thread.
+            max_pool_connections=STORAGE_MAX_WORKERS,
         ),
         region_name="auto",
     )
@@ -55,59 +117,278 @@ def get_s3_client():
     return _s3_client
 
 
-def init_storage():
-    """Initialize R2 connection. Call at startup to verify credentials."""
-    client = get_s3_client()
-    # Verify bucket access with a simple head_bucket call
-    try:
-        client.head_bucket(Bucket=R2_BUCKET_NAME)
+class R2Backend:
+    name = "r2"
+
+    def check(self):
+        # Verify bucket access with a simple head_bucket call
+        get_s3_client().head_bucket(Bucket=R2_BUCKET_NAME)
         logger.info(f"R2 bucket '{R2_BUCKET_NAME}' verified and accessible")
-    except Exception as e:
-        logger.error(f"R2 bucket verification failed: {e}")
+
+    def put(self, path: str, data: bytes, content_type: str) -> dict:
+        response = get_s3_client().put_object(
+            Bucket=R2_BUCKET_NAME,
+            Key=path,
+            Body=data,
+            ContentType=content_type,
+        )
+        return {"path": path, "size": len(data), "etag": response.get("ETag", "")}
+
+    def open(self, path: str, byte_range: str = "", if_none_match: str = "") -> dict:
+        kwargs = {"Bucket": R2_BUCKET_NAME, "Key": path}
+        if byte_range:
+            kwargs["Range"] = byte_range
+        if if_none_match:
+            kwargs["IfNoneMatch"] = if_none_match
+        try:
+            response = get_s3_client().get_object(**kwargs)
+        except ClientError as e:
+            status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+            if status == 304:
+                raise ObjectNotModified(path)
+            if status == 416:
+                size = e.response.get("Error", {}).get("ActualObjectSize")
+                if size is None:
+                    content_range = e.response.get("ResponseMetadata", {}).get("HTTPHeaders", {}).get("content-range", "")
+                    size = content_range.rpartition("/")[2]
+                raise RangeNotSatisfiable(path, int(size) if str(size).isdigit() else None)
+            raise
+        return {
+            "body": response["Body"],
+            "content_type": response.get("ContentType", "application/octet-stream"),
+            "content_length": response.get("ContentLength"),
+            "content_range": response.get("ContentRange", ""),
+            "etag": response.get("ETag", ""),
+            "last_modified": response.get("LastModified"),
+        }
+
+    def exists(self, path: str) -> bool:
+        try:
+            get_s3_client().head_object(Bucket=R2_BUCKET_NAME, Key=path)
+            return True
+        except ClientError as e:
+            if e.response.get("ResponseMetadata", {}).get("HTTPStatusCode") == 404:
+                return False
+            raise
+
+    def delete(self, path: str):
+        get_s3_client().delete_object(Bucket=R2_BUCKET_NAME, Key=path)
+
+
+# ── Local filesystem backend ─────────────────────────────────
+
+class _FileBody:
+    """File slice with the subset of botocore's StreamingBody we use."""
+
+    def __init__(self, f, length: int):
+        self._f = f
+        self._left = length
+
+    def read(self, amt: Optional[int] = None) -> bytes:
+        n = self._left if amt is None else min(amt, self._left)
+        data = self._f.read(n) if n > 0 else b""
+        self._left -= len(data)
+        return data
+
+    @property
+    def remaining(self) -> int:
+        return self._left
+
+    def fileno(self) -> int:
+        return self._f.fileno()
+
+    def tell(self) -> int:
+        return self._f.tell()
+
+    def iter_chunks(self, chunk_size: int = STREAM_CHUNK_SIZE):
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        self._f.close()
+
+
+class LocalBackend:
+    name = "local"
+
+    def __init__(self, root: str):
+        self.root = os.path.realpath(root)
+
+    def _file(self, path: str) -> str:
+        full = os.path.realpath(os.path.join(self.root, path))
+        if not full.startswith(self.root + os.sep):
+            raise FileNotFoundError(path)
+        return full
+
+    def check(self):
+        os.makedirs(self.root, exist_ok=True)
+        logger.info(f"Local object storage at {self.root}")
+
+    def put(self, path: str, data: bytes, content_type: str) -> dict:
+        full = self._file(path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        tmp = f"{full}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, full)
+        return {"path": path, "size": len(data), "etag": self._etag(os.stat(full))}
+
+    @staticmethod
+    def _etag(st) -> str:
+        return f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+    def open(self, path: str, byte_range: str = "", if_none_match: str = "") -> dict:
+        from datetime import datetime, timezone
+        full = self._file(path)
+        st = os.stat(full)
+        etag = self._etag(st)
+        if if_none_match and if_none_match == etag:
+            raise ObjectNotModified(path)
+        size = st.st_size
+        start, end, content_range = 0, size - 1, ""
+        if byte_range:
+            a, b = byte_range[len("bytes="):].split("-")
+            if a:
+                start, end = int(a), min(int(b), size - 1) if b else size - 1
+            else:
+                start, end = max(0, size - int(b)), size - 1
+            if start >= size:
+                raise RangeNotSatisfiable(path, size)
+            content_range = f"bytes {start}-{end}/{size}"
+        f = open(full, "rb")
+        f.seek(start)
+        return {
+            "body": _FileBody(f, end - start + 1),
+            "content_type": guess_content_type(path),
+            "content_length": end - start + 1,
+            "content_range": content_range,
+            "etag": etag,
+            "last_modified": datetime.fromtimestamp(st.st_mtime, tz=timezone.utc),
+        }
+
+    def exists(self, path: str) -> bool:
+        return os.path.isfile(self._file(path))
+
+    def delete(self, path: str):
+        os.remove(self._file(path))
+
+
+# ── Async facade ─────────────────────────────────────────────
+
+_backend = None
+_executor = ThreadPoolExecutor(max_workers=STORAGE_MAX_WORKERS, thread_name_prefix="storage")
+_metrics: Dict[str, dict] = {}
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = LocalBackend(LOCAL_STORAGE_DIR) if STORAGE_BACKEND == "local" else R2Backend()
+    return _backend
+
+
+def _record(op: str, ms: float, failed: bool):
+    m = _metrics.setdefault(op, {"calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+    m["calls"] += 1
+    m["errors"] += int(failed)
+    m["total_ms"] += ms
+    m["max_ms"] = max(m["max_ms"], ms)
+    if ms > SLOW_CALL_MS:
+        logger.warning(f"slow storage {op}: {ms:.0f} ms")
+
+
+async def _call(op: str, fn, *args):
+    """Run a blocking backend call on the storage pool and time it."""
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    failed = False
+    try:
+        return await loop.run_in_executor(_executor, fn, *args)
+    except (ObjectNotModified, RangeNotSatisfiable):
         raise
-    return True
+    except Exception:
+        failed = True
+        raise
+    finally:
+        _record(op, (time.perf_counter() - started) * 1000, failed)
 
 
-def put_object(path: str, data: bytes, content_type: str) -> dict:
-    """Upload file to R2. Returns metadata dict."""
-    client = get_s3_client()
-    response = client.put_object(
-        Bucket=R2_BUCKET_NAME,
-        Key=path,
-        Body=data,
-        ContentType=content_type,
-    )
+def storage_metrics() -> dict:
+    """Per-operation call counts and latency since process start."""
     return {
-        "path": path,
-        "size": len(data),
-        "etag": response.get("ETag", ""),
+        "backend": get_backend().name,
+        "max_workers": STORAGE_MAX_WORKERS,
+        "ops": {
+            op: {
+                "calls": m["calls"],
+                "errors": m["errors"],
+                "avg_ms": round(m["total_ms"] / m["calls"], 1) if m["calls"] else 0.0,
+                "max_ms": round(m["max_ms"], 1),
+            }
+            for op, m in _metrics.items()
+        },
     }
 
 
-def get_object(path: str) -> tuple:
-    """Download file from R2. Returns (content_bytes, content_type)."""
-    client = get_s3_client()
-    response = client.get_object(
-        Bucket=R2_BUCKET_NAME,
-        Key=path,
-    )
-    content_type = response.get("ContentType", "application/octet-stream")
-    data = response["Body"].read()
-    return data, content_type
+async def init_storage():
+    """Initialize the storage backend. Call at startup to verify credentials."""
+    try:
+        await _call("check", get_backend().check)
+    except Exception as e:
+        logger.error(f"Storage verification failed: {e}")
+        raise
+    return True
+
+
+async def open_object(path: str, byte_range: str = "", if_none_match: str = "") -> dict:
+    """Open an object for streaming without reading the body.
+
+    Returns dict with: body (has iter_chunks/read/close), content_type,
+    content_length, content_range ("" unless partial), etag, last_modified.
+    Range and If-None-Match are evaluated by the backend (R2 itself for the
+    R2 backend), so only the bytes needed ever leave the bucket.
+    """
+    return await _call("open", get_backend().open, path, byte_range, if_none_match)
+
 
+async def iter_body(body, chunk_size: int = STREAM_CHUNK_SIZE):
+    """Yield an object body in chunks read on the storage pool, always
+    releasing the connection."""
+    loop = asyncio.get_running_loop()
+    chunks = body.iter_chunks(chunk_size)
+    try:
+        while True:
+            chunk = await loop.run_in_executor(_executor, next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        body.close()
+
+
+async def put_object(path: str, data: bytes, content_type: str) -> dict:
+    """Store bytes at an explicit path (derived objects). Returns metadata dict."""
+    return await _call("put", get_backend().put, path, data, content_type)
+
+
+async def object_exists(path: str) -> bool:
+    return await _call("head", get_backend().exists, path)
 
-def delete_object(path: str) -> bool:
-    """Delete file from R2. Returns True on success."""
-    client = get_s3_client()
+
+async def delete_object(path: str) -> bool:
+    """Delete an object. Returns True on success."""
     try:
-        client.delete_object(Bucket=R2_BUCKET_NAME, Key=path)
+        await _call("delete", get_backend().delete, path)
         return True
     except Exception as e:
-        logger.error(f"R2 delete failed for {path}: {e}")
+        logger.error(f"Storage delete failed for {path}: {e}")
         return False
 
 
-def upload_file(data: bytes, original_filename: str, content_type: str = None, subfolder: str = "uploads") -> dict:
+async def upload_file(data: bytes, original_filename: str, content_type: str = None, subfolder: str = "uploads") -> dict:
     """
     High-level upload helper.
     Returns dict with: storage_path, original_name, content_type, size, filename
@@ -119,7 +400,7 @@ def upload_file(data: bytes, original_filename: str, content_type: str = None, s
     unique_filename = f"{uuid.uuid4().hex}.{ext}"
     storage_path = f"{APP_PREFIX}/{subfolder}/{unique_filename}"
 
-    result = put_object(storage_path, data, content_type)
+    result = await _call("put", get_backend().put, storage_path, data, content_type)
 
     return {
         "storage_path": result["path"],
@@ -130,9 +411,17 @@ def upload_file(data: bytes, original_filename: str, content_type: str = None, s
     }
 
 
-def download_file(storage_path: str) -> tuple:
+def _read_all(path: str) -> tuple:
+    obj = get_backend().open(path)
+    try:
+        return obj["body"].read(), obj["content_type"]
+    finally:
+        obj["body"].close()
+
+
+async def download_file(storage_path: str) -> tuple:
     """
     High-level download helper.
     Returns (content_bytes, content_type).
     """
-    return get_object(storage_path)
+    return await _call("get", _read_all, storage_path)
@@ -0,0 +1,105 @@
+"""Offline tests for the disk-backed media cache (no R2, no server).
+
+Objects come from a LocalBackend in a temp dir standing in for storage.
+
+Run:  cd /app/backend && python -m pytest tests/test_media_cache.py -q
+"""
+import os
+import sys
+import asyncio
+from collections import OrderedDict
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import media_cache  # noqa: E402
+from storage import LocalBackend  # noqa: E402
+
+DATA = bytes(range(256)) * 16
+PATH = "tlj/uploads/ring.jpg"
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    """media_cache pointed at a fresh directory, filling from a local 'bucket'
+    and counting how often storage is opened."""
+    bucket = LocalBackend(str(tmp_path / "bucket"))
+    bucket.put(PATH, DATA, "image/jpeg")
+    opened = []
+
+    async def fake_open_object(path, byte_range="", if_none_match=""):
+        opened.append(path)
+        return bucket.open(path, byte_range, if_none_match)
+
+    def use_dir(cache_dir):
+        monkeypatch.setattr(media_cache, "MEDIA_CACHE_DIR", cache_dir)
+        monkeypatch.setattr(media_cache, "_disk", LocalBackend(cache_dir))
+
+    use_dir(str(tmp_path / "cache"))
+    monkeypatch.setattr(media_cache, "open_object", fake_open_object)
+    monkeypatch.setattr(media_cache, "_index", OrderedDict())
+    monkeypatch.setattr(media_cache, "_uncacheable", OrderedDict())
+    monkeypatch.setattr(media_cache, "_total_bytes", 0)
+    monkeypatch.setattr(media_cache, "_loaded", True)
+    monkeypatch.setattr(media_cache, "_last_sync", float("inf"))   # no background scans
+    monkeypatch.setattr(media_cache, "_fills_paused_until", 0.0)
+    monkeypatch.setattr(media_cache, "_stats", dict.fromkeys(media_cache._stats, 0))
+    return media_cache, opened, use_dir
+
+
+def _read(obj) -> bytes:
+    try:
+        return obj["body"].read()
+    finally:
+        obj["body"].close()
+
+
+def test_miss_fills_then_hits(cache):
+    mc, opened, _ = cache
+
+    async def run():
+        entry = await mc.lookup(PATH)
+        assert entry and entry["size"] == len(DATA) and entry["content_type"] == "image/jpeg"
+        again = await mc.lookup(PATH)
+        assert again == entry
+        assert _read(await mc.open_cached(entry)) == DATA
+        part = await mc.open_cached(entry, "bytes=10-19")
+        assert part["content_range"] == f"bytes 10-19/{len(DATA)}"
+        assert _read(part) == DATA[10:20]
+
+    asyncio.run(run())
+    assert opened == [PATH]
+    assert mc._stats["fills"] == 1 and mc._stats["hits"] == 1
+
+
+def test_unwritable_cache_dir_falls_back_to_storage(cache, tmp_path):
+    mc, opened, use_dir = cache
+    blocker = tmp_path / "not-a-dir"
+    blocker.write_text("")   # makedirs under a regular file fails
+    use_dir(str(blocker))
+
+    async def run():
+        assert await mc.lookup(PATH) is None
+        # Fills pause after a disk error: the next miss doesn't download twice.
+        assert await mc.lookup(PATH) is None
+
+    asyncio.run(run())
+    assert opened == [PATH]
+    assert mc._stats["disk_errors"] == 1 and mc._stats["fills"] == 0
+    assert not mc._inflight
+
+
+def test_unreadable_blob_falls_back_to_storage(cache, monkeypatch):
+    mc, _, _ = cache
+
+    def broken_open(path, byte_range=""):
+        raise PermissionError(path)
+
+    async def run():
+        entry = await mc.lookup(PATH)
+        monkeypatch.setattr(mc._disk, "open", broken_open)
+        assert await mc.open_cached(entry) is None
+
+    asyncio.run(run())
+    assert mc._stats["disk_errors"] == 1
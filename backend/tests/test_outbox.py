@@ -0,0 +1,153 @@
+"""Outbox queue tests with fake providers (no SendGrid/Twilio, no server).
+
+Each test runs against a throwaway database on MONGO_URL and drives the
+queue through `process_due()` directly.
+
+Run:  cd /app/backend && python -m pytest tests/test_outbox.py -q
+"""
+import os
+import sys
+import uuid
+import asyncio
+from datetime import datetime, timezone, timedelta
+
+import pytest
+from dotenv import load_dotenv
+
+load_dotenv("/app/backend/.env")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import outbox  # noqa: E402
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    """run(scenario): call `scenario(db, providers)` with outbox pointed at a
+    fresh database and fake providers; the database is dropped afterwards."""
+    from motor.motor_asyncio import AsyncIOMotorClient
+    fakes = {"email": outbox.FakeProvider("email"), "sms": outbox.FakeProvider("sms")}
+    monkeypatch.setattr(outbox, "providers", fakes)
+
+    def run(scenario):
+        async def main():
+            client = AsyncIOMotorClient(os.environ["MONGO_URL"])
+            db = client[f"pytest_outbox_{uuid.uuid4().hex[:8]}"]
+            monkeypatch.setattr(outbox, "db", db)
+            try:
+                await outbox.ensure_indexes()
+                return await scenario(db, fakes)
+            finally:
+                await client.drop_database(db.name)
+                client.close()
+        return asyncio.run(main())
+
+    return run
+
+
+def _aware(dt):
+    return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt
+
+
+async def _row(db, message_id):
+    return await db.outbox.find_one({"message_id": message_id})
+
+
+def test_sends_once(queue):
+    async def scenario(db, fakes):
+        mid = await outbox.enqueue_email("a@example.com", "Hi", "<p>hi</p>", kind="test")
+        assert await outbox.process_due() == 1
+        assert await outbox.process_due() == 0
+        row = await _row(db, mid)
+        assert row["status"] == "sent" and row["attempts"] == 1
+        assert fakes["email"].sent == [("a@example.com", {"subject": "Hi", "html": "<p>hi</p>"})]
+        # Same caller-chosen id: no second row.
+        assert await outbox.enqueue_email("a@example.com", "Hi", "<p>hi</p>", kind="test", message_id=mid) == mid
+        assert await db.outbox.count_documents({}) == 1
+
+    queue(scenario)
+
+
+def test_failure_backs_off_then_retries(queue):
+    async def scenario(db, fakes):
+        fakes["sms"].fail_next = 1
+        mid = await outbox.enqueue_sms("+15555550100", "code 123456", kind="otp")
+        started = datetime.now(timezone.utc)
+        assert await outbox.process_due() == 1
+        row = await _row(db, mid)
+        assert row["status"] == "pending" and row["attempts"] == 1
+        assert "fake provider failure" in row["last_error"]
+        delay = (_aware(row["next_attempt_at"]) - started).total_seconds()
+        assert 0.8 * outbox.OUTBOX_BACKOFF_SECONDS - 1 <= delay <= 1.2 * outbox.OUTBOX_BACKOFF_SECONDS + 1
+        assert await outbox.process_due() == 0   # not due yet
+        await db.outbox.update_one({"message_id": mid}, {"$set": {"next_attempt_at": started}})
+        assert await outbox.process_due() == 1
+        row = await _row(db, mid)
+        assert row["status"] == "sent" and row["attempts"] == 2 and "last_error" not in row
+        assert fakes["sms"].sent == [("+15555550100", {"body": "code 123456"})]
+
+    queue(scenario)
+
+
+def test_backoff_grows_and_is_capped():
+    for attempts in range(1, 6):
+        base = outbox.OUTBOX_BACKOFF_SECONDS * 2 ** (attempts - 1)
+        delay = outbox.backoff(attempts).total_seconds()
+        assert min(0.8 * base, outbox.OUTBOX_BACKOFF_MAX_SECONDS) <= delay <= min(1.2 * base, outbox.OUTBOX_BACKOFF_MAX_SECONDS)
+    assert outbox.backoff(40).total_seconds() == outbox.OUTBOX_BACKOFF_MAX_SECONDS
+
+
+def test_dead_after_max_attempts_and_requeue(queue, monkeypatch):
+    monkeypatch.setattr(outbox, "OUTBOX_MAX_ATTEMPTS", 3)
+    monkeypatch.setattr(outbox, "OUTBOX_BACKOFF_SECONDS", 0)   # retries are due at once
+
+    async def scenario(db, fakes):
+        fakes["email"].fail_next = 100
+        mid = await outbox.enqueue_email("b@example.com", "Hi", "<p>hi</p>", kind="test")
+        assert await outbox.process_due() == 3
+        row = await _row(db, mid)
+        assert row["status"] == "dead" and row["attempts"] == 3
+        assert (await outbox.stats())["dead"] == 1
+
+        fakes["email"].fail_next = 0
+        assert await outbox.requeue(mid) is True
+        assert await outbox.requeue(mid) is False   # already pending
+        assert await outbox.process_due() == 1
+        row = await _row(db, mid)
+        assert row["status"] == "sent" and row["attempts"] == 1
+        assert await outbox.requeue(mid) is False   # sent rows stay sent
+
+    queue(scenario)
+
+
+def test_expired_rows_are_not_sent(queue):
+    async def scenario(db, fakes):
+        mid = await outbox.enqueue_sms("+15555550101", "code 654321", kind="otp", expires_in=timedelta(minutes=10))
+        past = datetime.now(timezone.utc) - timedelta(seconds=1)
+        await db.outbox.update_one({"message_id": mid}, {"$set": {"expires_at": past}})
+        assert await outbox.process_due() == 1
+        assert (await _row(db, mid))["status"] == "expired"
+        assert fakes["sms"].sent == []
+        # Requeue drops the expiry, so the message goes out.
+        assert await outbox.requeue(mid) is True
+        assert await outbox.process_due() == 1
+        assert (await _row(db, mid))["status"] == "sent"
+
+    queue(scenario)
+
+
+def test_failed_email_falls_back_to_sms(queue):
+    async def scenario(db, fakes):
+        fakes["email"].fail_next = 1
+        fallback = outbox.sms_message("+15555550102", "code 111111")
+        mid = await outbox.enqueue_email("c@example.com", "Code", "<p>111111</p>", kind="otp",
+                                         expires_in=timedelta(minutes=10), fallback=fallback)
+        assert await outbox.process_due() == 2   # the email, then its fallback
+        email = await _row(db, mid)
+        assert email["status"] == "dead" and email["fallback_id"]
+        sms = await _row(db, email["fallback_id"])
+        assert sms["status"] == "sent" and sms["kind"] == "otp"
+        assert _aware(sms["expires_at"]) <= _aware(email["expires_at"])
+        assert fakes["email"].sent == []
+        assert fakes["sms"].sent == [("+15555550102", {"body": "code 111111"})]
+
+    queue(scenario)
@@ -8,10 +8,12 @@ Backend tests for 4-phase massive feature build:
 - Project price fields
 - Sitemap.xml
 - Uploads audio MIME detection
+- Batched project/blog uploads (ordering, all-or-nothing, concurrency cap)
 """
 import os
 import io
 import time
+import asyncio
 import pytest
 import requests
 
@@ -152,6 +154,20 @@ class TestUserThreads:
         r = requests.get(f"{BASE_URL}/api/me/threads")
         assert r.status_code in (401, 403)
 
+    def test_profile_update_visible_through_cached_principal(self, request):
+        _, tok = self._ctx(request)
+        headers = {"Authorization": f"Bearer {tok}", "Content-Type": "application/json"}
+        assert requests.get(f"{BASE_URL}/api/me", headers=headers).status_code == 200
+        r = requests.put(f"{BASE_URL}/api/me/profile", headers=headers, json={"ring_size": "6.5"})
+        assert r.status_code == 200, r.text
+        me = requests.get(f"{BASE_URL}/api/me", headers=headers).json()["user"]
+        assert me["ring_size"] == "6.5"
+
+    def test_bad_token_rejected_repeatedly(self):
+        for _ in range(2):
+            r = requests.get(f"{BASE_URL}/api/me/leads", headers={"Authorization": "Bearer not-a-jwt"})
+            assert r.status_code == 401
+
 
 # ── Admin threads ────────────────────────────────────────────
 class TestAdminThreads:
@@ -173,6 +189,74 @@ class TestAdminThreads:
         threads = r.json().get("threads", [])
         assert any(t.get("user_email") == email for t in threads)
 
+    def test_search_threads_by_partial_phone(self, admin_headers, request):
+        tid = request.config.cache.get("inquire/thread_id", None)
+        if not tid:
+            pytest.skip("no thread")
+        digits = f"{TS % 10000000:07d}"
+        q = f"555-{digits[:3]}"
+        r = requests.get(f"{BASE_URL}/api/admin/threads", headers=admin_headers, params={"q": q})
+        assert r.status_code == 200
+        assert any(t["thread_id"] == tid for t in r.json()["threads"])
+
+    def test_search_filter_is_not_capped(self, admin_headers):
+        """More matches than search_index.SEARCH_CANDIDATES: the oldest one must
+        still be found once combined with a status filter, and counted."""
+        import sys
+        from datetime import datetime, timezone, timedelta
+        from dotenv import load_dotenv
+        from motor.motor_asyncio import AsyncIOMotorClient
+        load_dotenv("/app/backend/.env")
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        from search_index import SEARCH_CANDIDATES, entry_for
+
+        tag = f"zq{TS}"
+        n = SEARCH_CANDIDATES + 5
+        start = datetime.now(timezone.utc) - timedelta(days=30)
+        threads = [
+            {
+                "thread_id": f"pytest_bulk_{tag}_{i:05d}", "user_name": f"Bulk {tag}", "status": "closed" if i == 0 else "active",
+                "messages": [], "created_at": start + timedelta(minutes=i), "updated_at": start + timedelta(minutes=i),
+            }
+            for i in range(n)
+        ]
+
+        async def db_run(fn):
+            return await fn(AsyncIOMotorClient(os.environ["MONGO_URL"])[os.environ["DB_NAME"]])
+
+        async def seed(db):
+            await db.message_threads.insert_many([dict(t) for t in threads])
+            await db.search_index.insert_many([entry_for("thread", t) for t in threads])
+
+        async def teardown(db):
+            refs = {"$regex": f"^pytest_bulk_{tag}_"}
+            await db.message_threads.delete_many({"thread_id": refs})
+            await db.search_index.delete_many({"kind": "thread", "ref": refs})
+
+        asyncio.run(db_run(seed))
+        try:
+            r = requests.get(f"{BASE_URL}/api/admin/threads", headers=admin_headers, params={"q": tag, "status": "closed"})
+            assert r.status_code == 200, r.text
+            assert [t["thread_id"] for t in r.json()["threads"]] == [threads[0]["thread_id"]]
+            r = requests.get(f"{BASE_URL}/api/admin/threads", headers=admin_headers, params={"q": tag, "total": "exact", "limit": 1})
+            assert r.status_code == 200, r.text
+            assert r.json()["total"] == n
+        finally:
+            asyncio.run(db_run(teardown))
+
+    def test_ranked_search(self, admin_headers, request):
+        email = request.config.cache.get("inquire/email", None)
+        if not email:
+            pytest.skip("no email from inquire")
+        r = requests.get(f"{BASE_URL}/api/admin/search", headers=admin_headers, params={"q": email})
+        assert r.status_code == 200, r.text
+        body = r.json()
+        assert body["leads"] and body["leads"][0]["email"] == email
+        assert body["threads"] and body["threads"][0]["user_email"] == email
+        scores = [hit["score"] for hit in body["leads"]]
+        assert scores == sorted(scores, reverse=True)
+        assert requests.get(f"{BASE_URL}/api/admin/search", headers=admin_headers, params={"q": "x", "kind": "bogus"}).status_code == 400
+
     def test_filter_threads_by_status_active(self, admin_headers):
         r = requests.get(f"{BASE_URL}/api/admin/threads", headers=admin_headers, params={"status": "active"})
         assert r.status_code == 200
@@ -362,3 +446,367 @@ class TestUploadsAudio:
         body = r.json()
         first = (body.get("files") or [{}])[0]
         assert first.get("media_type") == "audio", f"expected audio, got {body}"
+
+
+# ── Batched uploads (_upload_all / _upload_groups) ─────────
+class _File:
+    def __init__(self, filename):
+        self.filename = filename
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    """server with R2 and image derivatives faked: records what was stored,
+    deleted and post-processed, and the peak number of uploads in flight."""
+    monkeypatch.syspath_prepend(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import server
+    import image_derivatives
+
+    calls = {"stored": [], "deleted": [], "recorded": [], "generated": [], "in_flight": 0, "peak": 0}
+
+    async def fake_upload(f, subfolder="projects"):
+        calls["in_flight"] += 1
+        calls["peak"] = max(calls["peak"], calls["in_flight"])
+        try:
+            # later files finish first, so completion order != input order
+            await asyncio.sleep(0.001 * (20 - int(f.filename.split(".")[0][-2:])))
+            if f.filename.startswith("bad"):
+                raise server.HTTPException(400, f"File '{f.filename}' exceeds 15 MB limit")
+            calls["stored"].append(f.filename)
+            return f"{server.CLOUD_URL_PREFIX}{subfolder}/{f.filename}", f.filename.encode()
+        finally:
+            calls["in_flight"] -= 1
+
+    async def fake_delete(path):
+        calls["deleted"].append(path)
+        return True
+
+    async def fake_record(path, data):
+        calls["recorded"].append(path)
+
+    monkeypatch.setattr(server, "_upload_to_r2", fake_upload)
+    monkeypatch.setattr(image_derivatives, "delete", fake_delete)
+    monkeypatch.setattr(image_derivatives, "record_original", fake_record)
+    monkeypatch.setattr(image_derivatives, "generate_in_background", lambda path, data: calls["generated"].append(path))
+    return server, calls
+
+
+class TestBatchedUploads:
+    def test_urls_keep_input_order(self, uploads):
+        server, calls = uploads
+        files = [_File("img01.jpg"), None, _File("img02.jpg"), _File(""), _File("img03.jpg")]
+        urls = asyncio.run(server._upload_all(files, subfolder="blog"))
+        p = server.CLOUD_URL_PREFIX
+        assert urls == [f"{p}blog/img01.jpg", "", f"{p}blog/img02.jpg", "", f"{p}blog/img03.jpg"]
+        assert calls["stored"] == ["img03.jpg", "img02.jpg", "img01.jpg"]   # finished out of order
+        assert sorted(calls["recorded"]) == sorted(calls["generated"]) == ["blog/img01.jpg", "blog/img02.jpg", "blog/img03.jpg"]
+
+    def test_groups_split_back_in_order(self, uploads):
+        server, _ = uploads
+        hero, gallery, renders, brief = [_File("hero01.jpg")], [_File("g02.jpg"), _File("g03.jpg")], [], [None]
+        (hero_url,), gallery_urls, render_urls, (brief_url,) = asyncio.run(server._upload_groups(hero, gallery, renders, brief))
+        p = server.CLOUD_URL_PREFIX
+        assert hero_url == f"{p}projects/hero01.jpg"
+        assert gallery_urls == [f"{p}projects/g02.jpg", f"{p}projects/g03.jpg"]
+        assert render_urls == [] and brief_url == ""
+
+    def test_failure_deletes_stored_files(self, uploads):
+        server, calls = uploads
+        files = [_File("img01.jpg"), _File("bad02.jpg"), _File("img03.jpg")]
+        with pytest.raises(server.HTTPException) as exc:
+            asyncio.run(server._upload_all(files))
+        assert exc.value.status_code == 400 and "bad02.jpg" in exc.value.detail
+        assert sorted(calls["deleted"]) == ["projects/img01.jpg", "projects/img03.jpg"]
+        assert calls["recorded"] == [] and calls["generated"] == []
+
+    def test_concurrency_is_bounded(self, uploads):
+        server, calls = uploads
+        files = [_File(f"img{i:02d}.jpg") for i in range(20)]
+        urls = asyncio.run(server._upload_all(files))
+        assert len(urls) == 20 and all(urls)
+        assert calls["peak"] == server.UPLOAD_CONCURRENCY
+
+
+# ── Cloud proxy streaming ───────────────────────────────────
+class TestCloudProxyStreaming:
+    def test_range_and_etag(self):
+        data = bytes(range(256)) * 64
+        r = requests.post(f"{BASE_URL}/api/uploads", files=[("files", ("clip.mp4", data, "video/mp4"))])
+        if r.status_code in (401, 403):
+            pytest.skip("uploads requires auth")
+        first = (r.json().get("files") or [{}])[0]
+        if not first.get("storage_path"):
+            pytest.skip("cloud storage not configured (local fallback)")
+        url = f"{BASE_URL}{first['url']}"
+
+        part = requests.get(url, headers={"Range": "bytes=100-199"})
+        assert part.status_code == 206, part.status_code
+        assert part.content == data[100:200]
+        assert part.headers["Content-Range"] == f"bytes 100-199/{len(data)}"
+
+        past_end = requests.get(url, headers={"Range": f"bytes={len(data) + 10}-"})
+        assert past_end.status_code == 416
+        assert past_end.headers["Content-Range"] == f"bytes */{len(data)}"
+
+        full = requests.get(url)
+        assert full.status_code == 200 and full.content == data
+        # The full read filled the media cache; ranges are now served from disk.
+        cached = requests.get(url, headers={"Range": "bytes=-10"})
+        assert cached.status_code == 206 and cached.content == data[-10:]
+        assert cached.headers["Content-Range"] == f"bytes {len(data) - 10}-{len(data) - 1}/{len(data)}"
+        etag = full.headers.get("ETag")
+        assert etag
+        again = requests.get(url, headers={"If-None-Match": etag})
+        assert again.status_code == 304
+
+    def test_storage_metrics(self, admin_token):
+        r = requests.get(f"{BASE_URL}/api/admin/storage/metrics", headers={"Authorization": f"Bearer {admin_token}"})
+        assert r.status_code == 200, r.text
+        body = r.json()
+        assert body["backend"] in ("r2", "local")
+        for op in body["ops"].values():
+            assert op["calls"] >= op["errors"] >= 0
+        cache = body["media_cache"]
+        assert cache["bytes"] <= cache["max_bytes"] or cache["max_bytes"] == 0
+
+
+# ── Batched event ingestion ─────────────────────────────────
+class TestEventBatch:
+    def test_batch_accepted(self):
+        events = [{"event_name": "tlj_step_view", "session_id": f"pytest_{TS}", "wizard_step": f"s{i}"} for i in range(5)]
+        r = requests.post(f"{BASE_URL}/api/events/batch", json=events)
+        assert r.status_code == 200, r.text
+        assert r.json() == {"status": "logged", "count": 5}
+
+    def test_batch_too_large(self):
+        r = requests.post(f"{BASE_URL}/api/events/batch", json=[{"event_name": "x"}] * 501)
+        assert r.status_code == 413
+
+    def test_user_agent_cache_counts_hits(self, admin_token):
+        ua = {"User-Agent": f"pytest-ua-cache/{TS}"}
+        for _ in range(3):
+            requests.post(f"{BASE_URL}/api/events", json={"event_name": "tlj_step_view", "session_id": f"pytest_{TS}"}, headers=ua)
+        r = requests.get(f"{BASE_URL}/api/admin/storage/metrics", headers={"Authorization": f"Bearer {admin_token}"})
+        stats = r.json()["caches"]["user_agent"]
+        assert stats["hits"] >= 2 and stats["size"] >= 1
+
+
+# ── Rollup-backed analytics ─────────────────────────────────
+class TestAnalyticsRollups:
+    def test_recent_events_counted(self, admin_headers):
+        before = requests.get(f"{BASE_URL}/api/admin/analytics/executive?days=1", headers=admin_headers).json()
+        requests.post(f"{BASE_URL}/api/events", json={"event_name": "tlj_session_start", "session_id": f"pytest_rollup_{TS}"})
+        time.sleep(2)  # event buffer flush
+        after = requests.get(f"{BASE_URL}/api/admin/analytics/executive?days=1", headers=admin_headers).json()
+        assert after["metrics"]["sessions"]["value"] >= before["metrics"]["sessions"]["value"] + 1
+
+    def test_trends_shape(self, admin_headers):
+        r = requests.get(f"{BASE_URL}/api/admin/analytics/trends?days=90", headers=admin_headers)
+        assert r.status_code == 200, r.text
+        body = r.json()
+        assert all({"date", "sessions", "wizard_starts", "leads"} <= set(d) for d in body["daily"])
+        assert all(1 <= h["dow"] <= 7 and 0 <= h["hour"] <= 23 for h in body["hourly"])
+
+    def test_executive_reports_server_timing(self, admin_headers):
+        r = requests.get(f"{BASE_URL}/api/admin/analytics/executive?days=30", headers=admin_headers)
+        assert r.status_code == 200, r.text
+        assert "Server-Timing" not in r.headers
+        r = requests.get(f"{BASE_URL}/api/admin/analytics/executive?days=30", headers={**admin_headers, "X-Debug-Timing": "1"})
+        assert r.status_code == 200, r.text
+        timing = r.headers.get("Server-Timing", "")
+        assert "events;dur=" in timing and "leads;dur=" in timing and "total;dur=" in timing
+        assert set(r.json()["metrics"]) >= {"sessions", "total_leads", "completion_rate"}
+
+    def test_events_health_tracks_new_events(self, admin_headers):
+        def focus_stats():
+            r = requests.get(f"{BASE_URL}/api/admin/analytics/events-health", headers=admin_headers)
+            assert r.status_code == 200, r.text
+            return next(e for e in r.json()["events"] if e["event"] == "tlj_field_focus")
+        before = focus_stats()
+        requests.post(f"{BASE_URL}/api/events", json={"event_name": "tlj_field_focus", "session_id": f"pytest_health_{TS}"})
+        time.sleep(2)  # event buffer flush
+        after = focus_stats()
+        assert after["total_count"] == before["total_count"] + 1
+        assert after["last_7d_count"] >= 1 and after["status"] == "healthy"
+
+    def test_visitors_sketch_matches_exact_for_small_counts(self, admin_headers):
+        url = f"{BASE_URL}/api/admin/analytics/visitors?days=7"
+        approx = requests.get(url, headers=admin_headers).json()
+        exact = requests.get(url + "&exact=true", headers=admin_headers).json()
+        # sketches are exact below 1024 distinct ids per row
+        small = {d["date"]: d["unique"] for d in exact["daily_visitors"] if d["unique"] < 1000}
+        assert all(d["unique"] == small[d["date"]] for d in approx["daily_visitors"] if d["date"] in small)
+
+    def test_step_time_percentiles(self, admin_headers):
+        requests.post(f"{BASE_URL}/api/events", json={"event_name": "tlj_step_complete", "session_id": f"pytest_pct_{TS}", "wizard_step": "pytest_step", "step_time_ms": 4000})
+        time.sleep(2)  # event buffer flush
+        r = requests.get(f"{BASE_URL}/api/admin/analytics/friction?days=1", headers=admin_headers)
+        assert r.status_code == 200, r.text
+        steps = r.json()["slowest_steps"]
+        assert steps and all(s["p50_time_sec"] <= s["p90_time_sec"] <= s["p99_time_sec"] for s in steps)
+        assert [s["p50_time_sec"] for s in steps] == sorted((s["p50_time_sec"] for s in steps), reverse=True)
+        metrics = requests.get(f"{BASE_URL}/api/admin/analytics/executive?days=1", headers=admin_headers).json()["metrics"]
+        assert metrics["median_step_time_sec"]["value"] > 0
+
+    def test_funnel_sequence(self, admin_headers):
+        r = requests.get(f"{BASE_URL}/api/admin/analytics/funnel/sequence?days=30&steps=tlj_session_start,tlj_wizard_start,tlj_lead_created", headers=admin_headers)
+        assert r.status_code == 200, r.text
+        steps = r.json()["steps"]
+        assert [s["step"] for s in steps] == ["tlj_session_start", "tlj_wizard_start", "tlj_lead_created"]
+        assert steps[0]["sessions"] >= steps[1]["sessions"] >= steps[2]["sessions"]
+        assert steps[0]["time_from_prev_sec"] is None and set(steps[1]["time_from_prev_sec"]) == {"p50", "p90"}
+
+    def test_funnel_sequence_rejects_bad_definition(self, admin_headers):
+        r = requests.get(f"{BASE_URL}/api/admin/analytics/funnel/sequence?steps=$where", headers=admin_headers)
+        assert r.status_code == 400
+
+    def test_funnel_and_geo_shape(self, admin_headers):
+        funnel = requests.get(f"{BASE_URL}/api/admin/analytics/funnel?days=30", headers=admin_headers)
+        assert funnel.status_code == 200, funnel.text
+        assert all({"count", "unique_sessions"} <= set(v) for v in funnel.json()["funnel"].values())
+        geo = requests.get(f"{BASE_URL}/api/admin/analytics/geo?days=30&exact=true", headers=admin_headers)
+        assert geo.status_code == 200, geo.text
+        assert all(c["sessions"] <= c["events"] for c in geo.json()["countries"])
+
+    def test_sources_use_landing_path_and_referrer_host(self, admin_headers):
+        requests.post(f"{BASE_URL}/api/events", json={
+            "event_name": "tlj_session_start", "session_id": f"pytest_src_{TS}",
+            "attribution": {"landing_url": f"https://example.com/pytest-landing?gclid={TS}#top", "referrer_url": "https://WWW.Example.org/q?x=1"},
+        })
+        time.sleep(2)  # event buffer flush
+        r = requests.get(f"{BASE_URL}/api/admin/analytics/sources?days=1", headers=admin_headers)
+        assert r.status_code == 200, r.text
+        assert all("?" not in lp["url"] and "#" not in lp["url"] for lp in r.json()["landing_pages"])
+        assert all("/" not in ref["url"] for ref in r.json()["referrers"])
+
+
+# ── Outbound message queue ──────────────────────────────────
+class TestOutbox:
+    def test_contact_returns_without_waiting_on_providers(self, session):
+        started = time.time()
+        r = session.post(f"{BASE_URL}/api/contact", json={"name": f"TEST_Outbox_{TS}", "email": f"outbox_{TS}@example.com", "message": "queue me"})
+        assert r.status_code == 200, r.text
+        assert time.time() - started < 5
+
+    def test_dead_letter_view(self, admin_headers):
+        r = requests.get(f"{BASE_URL}/api/admin/outbox?status=dead", headers=admin_headers)
+        assert r.status_code == 200, r.text
+        body = r.json()
+        assert set(body["counts"]) >= {"pending", "sent", "dead"}
+        assert all(m["status"] == "dead" for m in body["messages"])
+        assert requests.get(f"{BASE_URL}/api/admin/outbox?status=bogus", headers=admin_headers).status_code == 400
+        assert requests.post(f"{BASE_URL}/api/admin/outbox/msg_missing/retry", headers=admin_headers).status_code == 404
+
+
+# ── Staged lead submission ──────────────────────────────────
+class TestLeadPipeline:
+    def test_submit_token_resolves_to_linked_user(self, session, admin_headers):
+        lead_id = f"lead_pytest_{TS}"
+        r = session.post(f"{BASE_URL}/api/leads/submit", json={
+            "lead_id": lead_id, "first_name": "TEST_Pipeline", "email": f"pipeline_{TS}@example.com",
+            "answers": {"product_type": "engagement_ring"}, "attribution": {"anonymous_id": f"anon_{TS}"},
+        })
+        assert r.status_code == 200, r.text
+        tok = r.json()["token"]
+        # Usable before the background stages have run: the token links the lead on demand.
+        me = requests.get(f"{BASE_URL}/api/me/leads", headers={"Authorization": f"Bearer {tok}"})
+        assert me.status_code == 200, me.text
+        assert lead_id in [ld["lead_id"] for ld in me.json()["leads"]]
+        for _ in range(20):
+            lead = requests.get(f"{BASE_URL}/api/admin/leads/{lead_id}", headers=admin_headers).json().get("lead") or {}
+            if lead.get("lead_score"):
+                break
+            time.sleep(0.5)
+        assert lead.get("lead_score", 0) >= 45
+
+    def test_pipeline_metrics(self, admin_headers):
+        r = requests.get(f"{BASE_URL}/api/admin/lead-pipeline", headers=admin_headers)
+        assert r.status_code == 200, r.text
+        body = r.json()
+        assert set(body["stages"]) == {"score", "link_user", "session", "notify", "index"}
+        assert {"queued", "failed", "failed_leads"} <= set(body)
+        assert requests.post(f"{BASE_URL}/api/admin/lead-pipeline/lead_missing/retry", headers=admin_headers).status_code == 404
+
+
+# ── Declarative lead scoring ────────────────────────────────
+class TestLeadScoring:
+    def test_rules_are_readable(self, admin_headers):
+        r = requests.get(f"{BASE_URL}/api/admin/lead-scoring", headers=admin_headers)
+        assert r.status_code == 200, r.text
+        rules = r.json()["rules"]
+        assert isinstance(rules["rules"], list) and rules["buckets"]
+
+    def test_invalid_rules_rejected(self, admin_headers):
+        r = requests.put(f"{BASE_URL}/api/admin/lead-scoring?rescore=false", headers=admin_headers,
+                         json={"rules": [{"field": "phone", "op": "regex", "value": ".*"}]})
+        assert r.status_code == 400
+
+    def test_quick_quote_scored_by_rules(self, session, admin_headers):
+        r = session.post(f"{BASE_URL}/api/leads/quick", json={
+            "name": "TEST_Scoring", "email": f"scoring_{TS}@example.com", "phone": f"+1555{TS % 10000000:07d}",
+        })
+        assert r.status_code == 200, r.text
+        lead = requests.get(f"{BASE_URL}/api/admin/leads/{r.json()['lead_id']}", headers=admin_headers).json()["lead"]
+        assert lead["intent_bucket"] in ("high", "medium", "low")
+        assert "quick_quote" in lead["quality_flags"] and "has_phone" in lead["quality_flags"]
+
+
+# ── Keyset pagination ───────────────────────────────────────
+class TestPagination:
+    def test_leads_cursor_pages_do_not_overlap(self, admin_headers):
+        r = requests.get(f"{BASE_URL}/api/admin/leads?limit=2", headers=admin_headers)
+        assert r.status_code == 200, r.text
+        first = r.json()
+        assert "page" not in first and len(first["leads"]) <= 2
+        if not first["next_cursor"]:
+            pytest.skip("fewer than 3 leads")
+        r2 = requests.get(f"{BASE_URL}/api/admin/leads?limit=2&cursor={first['next_cursor']}", headers=admin_headers)
+        assert r2.status_code == 200, r2.text
+        seen = {ld["lead_id"] for ld in first["leads"]}
+        assert r2.json()["leads"] and not seen & {ld["lead_id"] for ld in r2.json()["leads"]}
+
+    def test_legacy_page_param_still_pages(self, admin_headers):
+        first = requests.get(f"{BASE_URL}/api/admin/leads?limit=2", headers=admin_headers).json()
+        if not first["next_cursor"]:
+            pytest.skip("fewer than 3 leads")
+        r = requests.get(f"{BASE_URL}/api/admin/leads?limit=2&page=2", headers=admin_headers)
+        assert r.status_code == 200, r.text
+        by_cursor = requests.get(f"{BASE_URL}/api/admin/leads?limit=2&cursor={first['next_cursor']}", headers=admin_headers).json()
+        assert [ld["lead_id"] for ld in r.json()["leads"]] == [ld["lead_id"] for ld in by_cursor["leads"]]
+
+    def test_exact_total_on_request(self, admin_headers):
+        r = requests.get(f"{BASE_URL}/api/admin/orders?limit=5&total=exact", headers=admin_headers)
+        assert r.status_code == 200, r.text
+        assert r.json()["total_exact"] is True and isinstance(r.json()["total"], int)
+        r = requests.get(f"{BASE_URL}/api/admin/threads?total=none", headers=admin_headers)
+        assert r.status_code == 200 and r.json()["total"] is None
+
+    def test_bad_cursor_and_total_rejected(self, admin_headers):
+        assert requests.get(f"{BASE_URL}/api/admin/leads?cursor=not-a-cursor", headers=admin_headers).status_code == 400
+        assert requests.get(f"{BASE_URL}/api/admin/shop-orders?total=all", headers=admin_headers).status_code == 400
+
+    def test_capped_lists_expose_next_cursor(self, admin_headers):
+        for path, key in (("shop-orders", "orders"), ("threads", "threads"), ("contact-submissions", "submissions")):
+            r = requests.get(f"{BASE_URL}/api/admin/{path}?limit=1", headers=admin_headers)
+            assert r.status_code == 200, r.text
+            assert len(r.json()[key]) <= 1 and "next_cursor" in r.json()
+
+
+# ── Streaming exports ───────────────────────────────────────
+class TestExports:
+    def test_leads_csv_header(self, admin_headers):
+        r = requests.get(f"{BASE_URL}/api/admin/leads/export.csv", headers=admin_headers)
+        assert r.status_code == 200, r.text
+        assert r.text.splitlines()[0].startswith("lead_id,first_name,phone,email")
+
+    def test_events_jsonl_gzip(self, admin_headers):
+        import gzip
+        import json
+        r = requests.get(f"{BASE_URL}/api/admin/export/events?format=jsonl&gzip=true&fields=event_name,geo.country&limit=20", headers=admin_headers)
+        assert r.status_code == 200, r.text
+        rows = [json.loads(line) for line in gzip.decompress(r.content).decode().splitlines()]
+        assert len(rows) <= 20 and all(set(row) == {"event_name", "geo.country"} for row in rows)
+
+    def test_rejects_bad_fields_and_datasets(self, admin_headers):
+        assert requests.get(f"{BASE_URL}/api/admin/export/events?fields=$where", headers=admin_headers).status_code == 400
+        assert requests.get(f"{BASE_URL}/api/admin/export/users", headers=admin_headers).status_code == 404
@@ -63,6 +63,17 @@ def test_admin_settings_patch_persists(client, admin_headers):
     }, headers=admin_headers)
 
 
+# --- Cached settings pick up admin writes ---
+def test_abtest_config_reflects_admin_patch(client, admin_headers):
+    before = client.get("/api/abtest/config").json()
+    r = client.patch("/api/admin/abtest", json={"variant_a_weight": 37}, headers=admin_headers)
+    assert r.status_code == 200, r.text
+    try:
+        assert client.get("/api/abtest/config").json()["variant_a_weight"] == 37
+    finally:
+        client.patch("/api/admin/abtest", json={"variant_a_weight": before.get("variant_a_weight", 50)}, headers=admin_headers)
+
+
 # --- Seed a paid order, then test checkout/status + admin invoice ---
 @pytest.fixture(scope="module")
 def seeded_order():
@@ -0,0 +1,116 @@
+"""Offline tests for the local object-storage backend and the storage
+facade's per-operation metrics (temp dir, no R2, no server).
+
+Run:  cd /app/backend && python -m pytest tests/test_storage.py -q
+"""
+import os
+import sys
+import asyncio
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402
+from storage import LocalBackend, ObjectNotModified, RangeNotSatisfiable  # noqa: E402
+
+DATA = bytes(range(256)) * 4   # 1024 bytes
+PATH = "tlj/uploads/clip.mp4"
+
+
+@pytest.fixture
+def backend(tmp_path):
+    return LocalBackend(str(tmp_path))
+
+
+@pytest.fixture
+def facade(backend, monkeypatch):
+    """The async storage API over `backend`, with fresh metrics."""
+    monkeypatch.setattr(storage, "_backend", backend)
+    monkeypatch.setattr(storage, "_metrics", {})
+    return storage
+
+
+def _read(obj) -> bytes:
+    try:
+        return obj["body"].read()
+    finally:
+        obj["body"].close()
+
+
+def test_put_then_open_whole(backend):
+    meta = backend.put(PATH, DATA, "video/mp4")
+    assert meta["path"] == PATH and meta["size"] == len(DATA)
+    obj = backend.open(PATH)
+    assert obj["content_length"] == len(DATA) and obj["content_range"] == ""
+    assert obj["content_type"] == "video/mp4"
+    assert obj["etag"] == meta["etag"]
+    assert _read(obj) == DATA
+    assert backend.exists(PATH)
+    assert not any(name.endswith(".tmp") for name in os.listdir(os.path.dirname(os.path.join(backend.root, PATH))))
+
+
+@pytest.mark.parametrize("byte_range,start,end", [
+    ("bytes=100-199", 100, 199),
+    ("bytes=1000-", 1000, 1023),
+    ("bytes=-24", 1000, 1023),
+    ("bytes=1000-5000", 1000, 1023),   # end clamped to the object
+])
+def test_open_range(backend, byte_range, start, end):
+    backend.put(PATH, DATA, "video/mp4")
+    obj = backend.open(PATH, byte_range)
+    assert obj["content_range"] == f"bytes {start}-{end}/{len(DATA)}"
+    assert obj["content_length"] == end - start + 1
+    assert obj["body"].remaining == end - start + 1
+    assert _read(obj) == DATA[start:end + 1]
+
+
+def test_range_past_end_is_not_satisfiable(backend):
+    backend.put(PATH, DATA, "video/mp4")
+    with pytest.raises(RangeNotSatisfiable) as exc:
+        backend.open(PATH, f"bytes={len(DATA)}-")
+    assert exc.value.size == len(DATA)
+
+
+def test_etag_conditional_open(backend):
+    etag = backend.put(PATH, DATA, "video/mp4")["etag"]
+    with pytest.raises(ObjectNotModified):
+        backend.open(PATH, if_none_match=etag)
+    assert _read(backend.open(PATH, if_none_match='"stale"')) == DATA
+    new_etag = backend.put(PATH, DATA + b"!", "video/mp4")["etag"]
+    assert new_etag != etag
+
+
+def test_delete_and_missing(backend):
+    backend.put(PATH, DATA, "video/mp4")
+    backend.delete(PATH)
+    assert not backend.exists(PATH)
+    with pytest.raises(FileNotFoundError):
+        backend.open(PATH)
+    with pytest.raises(FileNotFoundError):
+        backend.open("../outside.txt")   # paths can't escape the root
+
+
+def test_metrics_count_calls_and_errors(facade):
+    async def run():
+        await facade.put_object(PATH, DATA, "video/mp4")
+        obj = await facade.open_object(PATH, "bytes=0-9")
+        assert b"".join([chunk async for chunk in facade.iter_body(obj["body"])]) == DATA[:10]
+        assert await facade.object_exists(PATH)
+        with pytest.raises(RangeNotSatisfiable):
+            await facade.open_object(PATH, "bytes=5000-")
+        assert await facade.delete_object(PATH) is True
+        with pytest.raises(FileNotFoundError):
+            await facade.open_object(PATH)
+        assert await facade.delete_object(PATH) is False
+
+    asyncio.run(run())
+    m = facade.storage_metrics()
+    assert m["backend"] == "local"
+    ops = m["ops"]
+    assert ops["put"]["calls"] == 1 and ops["put"]["errors"] == 0
+    # A 416 is an answer, not a failure; the missing object is.
+    assert ops["open"]["calls"] == 3 and ops["open"]["errors"] == 1
+    assert ops["head"]["calls"] == 1
+    assert ops["delete"]["calls"] == 2 and ops["delete"]["errors"] == 1
+    assert all(op["max_ms"] >= op["avg_ms"] >= 0 for op in ops.values())
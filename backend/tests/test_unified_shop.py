@@ -129,6 +129,13 @@ class TestCollections:
         prices = [p.get("price") or p.get("from_price") or 0 for p in r.json()["products"]]
         assert prices == sorted(prices, reverse=True), prices
 
+    def test_product_counts_match_collection_listing(self, api):
+        cols = api.get(f"{BASE_URL}/api/collections", params={"all": True}).json()["collections"]
+        for c in cols[:10]:
+            r = api.get(f"{BASE_URL}/api/collections/{c['slug']}")
+            assert r.status_code == 200
+            assert c["product_count"] == r.json()["total"], c["slug"]
+
     def test_collection_404(self, api):
         r = api.get(f"{BASE_URL}/api/collections/does-not-exist-xyz")
         assert r.status_code == 404
@@ -172,6 +179,20 @@ class TestProductsFromProjects:
             if "featured" in p:
                 assert p["featured"] is True
 
+    def test_cards_carry_srcset(self, api):
+        r = api.get(f"{BASE_URL}/api/products")
+        assert r.status_code == 200
+        for p in r.json()["products"]:
+            assert "hero_srcset" in p and "hero_sources" in p
+            assert all(src["type"] in ("image/avif", "image/webp") for src in p["hero_sources"])
+            if p["hero_image_url"].startswith("/api/uploads/cloud/") and p["hero_srcset"]:
+                widths = [s["width"] for s in p["hero_srcset"]]
+                assert widths == sorted(widths)
+                img = api.get(f"{BASE_URL}{p['hero_srcset'][0]['url']}")
+                assert img.status_code == 200
+                assert img.headers["Content-Type"] == "image/webp"
+                break
+
 
 # ────────────────────────────────────────────────────────────
 # Public project detail enrichment
@@ -234,6 +255,20 @@ class TestCheckout:
         r = api.post(f"{BASE_URL}/api/checkout/session", json={"items": [], "origin_url": BASE_URL})
         assert r.status_code == 400
 
+    def test_cart_quote_matches_matrix(self, api):
+        pr = api.get(f"{BASE_URL}/api/projects/{BUYABLE_SLUG_A}")
+        cell = float(pr.json()["price_matrix"]["14k"]["2"])
+        r = api.post(f"{BASE_URL}/api/cart/quote", json={"items": [
+            {"product_slug": BUYABLE_SLUG_A, "quantity": 2, "metal_tier": "14k", "carat": "2"},
+            {"product_slug": "nope-zzz", "quantity": 1},
+        ]})
+        assert r.status_code == 200, r.text
+        data = r.json()
+        assert [l["slug"] for l in data["items"]] == [BUYABLE_SLUG_A]
+        assert data["items"][0]["unit"] == cell
+        assert data["total"] == round(cell * 2, 2)
+        assert data["unavailable"][0]["slug"] == "nope-zzz"
+
 
 # ────────────────────────────────────────────────────────────
 # Admin projects (collections + price_matrix)
@@ -289,6 +324,28 @@ class TestAdminProjects:
         payload["price_matrix"]["14k"]["2"] = original_cell
         api.put(f"{BASE_URL}/api/admin/projects/{pid}", json=payload, headers=admin_headers)
 
+    def test_unpublish_refreshes_storefront_cards(self, api, admin_headers):
+        """Storefront lists read db.product_cards — an admin write must show up
+        on the very next request."""
+        r = api.get(f"{BASE_URL}/api/admin/projects", headers=admin_headers)
+        projs = r.json().get("projects") or r.json().get("items") or []
+        target = next(p for p in projs if p.get("slug") == BUYABLE_SLUG_C)
+        pid = target.get("project_id") or target.get("id")
+        payload = dict(target)
+        payload.pop("_id", None)
+
+        payload["published"] = False
+        r2 = api.put(f"{BASE_URL}/api/admin/projects/{pid}", json=payload, headers=admin_headers)
+        assert r2.status_code == 200, r2.text
+        try:
+            slugs = {p["slug"] for p in api.get(f"{BASE_URL}/api/products?limit=200").json()["products"]}
+            assert BUYABLE_SLUG_C not in slugs
+        finally:
+            payload["published"] = True
+            api.put(f"{BASE_URL}/api/admin/projects/{pid}", json=payload, headers=admin_headers)
+        slugs = {p["slug"] for p in api.get(f"{BASE_URL}/api/products?limit=200").json()["products"]}
+        assert BUYABLE_SLUG_C in slugs
+
 
 # ────────────────────────────────────────────────────────────
 # Site-wide SALE
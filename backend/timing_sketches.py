@@ -0,0 +1,153 @@
+"""Hourly duration sketches behind step-time percentiles and A/B time-to-submit.
+
+`db.timing_sketches` holds one document per metric x key x hour:
+
+    {metric: "step_time", key: "<wizard_step>", ts: <hour>, n, b: {"<bucket>": count}}
+
+where `b` is a quantile_sketch histogram. An `event_buffer` flush hook folds
+each stored batch in with one `$inc` upsert per (metric, key, hour), so the
+sketches are current within a flush and concurrent workers never conflict.
+`percentiles(metric, start, end)` merges the hours in the window (rounded out
+to whole hours) and reads p50/p90/p99 without touching raw events.
+
+On first start one worker seeds the sketches from `db.events` under a
+seed_claim cutoff, with the same `$inc` as the hook, so the seed and live
+flushes add up. `python timing_sketches.py` clears and re-seeds them (run it
+with ingestion paused).
+"""
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from pymongo import UpdateOne
+
+import seed_claim
+from admin_routes import db
+from event_buffer import event_buffer
+from quantile_sketch import bucket, merge, quantiles
+
+logger = logging.getLogger(__name__)
+
+# metric -> which events feed it, where the duration lives and what it's keyed by
+TIMING_METRICS = {
+    "step_time": {"event_name": "tlj_step_complete", "value": "step_time_ms", "key": "wizard_step"},
+    "time_to_submit": {"event_name": "tlj_ab_form_completed", "value": "event_data.time_to_submit_ms", "key": "event_data.variant"},
+}
+PERCENTILES = (0.5, 0.9, 0.99)
+_SEEDED_KEY = "timing_sketches_seeded"
+_BY_EVENT = {spec["event_name"]: (metric, spec) for metric, spec in TIMING_METRICS.items()}
+_as_of: Optional[datetime] = None   # seed cutoff: earlier events came from the seed
+
+
+def _dig(doc: dict, path: str):
+    for part in path.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+def _fold(docs, into: Dict[tuple, Dict[int, int]]):
+    for doc in docs:
+        metric, spec = _BY_EVENT.get(doc.get("event_name"), (None, None))
+        ts = doc.get("server_timestamp")
+        if not metric or not isinstance(ts, datetime):
+            continue
+        b = bucket(_dig(doc, spec["value"]))
+        if b is None:
+            continue
+        key = _dig(doc, spec["key"])
+        hour = ts.replace(minute=0, second=0, microsecond=0)
+        counts = into[(metric, str(key) if key is not None else "unknown", hour)]
+        counts[b] = counts.get(b, 0) + 1
+
+
+def _ops(sketches: Dict[tuple, Dict[int, int]]) -> List[UpdateOne]:
+    ops = []
+    for (metric, key, hour), counts in sketches.items():
+        fields = {"n": sum(counts.values()), **{f"b.{b}": n for b, n in counts.items()}}
+        ops.append(UpdateOne({"metric": metric, "key": key, "ts": hour}, {"$inc": fields}, upsert=True))
+    return ops
+
+
+@event_buffer.on_flush
+async def record_events(docs: List[dict]):
+    """Fold one stored batch of events into the hourly sketches."""
+    sketches: Dict[tuple, Dict[int, int]] = defaultdict(dict)
+    _fold([doc for doc in docs if seed_claim.counts(doc, _as_of)], sketches)
+    if sketches:
+        await db.timing_sketches.bulk_write(_ops(sketches), ordered=False)
+
+
+async def _seed(before: datetime) -> int:
+    """Add every timed event before `before` to the sketches (one pass)."""
+    sketches: Dict[tuple, Dict[int, int]] = defaultdict(dict)
+    projection = {"_id": 0, "event_name": 1, "server_timestamp": 1}
+    for spec in TIMING_METRICS.values():
+        projection.update({spec["value"]: 1, spec["key"]: 1})
+    query = {"event_name": {"$in": list(_BY_EVENT)}, "server_timestamp": {"$lt": before}}
+    cursor = db.events.find(query, projection).batch_size(1000)
+    batch = []
+    async for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= 1000:
+            _fold(batch, sketches)
+            batch = []
+    _fold(batch, sketches)
+    ops = _ops(sketches)
+    for i in range(0, len(ops), 1000):
+        await db.timing_sketches.bulk_write(ops[i:i + 1000], ordered=False)
+    logger.info(f"Seeded {len(ops)} timing sketches")
+    return len(ops)
+
+
+async def ensure_seeded(background: bool = True):
+    """Index the sketches; the worker that claims the seed fills them from db.events
+    (in the background unless `background` is False)."""
+    global _as_of
+    try:
+        await db.timing_sketches.create_index([("metric", 1), ("ts", 1), ("key", 1)], unique=True)
+    except Exception:
+        pass
+    claimed, _as_of = await seed_claim.claim(_SEEDED_KEY)
+    if claimed:
+        await seed_claim.run(_SEEDED_KEY, _as_of, _seed, background=background)
+
+
+async def rebuild() -> int:
+    """Clear the sketches and re-seed them from db.events."""
+    await seed_claim.reset(_SEEDED_KEY)
+    await db.timing_sketches.delete_many({})
+    await ensure_seeded(background=False)
+    return await db.timing_sketches.count_documents({})
+
+
+async def percentiles(metric: str, start: Optional[datetime] = None, end: Optional[datetime] = None, keys: Optional[List[str]] = None) -> Dict[str, dict]:
+    """{key: {n, p50, p90, p99}} in ms for `metric` over [start, end], plus
+    "_all" merged across keys. Open-ended when start/end are None."""
+    query: dict = {"metric": metric}
+    if start or end:
+        query["ts"] = {}
+        if start:
+            query["ts"]["$gte"] = start.replace(minute=0, second=0, microsecond=0)
+        if end:
+            query["ts"]["$lte"] = end
+    if keys is not None:
+        query["key"] = {"$in": keys}
+    per_key: Dict[str, list] = defaultdict(list)
+    async for doc in db.timing_sketches.find(query, {"_id": 0, "key": 1, "b": 1}):
+        per_key[doc["key"]].append(doc.get("b"))
+    merged = {key: merge(parts) for key, parts in per_key.items()}
+    if merged:
+        merged["_all"] = merge(merged.values())
+    out = {}
+    for key, counts in merged.items():
+        q = quantiles(counts, PERCENTILES)
+        out[key] = {"n": sum(counts.values()), **{f"p{round(p * 100)}": round(v) for p, v in q.items()}}
+    return out
+
+
+if __name__ == "__main__":
+    print(f"rebuilt {asyncio.run(rebuild())} timing sketches")
@@ -0,0 +1,97 @@
+"""Bounded in-process LRU cache with per-entry TTL and hit/miss counters.
+
+Used for hot per-event lookups (UA parsing, GeoIP) where the same keys repeat
+heavily across requests:
+
+    _ua_cache = TTLCache("user_agent", maxsize=20000, ttl=86400)
+    parsed = _ua_cache.get_or_set(ua_string, lambda: _parse(ua_string))
+
+`get_or_load` is the async variant with per-key single-flight: concurrent
+misses for one key share a single loader call. Every cache registers itself
+so `all_cache_stats()` can report them all.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+_MISSING = object()
+_registry: Dict[str, "TTLCache"] = {}
+
+
+class TTLCache:
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()   # key -> (expires_at, value)
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        _registry[name] = self
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value: Any, ttl: float = None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def get_or_set(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = compute()
+            self.set(key, value)
+        return value
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        pending = self._inflight.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(loader())
+            self._inflight[key] = pending
+            pending.add_done_callback(lambda _: self._inflight.pop(key, None))
+            value = await asyncio.shield(pending)
+            self.set(key, value)
+            return value
+        return await asyncio.shield(pending)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+        }
+
+
+def all_cache_stats() -> dict:
+    """Stats for every TTLCache in this process, keyed by name."""
+    return {name: cache.stats() for name, cache in _registry.items()}
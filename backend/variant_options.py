@@ -241,3 +241,9 @@ def apply_sale(price: float, sale: dict) -> float:
     except (TypeError, ValueError):
         return price
     return round(price * (1 - pct / 100.0), 2)
+
+
+def card_pricing(base: float, sale: dict) -> tuple:
+    """(price, compare_at_price, on_sale) for a card whose lowest cell is `base`."""
+    on_sale = bool(sale) and base > 0
+    return (apply_sale(base, sale) if on_sale else base), (base if on_sale else None), on_sale
@@ -0,0 +1,174 @@
+"""Per-visitor feature store behind lead scoring.
+
+`db.visitor_features` holds one document per anonymous_id:
+
+    {anonymous_id, events, sessions, visits, pages, time_on_site_sec, first_seen, last_seen}
+
+- sessions: tlj_session_start events (the client's own session count)
+- visits: runs of activity separated by more than VISIT_GAP of inactivity
+- pages: `*_view` events
+- time_on_site_sec: gaps between consecutive events within a visit
+
+An `event_buffer` flush hook folds each stored batch in: one read for the
+batch's visitors (their `last_seen`, to bridge gaps across batches), then one
+`$inc`/`$min`/`$max` upsert per visitor. Events older than `last_seen` still
+count but add no time. Scoring a lead is then a single `find_one` instead of a
+scan over `db.events`.
+
+On first start one worker seeds the store from `db.events` under a
+seed_claim cutoff, writing with the hook's `$inc`/`$min`/`$max` so the seed
+and live flushes add up. A visitor active across the cutoff may count one
+extra visit (the hook can't bridge to a `last_seen` the seed hasn't written
+yet). `python visitor_features.py` clears and re-seeds the store (run it
+with ingestion paused).
+"""
+import asyncio
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional
+
+from pymongo import UpdateOne
+
+import seed_claim
+from admin_routes import db
+from event_buffer import event_buffer
+
+logger = logging.getLogger(__name__)
+
+VISIT_GAP = timedelta(minutes=30)
+FEATURES = ("events", "sessions", "visits", "pages", "time_on_site_sec")
+_SEEDED_KEY = "visitor_features_seeded"
+_as_of: Optional[datetime] = None   # seed cutoff: earlier events came from the seed
+
+
+def _aware(dt: Optional[datetime]) -> Optional[datetime]:
+    return dt.replace(tzinfo=timezone.utc) if dt and dt.tzinfo is None else dt
+
+
+def _fold(events: List[dict], last_seen: Optional[datetime]) -> dict:
+    """Counter increments for one visitor's events (sorted by time)."""
+    inc = {name: 0 for name in FEATURES}
+    prev = last_seen
+    for e in events:
+        ts = _aware(e["server_timestamp"])
+        name = e.get("event_name") or ""
+        inc["events"] += 1
+        if name == "tlj_session_start":
+            inc["sessions"] += 1
+        if name.endswith("_view"):
+            inc["pages"] += 1
+        if prev is None or ts - prev > VISIT_GAP:
+            inc["visits"] += 1
+        elif ts > prev:
+            inc["time_on_site_sec"] += (ts - prev).total_seconds()
+        if prev is None or ts > prev:
+            prev = ts
+    inc["time_on_site_sec"] = round(inc["time_on_site_sec"], 1)
+    return inc
+
+
+def _by_visitor(docs: List[dict]) -> Dict[str, List[dict]]:
+    grouped: Dict[str, List[dict]] = {}
+    for doc in docs:
+        if doc.get("anonymous_id") and isinstance(doc.get("server_timestamp"), datetime):
+            grouped.setdefault(doc["anonymous_id"], []).append(doc)
+    for events in grouped.values():
+        events.sort(key=lambda e: _aware(e["server_timestamp"]))
+    return grouped
+
+
+def _upsert(anonymous_id: str, events: List[dict], last_seen: Optional[datetime]) -> UpdateOne:
+    return UpdateOne(
+        {"anonymous_id": anonymous_id},
+        {
+            "$inc": _fold(events, last_seen),
+            "$min": {"first_seen": events[0]["server_timestamp"]},
+            "$max": {"last_seen": events[-1]["server_timestamp"]},
+        },
+        upsert=True,
+    )
+
+
+@event_buffer.on_flush
+async def record_events(docs: List[dict]):
+    """Fold one stored batch of events into the visitors' features."""
+    grouped = _by_visitor([doc for doc in docs if seed_claim.counts(doc, _as_of)])
+    if not grouped:
+        return
+    last_seen = {
+        f["anonymous_id"]: _aware(f.get("last_seen"))
+        async for f in db.visitor_features.find({"anonymous_id": {"$in": list(grouped)}}, {"_id": 0, "anonymous_id": 1, "last_seen": 1})
+    }
+    ops = [_upsert(anonymous_id, events, last_seen.get(anonymous_id)) for anonymous_id, events in grouped.items()]
+    await db.visitor_features.bulk_write(ops, ordered=False)
+
+
+async def _seed(before: datetime) -> int:
+    """Add every visitor's events before `before` to the store."""
+    pipeline = [
+        {"$match": {"anonymous_id": {"$nin": [None, ""]}, "server_timestamp": {"$lt": before}}},
+        {"$project": {"_id": 0, "anonymous_id": 1, "event_name": 1, "server_timestamp": 1}},
+        {"$sort": {"anonymous_id": 1, "server_timestamp": 1}},
+    ]
+    ops: List[UpdateOne] = []
+    written = 0
+    current, events = None, []
+
+    async def flush_ops():
+        nonlocal ops, written
+        if ops:
+            await db.visitor_features.bulk_write(ops, ordered=False)
+            written += len(ops)
+            ops = []
+
+    def add(anonymous_id, events):
+        events = [e for e in events if isinstance(e.get("server_timestamp"), datetime)]
+        if events:
+            ops.append(_upsert(anonymous_id, events, None))
+
+    async for doc in db.events.aggregate(pipeline, allowDiskUse=True):
+        if doc["anonymous_id"] != current:
+            add(current, events)
+            current, events = doc["anonymous_id"], []
+            if len(ops) >= 1000:
+                await flush_ops()
+        events.append(doc)
+    add(current, events)
+    await flush_ops()
+    logger.info(f"Seeded features for {written} visitors")
+    return written
+
+
+async def ensure_seeded(background: bool = True):
+    """Index the store; the worker that claims the seed fills it from db.events
+    (in the background unless `background` is False)."""
+    global _as_of
+    await db.visitor_features.create_index("anonymous_id", unique=True)
+    claimed, _as_of = await seed_claim.claim(_SEEDED_KEY)
+    if claimed:
+        await seed_claim.run(_SEEDED_KEY, _as_of, _seed, background=background)
+
+
+async def rebuild() -> int:
+    """Clear the store and re-seed it from db.events."""
+    await seed_claim.reset(_SEEDED_KEY)
+    await db.visitor_features.delete_many({})
+    await ensure_seeded(background=False)
+    return await db.visitor_features.count_documents({})
+
+
+async def get(anonymous_id: Optional[str]) -> dict:
+    """Features for one visitor (zeros for an unknown one)."""
+    doc = await db.visitor_features.find_one({"anonymous_id": anonymous_id}, {"_id": 0}) if anonymous_id else None
+    return {**{name: 0 for name in FEATURES}, **(doc or {})}
+
+
+async def get_many(anonymous_ids: List[str]) -> Dict[str, dict]:
+    out = {}
+    async for doc in db.visitor_features.find({"anonymous_id": {"$in": [a for a in anonymous_ids if a]}}, {"_id": 0}):
+        out[doc["anonymous_id"]] = {**{name: 0 for name in FEATURES}, **doc}
+    return out
+
+
+if __name__ == "__main__":
+    print(f"rebuilt features for {asyncio.run(rebuild())} visitors")
@@ -15,7 +15,9 @@ export default function LeadsCRM() {
   const [leads, setLeads] = useState([]);
   const [total, setTotal] = useState(0);
   const [page, setPage] = useState(1);
-  const [pages, setPages] = useState(0);
+  const [totalExact, setTotalExact] = useState(true);
+  const [cursors, setCursors] = useState([null]);
+  const [nextCursor, setNextCursor] = useState(null);
   const [loading, setLoading] = useState(true);
   const [search, setSearch] = useState('');
   const [statusFilter, setStatusFilter] = useState('');
@@ -39,15 +41,24 @@ export default function LeadsCRM() {
   const fetchLeads = useCallback(async () => {
     setLoading(true);
     try {
-      const params = new URLSearchParams({ page, limit: 25 });
+      const params = new URLSearchParams({ limit: 25 });
+      if (cursors[page - 1]) params.set('cursor', cursors[page - 1]);
       if (search) params.set('search', search);
       if (statusFilter) params.set('status', statusFilter);
       if (productFilter) params.set('product_type', productFilter);
       const res = await api('get', `/api/admin/leads?${params}`);
-      setLeads(res.data.leads); setTotal(res.data.total); setPages(res.data.pages);
+      setLeads(res.data.leads); setTotal(res.data.total); setTotalExact(res.data.total_exact); setNextCursor(res.data.next_cursor);
     } catch (e) { console.error(e); }
     setLoading(false);
-  }, [api, page, search, statusFilter, productFilter]);
+  }, [api, page, cursors, search, statusFilter, productFilter]);
+
+  const resetPaging = () => { setPage(1); setCursors([null]); };
+  const goNext = () => {
+    if (!nextCursor) return;
+    setCursors(c => [...c.slice(0, page), nextCursor]);
+    setPage(p => p + 1);
+  };
+  const pages = totalExact ? Math.max(1, Math.ceil(total / 25)) : null;
 
   useEffect(() => { fetchLeads(); }, [fetchLeads]);
 
@@ -125,15 +136,15 @@ export default function LeadsCRM() {
       <div className="flex flex-wrap gap-3 mb-4">
         <div className="relative flex-1 min-w-[200px]">
           <Search size={16} className="absolute left-3 top-1/2 -translate-y-1/2" style={{ color: 'var(--lj-muted)' }} />
-          <input value={search} onChange={e => { setSearch(e.target.value); setPage(1); }} placeholder="Search name, phone, email..." data-testid="lead-search-input"
+          <input value={search} onChange={e => { setSearch(e.target.value); resetPaging(); }} placeholder="Search name, phone, email..." data-testid="lead-search-input"
             className="w-full min-h-[40px] pl-9 pr-4 rounded-[10px] text-[14px]" style={{ background: 'var(--lj-surface)', border: '1px solid var(--lj-border)', color: 'var(--lj-text)' }} />
         </div>
-        <select value={statusFilter} onChange={e => { setStatusFilter(e.target.value); setPage(1); }}
+        <select value={statusFilter} onChange={e => { setStatusFilter(e.target.value); resetPaging(); }}
           className="min-h-[40px] px-3 rounded-[10px] text-[14px]" style={{ background: 'var(--lj-surface)', border: '1px solid var(--lj-border)', color: 'var(--lj-text)' }}>
           <option value="">All Status</option>
           {STATUSES.map(s => <option key={s} value={s}>{s.charAt(0).toUpperCase() + s.slice(1)}</option>)}
         </select>
-        <select value={productFilter} onChange={e => { setProductFilter(e.target.value); setPage(1); }}
+        <select value={productFilter} onChange={e => { setProductFilter(e.target.value); resetPaging(); }}
           className="min-h-[40px] px-3 rounded-[10px] text-[14px]" style={{ background: 'var(--lj-surface)', border: '1px solid var(--lj-border)', color: 'var(--lj-text)' }}>
           <option value="">All Products</option>
           {PRODUCTS.map(p => <option key={p} value={p}>{formatLabel(p)}</option>)}
@@ -172,11 +183,11 @@ export default function LeadsCRM() {
           </div>
           {/* Pagination */}
           <div className="flex items-center justify-between px-4 py-3" style={{ background: 'var(--lj-surface)', borderTop: '1px solid var(--lj-border)' }}>
-            <span className="text-[13px]" style={{ color: 'var(--lj-muted)' }}>{total} leads total</span>
+            <span className="text-[13px]" style={{ color: 'var(--lj-muted)' }}>{totalExact ? '' : '~'}{total} leads total</span>
             <div className="flex items-center gap-2">
               <button disabled={page <= 1} onClick={() => setPage(p => p - 1)} className="w-8 h-8 rounded-full flex items-center justify-center" style={{ background: 'var(--lj-bg)', color: 'var(--lj-muted)' }}><ChevronLeft size={16} /></button>
-              <span className="text-[13px]" style={{ color: 'var(--lj-text)' }}>Page {page} of {pages || 1}</span>
-              <button disabled={page >= pages} onClick={() => setPage(p => p + 1)} className="w-8 h-8 rounded-full flex items-center justify-center" style={{ background: 'var(--lj-bg)', color: 'var(--lj-muted)' }}><ChevronRight size={16} /></button>
+              <span className="text-[13px]" style={{ color: 'var(--lj-text)' }}>Page {page}{pages ? ` of ${pages}` : ''}</span>
+              <button disabled={!nextCursor} onClick={goNext} className="w-8 h-8 rounded-full flex items-center justify-center" style={{ background: 'var(--lj-bg)', color: 'var(--lj-muted)' }}><ChevronRight size={16} /></button>
             </div>
           </div>
         </div>
@@ -12,7 +12,10 @@ export default function OrdersPage() {
   const [orders, setOrders] = useState([]);
   const [loading, setLoading] = useState(true);
   const [page, setPage] = useState(1);
+  const [cursors, setCursors] = useState([null]);
+  const [nextCursor, setNextCursor] = useState(null);
   const [total, setTotal] = useState(0);
+  const [totalExact, setTotalExact] = useState(true);
   const [editOrder, setEditOrder] = useState(null);
   const [trackingNum, setTrackingNum] = useState('');
   const [shippingUrl, setShippingUrl] = useState('');
@@ -20,11 +23,18 @@ export default function OrdersPage() {
   const fetchOrders = useCallback(async () => {
     setLoading(true);
     try {
-      const res = await api('get', `/api/admin/orders?page=${page}&limit=25`);
-      setOrders(res.data.orders); setTotal(res.data.total);
+      const cursor = cursors[page - 1];
+      const res = await api('get', `/api/admin/orders?limit=25${cursor ? `&cursor=${cursor}` : ''}`);
+      setOrders(res.data.orders); setTotal(res.data.total); setTotalExact(res.data.total_exact); setNextCursor(res.data.next_cursor);
     } catch (e) { console.error(e); }
     setLoading(false);
-  }, [api, page]);
+  }, [api, page, cursors]);
+
+  const goNext = () => {
+    if (!nextCursor) return;
+    setCursors(c => [...c.slice(0, page), nextCursor]);
+    setPage(p => p + 1);
+  };
 
   useEffect(() => { fetchOrders(); }, [fetchOrders]);
 
@@ -75,6 +85,14 @@ export default function OrdersPage() {
               </div>
             );
           })}
+          <div className="flex items-center justify-between pt-2">
+            <span className="text-[13px]" style={{ color: 'var(--lj-muted)' }}>{totalExact ? '' : '~'}{total} orders total</span>
+            <div className="flex items-center gap-2">
+              <button disabled={page <= 1} onClick={() => setPage(p => p - 1)} className="w-8 h-8 rounded-full flex items-center justify-center" style={{ background: 'var(--lj-bg)', color: 'var(--lj-muted)' }}><ChevronLeft size={16} /></button>
+              <span className="text-[13px]" style={{ color: 'var(--lj-text)' }}>Page {page}</span>
+              <button disabled={!nextCursor} onClick={goNext} className="w-8 h-8 rounded-full flex items-center justify-center" style={{ background: 'var(--lj-bg)', color: 'var(--lj-muted)' }}><ChevronRight size={16} /></button>
+            </div>
+          </div>
         </div>
       )}
     </div>